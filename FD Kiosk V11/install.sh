@@ -65,7 +65,7 @@ install_packages() {
     chromium chromium-sandbox firefox-esr
     xdotool wmctrl unclutter zenity
     jq curl dbus-x11 x11-xserver-utils
-    python3-gi gir1.2-gtk-3.0 python3-requests
+    python3-gi gir1.2-gtk-3.0 python3-requests python3-websocket python3-xlib
     at-spi2-core
     xvkbd xfonts-75dpi xfonts-100dpi
   )
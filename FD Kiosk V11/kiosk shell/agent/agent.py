@@ -1,13 +1,20 @@
 #!/usr/bin/env python3
 import argparse
+import asyncio
 import json
 import logging
 import os
+import random
+import signal
 import socket
+import struct
 import subprocess
 import sys
 import threading
 import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 
 import paho.mqtt.client as mqtt
@@ -18,6 +25,9 @@ DEFAULT_QUEUE_PATH = "/var/lib/kiosk-agent/queue.json"
 DEFAULT_LOG_PATH = "/var/lib/kiosk-agent/agent.log"
 DEFAULT_LAST_UPDATE_PATH = "/var/lib/kiosk-agent/last_update.json"
 DEFAULT_RUN_LOCK_PATH = "/var/lib/kiosk-agent/run.lock"
+# Written by kiosk-ui.py (KIOSK_TABS_FILE) after tab changes and toggles.
+DEFAULT_BROWSER_STATS_PATH = "/tmp/kiosk-browser-tabs.json"
+DEFAULT_COMMAND_LOG_DIR = "/var/lib/kiosk-agent/commands"
 ALLOWED_ACTIONS = {
     "update_full",
     "update_os",
@@ -26,6 +36,25 @@ ALLOWED_ACTIONS = {
     "restart_services",
     "reboot",
 }
+HEARTBEAT_MODES = {"full", "delta"}
+# A heartbeat that changes none of these lets the interval back off.
+HEARTBEAT_TRACKED_FIELDS = ("location", "ip", "git_sha", "os_version", "services", "last_update")
+DEFAULT_HEARTBEAT_THRESHOLDS = {"disk_used_pct": 90, "mem_used_pct": 90, "load_per_cpu": 2.0}
+DEFAULT_FACTS_TTL_SEC = {
+    "git_sha": 3600,
+    "os_version": 86400,
+    "ip": 300,
+    "services": 60,
+    "last_update": 3600,
+}
+# Facts that a finished action may have changed.
+ACTION_INVALIDATES = {
+    "update_full": ("git_sha", "os_version", "services", "ip"),
+    "update_os": ("os_version", "services"),
+    "update_repo": ("git_sha",),
+    "run_install": ("git_sha", "services"),
+    "restart_services": ("services",),
+}
 
 
 def utc_now_iso():
@@ -108,6 +137,125 @@ def get_git_sha(repo_path):
         return "unknown"
 
 
+def file_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def git_head_stamp(repo_path):
+    """mtimes of .git/HEAD, the ref it points at and packed-refs (no subprocess)."""
+    if not repo_path:
+        return None
+    git_dir = os.path.join(repo_path, ".git")
+    head_path = os.path.join(git_dir, "HEAD")
+    ref_path = None
+    try:
+        with open(head_path, "r", encoding="utf-8") as f:
+            head = f.read().strip()
+        if head.startswith("ref:"):
+            ref_path = os.path.join(git_dir, head[4:].strip())
+    except OSError:
+        return None
+    return (
+        file_mtime(head_path),
+        file_mtime(ref_path) if ref_path else None,
+        file_mtime(os.path.join(git_dir, "packed-refs")),
+    )
+
+
+class NetlinkWatcher:
+    """Counts rtnetlink link/address/route notifications without a thread.
+
+    generation() drains pending messages and bumps a counter if any arrived,
+    so callers can use it as a cache stamp for the IP address.
+    """
+
+    RTMGRP_LINK = 0x1
+    RTMGRP_IPV4_IFADDR = 0x10
+    RTMGRP_IPV4_ROUTE = 0x40
+    RTMGRP_IPV6_IFADDR = 0x100
+    RTMGRP_IPV6_ROUTE = 0x400
+
+    def __init__(self):
+        self.gen = 0
+        self.sock = None
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+            sock.bind(
+                (
+                    0,
+                    self.RTMGRP_LINK
+                    | self.RTMGRP_IPV4_IFADDR
+                    | self.RTMGRP_IPV4_ROUTE
+                    | self.RTMGRP_IPV6_IFADDR
+                    | self.RTMGRP_IPV6_ROUTE,
+                )
+            )
+            sock.setblocking(False)
+            self.sock = sock
+        except (AttributeError, OSError):
+            self.sock = None
+
+    @property
+    def available(self):
+        return self.sock is not None
+
+    def generation(self):
+        if self.sock is None:
+            return None
+        changed = False
+        while True:
+            try:
+                if not self.sock.recv(65536):
+                    break
+                changed = True
+            except BlockingIOError:
+                break
+            except OSError:
+                # ENOBUFS means we missed notifications; treat as a change.
+                changed = True
+                break
+        if changed:
+            self.gen += 1
+        return self.gen
+
+
+class FactsCache:
+    """Caches slow-changing heartbeat facts.
+
+    A fact is reloaded when its TTL expires, when its stamp (a cheap
+    fingerprint such as a file mtime) changes, or after invalidate().
+    """
+
+    def __init__(self, ttl_sec=None):
+        self.ttl_sec = dict(DEFAULT_FACTS_TTL_SEC)
+        self.ttl_sec.update(ttl_sec or {})
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, name, loader, stamp=None):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(name)
+            if (
+                entry is not None
+                and entry["stamp"] == stamp
+                and now - entry["loaded_at"] < self.ttl_sec.get(name, 60)
+            ):
+                return entry["value"]
+        value = loader()
+        with self.lock:
+            self.entries[name] = {"value": value, "stamp": stamp, "loaded_at": now}
+        return value
+
+    def invalidate(self, *names):
+        with self.lock:
+            for name in names or list(self.entries):
+                self.entries.pop(name, None)
+
+
 def get_os_version():
     try:
         with open("/etc/os-release", "r", encoding="utf-8") as f:
@@ -194,36 +342,221 @@ def get_disk_io(path="/"):
     return {"path": path, "reads": 0, "writes": 0, "read_bytes": 0, "write_bytes": 0}
 
 
+SERVICE_SHOW_PROPERTIES = "Id,LoadState,ActiveState,SubState"
+
+
+def parse_systemctl_show(output):
+    """Split `systemctl show` output into one dict per unit, in argument order."""
+    units = []
+    current = {}
+    for line in output.splitlines():
+        line = line.strip()
+        if not line:
+            if current:
+                units.append(current)
+                current = {}
+            continue
+        if "=" in line:
+            key, value = line.split("=", 1)
+            current[key] = value
+    if current:
+        units.append(current)
+    return units
+
+
+def systemctl_show(services, user=False):
+    cmd = ["systemctl"]
+    if user:
+        cmd.append("--user")
+    cmd += ["show", f"--property={SERVICE_SHOW_PROPERTIES}", "--", *services]
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True)
+    except Exception:
+        return {}
+    units = parse_systemctl_show(result.stdout)
+    if len(units) != len(services):
+        return {}
+    return dict(zip(services, units))
+
+
 def get_service_status(services):
+    """ActiveState for each service with at most two systemctl calls.
+
+    User units are checked first (as the kiosk units are user services);
+    anything not loaded there is looked up in the system manager.
+    """
+    services = [str(service) for service in services if str(service)]
     status = {}
+    if not services:
+        return status
+    user_units = systemctl_show(services, user=True)
+    missing = []
     for service in services:
-        service = str(service)
-        if not service:
-            continue
-        status_val = "unknown"
-        try:
-            result = subprocess.run(
-                ["systemctl", "--user", "is-active", service],
-                capture_output=True,
-                text=True,
-            )
-            status_val = result.stdout.strip() or result.stderr.strip() or "unknown"
-        except Exception:
-            pass
-        if status_val in ("unknown", ""):
-            try:
-                result = subprocess.run(
-                    ["systemctl", "is-active", service],
-                    capture_output=True,
-                    text=True,
-                )
-                status_val = result.stdout.strip() or result.stderr.strip() or "unknown"
-            except Exception:
-                status_val = "unknown"
-        status[service] = status_val
+        unit = user_units.get(service)
+        if unit and unit.get("LoadState") not in (None, "", "not-found"):
+            status[service] = unit.get("ActiveState") or "unknown"
+        else:
+            missing.append(service)
+    if missing:
+        system_units = systemctl_show(missing)
+        for service in missing:
+            unit = system_units.get(service) or {}
+            if unit.get("LoadState") == "not-found":
+                status[service] = "unknown"
+            else:
+                status[service] = unit.get("ActiveState") or "unknown"
     return status
 
 
+class ServiceWatcher:
+    """Tracks unit ActiveState over D-Bus and reports changes.
+
+    Uses PyGObject (python3-gi, already installed for kiosk-ui) to hold one
+    connection per bus, subscribe to systemd, and listen for
+    PropertiesChanged on each configured unit. Units are looked up on the
+    session bus first, then the system bus, matching get_service_status().
+    If gi or the buses are unavailable, start() returns False and callers
+    fall back to get_service_status().
+    """
+
+    SYSTEMD = "org.freedesktop.systemd1"
+    MANAGER_PATH = "/org/freedesktop/systemd1"
+    MANAGER_IFACE = "org.freedesktop.systemd1.Manager"
+    UNIT_IFACE = "org.freedesktop.systemd1.Unit"
+    PROPS_IFACE = "org.freedesktop.DBus.Properties"
+
+    def __init__(self, services, on_change, logger):
+        self.services = [str(service) for service in services if str(service)]
+        self.on_change = on_change
+        self.logger = logger
+        self.states = {}
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.running = False
+        self._loop = None
+
+    def start(self, timeout=5):
+        if not self.services:
+            return False
+        try:
+            import gi  # noqa: F401
+
+            gi.require_version("Gio", "2.0")
+            from gi.repository import Gio, GLib  # noqa: F401
+        except (ImportError, ValueError):
+            return False
+        thread = threading.Thread(target=self._run, name="service-watcher", daemon=True)
+        thread.start()
+        self.ready.wait(timeout)
+        return self.running
+
+    def snapshot(self):
+        with self.lock:
+            return {service: self.states.get(service, "unknown") for service in self.services}
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.quit()
+
+    def _run(self):
+        from gi.repository import Gio, GLib
+
+        context = GLib.MainContext()
+        context.push_thread_default()
+        try:
+            pending = list(self.services)
+            for bus_type in (Gio.BusType.SESSION, Gio.BusType.SYSTEM):
+                if not pending:
+                    break
+                try:
+                    conn = Gio.bus_get_sync(bus_type, None)
+                    self._call(conn, self.MANAGER_PATH, self.MANAGER_IFACE, "Subscribe", None, None)
+                except GLib.Error:
+                    continue
+                pending = [unit for unit in pending if not self._watch(conn, unit)]
+            for unit in pending:
+                self.logger.warning("Service %s not found on any systemd bus", unit)
+            self.running = len(pending) < len(self.services)
+        except Exception as exc:
+            self.logger.warning("Service watcher unavailable: %s", exc)
+            self.running = False
+        self.ready.set()
+        if not self.running:
+            context.pop_thread_default()
+            return
+        self._loop = GLib.MainLoop(context)
+        self._loop.run()
+
+    def _call(self, conn, path, iface, method, args, reply_type):
+        from gi.repository import Gio, GLib
+
+        return conn.call_sync(
+            self.SYSTEMD,
+            path,
+            iface,
+            method,
+            args,
+            GLib.VariantType(reply_type) if reply_type else None,
+            Gio.DBusCallFlags.NONE,
+            -1,
+            None,
+        )
+
+    def _get_props(self, conn, path):
+        from gi.repository import GLib
+
+        reply = self._call(
+            conn, path, self.PROPS_IFACE, "GetAll", GLib.Variant("(s)", (self.UNIT_IFACE,)), "(a{sv})"
+        )
+        return reply.unpack()[0]
+
+    def _watch(self, conn, unit):
+        from gi.repository import Gio, GLib
+
+        try:
+            path = self._call(
+                conn, self.MANAGER_PATH, self.MANAGER_IFACE, "LoadUnit", GLib.Variant("(s)", (unit,)), "(o)"
+            ).unpack()[0]
+            props = self._get_props(conn, path)
+        except GLib.Error:
+            return False
+        if props.get("LoadState") == "not-found":
+            return False
+        with self.lock:
+            self.states[unit] = props.get("ActiveState", "unknown")
+
+        def on_signal(connection, _sender, obj_path, _iface, _signal, params, _data):
+            iface, changed, invalidated = params.unpack()
+            if iface != self.UNIT_IFACE:
+                return
+            if "ActiveState" in changed:
+                state = changed["ActiveState"]
+            elif "ActiveState" in invalidated:
+                try:
+                    state = self._get_props(connection, obj_path).get("ActiveState", "unknown")
+                except GLib.Error:
+                    state = "unknown"
+            else:
+                return
+            with self.lock:
+                previous = self.states.get(unit)
+                self.states[unit] = state
+            if previous != state:
+                self.on_change(unit, previous, state)
+
+        conn.signal_subscribe(
+            self.SYSTEMD,
+            self.PROPS_IFACE,
+            "PropertiesChanged",
+            path,
+            None,
+            Gio.DBusSignalFlags.NONE,
+            on_signal,
+            None,
+        )
+        return True
+
+
 def acquire_lock(lock_path):
     import fcntl
 
@@ -233,107 +566,841 @@ def acquire_lock(lock_path):
     return lock_file
 
 
-def load_queue(queue_path, lock_path):
-    lock_file = acquire_lock(lock_path)
-    try:
-        queue = load_json(queue_path, [])
-        if not isinstance(queue, list):
-            queue = []
-        return queue
-    finally:
-        lock_file.close()
+class CommandJournal:
+    """Append-only journal for the nightly command queue.
+
+    Each record is a 13-byte header (magic, kind, payload length, CRC32)
+    followed by a JSON payload. Enqueue appends one record and fsyncs;
+    ack appends a small record naming the cmd_id. Replay returns enqueued
+    commands without an ack, in order. A corrupt record in the middle of the
+    file is skipped by resyncing on the next magic, so later commands
+    survive; only a torn tail after the last good record is truncated.
+    compact() rewrites the file with only pending commands once enough acks
+    have piled up or corrupt records were skipped. Records are keyed by
+    the `key` field of their payload (cmd_id for the nightly queue).
+    """
+
+    MAGIC = b"KQJ1"
+    HEADER = struct.Struct(">4sBII")
+    ENQUEUE = 1
+    ACK = 2
+
+    def __init__(self, path, lock_path, compact_after=64, key="cmd_id"):
+        self.path = path
+        self.lock_path = lock_path
+        self.compact_after = compact_after
+        self.key = key
+
+    def _append(self, kind, payload):
+        """Append one record; returns the file offsets (start, end) it occupies."""
+        data = json.dumps(payload, sort_keys=True).encode("utf-8")
+        record = self.HEADER.pack(self.MAGIC, kind, len(data), zlib.crc32(data)) + data
+        lock_file = acquire_lock(self.lock_path)
+        try:
+            ensure_parent_dir(self.path)
+            with open(self.path, "ab") as f:
+                start = f.seek(0, os.SEEK_END)
+                f.write(record)
+                f.flush()
+                os.fsync(f.fileno())
+                return start, start + len(record)
+        finally:
+            lock_file.close()
 
+    def enqueue(self, item):
+        return self._append(self.ENQUEUE, item)
 
-def save_queue(queue_path, lock_path, queue):
-    lock_file = acquire_lock(lock_path)
-    try:
-        ensure_parent_dir(queue_path)
-        atomic_write_json(queue_path, queue)
-    finally:
-        lock_file.close()
+    def ack(self, item_id):
+        return self._append(self.ACK, {self.key: item_id})
 
+    def _scan(self):
+        """Return (pending items, ack count, skipped bytes, good length, file length).
 
-def append_queue(queue_path, lock_path, item):
-    lock_file = acquire_lock(lock_path)
-    try:
-        queue = load_json(queue_path, [])
-        if not isinstance(queue, list):
-            queue = []
-        queue.append(item)
-        ensure_parent_dir(queue_path)
-        atomic_write_json(queue_path, queue)
-    finally:
-        lock_file.close()
+        good length is the end of the last good record; skipped bytes counts
+        corrupt data before it that was stepped over.
+        """
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return [], 0, 0, 0, 0
+        pending = {}
+        acks = 0
+        skipped = 0
+        pos = 0
+        good = 0
+        size = self.HEADER.size
+        while pos + size <= len(data):
+            magic, kind, length, crc = self.HEADER.unpack_from(data, pos)
+            body = data[pos + size: pos + size + length]
+            payload = None
+            if magic == self.MAGIC and len(body) == length and zlib.crc32(body) == crc:
+                try:
+                    payload = json.loads(body.decode("utf-8"))
+                except (UnicodeDecodeError, json.JSONDecodeError):
+                    payload = None
+            if not isinstance(payload, dict):
+                following = data.find(self.MAGIC, pos + 1)
+                if following < 0:
+                    break
+                pos = following
+                continue
+            skipped += pos - good
+            if kind == self.ENQUEUE:
+                pending[payload.get(self.key)] = payload
+            elif kind == self.ACK:
+                acks += 1
+                pending.pop(payload.get(self.key), None)
+            pos += size + length
+            good = pos
+        return list(pending.values()), acks, skipped, good, len(data)
+
+    def replay(self, logger=None):
+        lock_file = acquire_lock(self.lock_path)
+        try:
+            pending, acks, skipped, good, total = self._scan()
+            if skipped and logger:
+                logger.warning("Skipped %s corrupt bytes in queue journal %s", skipped, self.path)
+            if good < total:
+                if logger:
+                    logger.warning(
+                        "Truncating %s torn bytes from queue journal %s", total - good, self.path
+                    )
+                with open(self.path, "r+b") as f:
+                    f.truncate(good)
+                    f.flush()
+                    os.fsync(f.fileno())
+            return pending
+        finally:
+            lock_file.close()
 
+    def compact(self, force=False):
+        lock_file = acquire_lock(self.lock_path)
+        try:
+            pending, acks, skipped, good, total = self._scan()
+            if not force and acks < self.compact_after and not skipped and good == total:
+                return False
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "wb") as f:
+                for item in pending:
+                    data = json.dumps(item, sort_keys=True).encode("utf-8")
+                    f.write(self.HEADER.pack(self.MAGIC, self.ENQUEUE, len(data), zlib.crc32(data)))
+                    f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            return True
+        finally:
+            lock_file.close()
 
-def pop_all_queue(queue_path, lock_path):
-    lock_file = acquire_lock(lock_path)
-    try:
-        queue = load_json(queue_path, [])
-        if not isinstance(queue, list):
-            queue = []
-        ensure_parent_dir(queue_path)
-        atomic_write_json(queue_path, [])
-        return queue
-    finally:
-        lock_file.close()
+    def import_legacy(self, json_path, logger=None):
+        """Move commands from the old queue.json into the journal once."""
+        if not os.path.exists(json_path):
+            return 0
+        lock_file = acquire_lock(self.lock_path)
+        try:
+            items = load_json(json_path, [])
+            if not isinstance(items, list):
+                items = []
+            ensure_parent_dir(self.path)
+            with open(self.path, "ab") as f:
+                for item in items:
+                    data = json.dumps(item, sort_keys=True).encode("utf-8")
+                    f.write(self.HEADER.pack(self.MAGIC, self.ENQUEUE, len(data), zlib.crc32(data)))
+                    f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(json_path, f"{json_path}.migrated")
+        finally:
+            lock_file.close()
+        if logger and items:
+            logger.info("Imported %s commands from %s", len(items), json_path)
+        return len(items)
+
+
+class ReplyOutbox:
+    """Disk-backed store-and-forward queue for `reply` messages.
+
+    A reply is appended to a journal before it is published and acked there
+    once the broker confirms it (PUBACK), so results produced while offline
+    or just before a restart are replayed in order on the next connection.
+    Within one process paho retransmits what it was handed, so each reply
+    is handed over once. The nightly runner only appends; the daemon
+    publishes. At most max_messages / max_bytes are kept; beyond that the
+    oldest replies are dropped and counted.
+
+    Pending replies and their sizes are mirrored in memory, so put() and
+    collect() only append. The journal is replayed in full at startup,
+    after a compaction, or when its size shows another process (the nightly
+    runner) wrote to it.
+    """
+
+    def __init__(self, path, lock_path, max_messages=1000, max_bytes=4 * 1024 * 1024, compact_after=64):
+        self.path = path
+        self.journal = CommandJournal(path, lock_path, compact_after, key="id")
+        self.max_messages = max(int(max_messages), 1)
+        self.max_bytes = max(int(max_bytes), 1)
+        self.lock = threading.Lock()
+        self.handed = {}
+        self.items = None
+        self.bytes = 0
+        self.size = None
+        self.acks = 0
+        self.pending = 0
+        self.blocked = False
+        self.stats = {"dropped": 0, "published": 0}
+
+    def _file_size(self):
+        try:
+            return os.stat(self.path).st_size
+        except FileNotFoundError:
+            return 0
+
+    def _reload(self):
+        # Size first: a write racing the replay only costs one more reload.
+        self.size = self._file_size()
+        self.items = OrderedDict(
+            (item["id"], (item, len(json.dumps(item)))) for item in self.journal.replay()
+        )
+        self.bytes = sum(size for _, size in self.items.values())
+        self.pending = len(self.items)
+
+    def _wrote(self, span):
+        """Track our own append; anything else in between forces a reload."""
+        if self.items is not None and span[0] == self.size:
+            self.size = span[1]
+        else:
+            self.items = None
+
+    def put(self, topic, payload):
+        item = {"id": f"{time.time_ns():x}-{os.getpid()}", "topic": topic, "payload": payload}
+        with self.lock:
+            self._wrote(self.journal.enqueue(item))
+            if self.items is None:
+                self._reload()
+            else:
+                size = len(json.dumps(item))
+                self.items[item["id"]] = (item, size)
+                self.bytes += size
+            dropped = 0
+            while len(self.items) > self.max_messages or self.bytes > self.max_bytes:
+                oldest, (_, size) = self.items.popitem(last=False)
+                self.bytes -= size
+                span = self.journal.ack(oldest)
+                dropped += 1
+                self._wrote(span)
+                if self.items is None:
+                    self._reload()
+            self.pending = len(self.items)
+            self.stats["dropped"] += dropped
+        return dropped
+
+    def changed(self):
+        """True when a flush is due: the client was full last time, or the
+        journal changed since (e.g. the nightly runner appended)."""
+        return self.blocked or self._file_size() != self.size
+
+    def flush(self, publish):
+        """Hand pending replies to the client, oldest first.
+
+        publish(topic, payload) returns an MQTTMessageInfo, or None once the
+        client cannot take more.
+        """
+        with self.lock:
+            if self.items is None or self._file_size() != self.size:
+                self._reload()
+            self.blocked = False
+            for item, _ in list(self.items.values()):
+                if item["id"] in self.handed:
+                    continue
+                info = publish(item["topic"], item["payload"])
+                if info is None:
+                    self.blocked = True
+                    break
+                self.handed[item["id"]] = info
+
+    def collect(self):
+        """Ack replies the broker has confirmed; returns how many."""
+        with self.lock:
+            done = [item_id for item_id, info in self.handed.items() if info.is_published()]
+            for item_id in done:
+                self._wrote(self.journal.ack(item_id))
+                del self.handed[item_id]
+                if self.items is not None:
+                    entry = self.items.pop(item_id, None)
+                    if entry is not None:
+                        self.bytes -= entry[1]
+            self.pending = max(self.pending - len(done), 0)
+            self.stats["published"] += len(done)
+            self.acks += len(done)
+            if self.acks >= self.journal.compact_after:
+                self.journal.compact(force=True)
+                self.acks = 0
+                self.items = None
+        return len(done)
+
+    def in_flight(self):
+        """Replies handed to the client and not yet confirmed."""
+        with self.lock:
+            return len(self.handed)
+
+    def snapshot(self):
+        with self.lock:
+            return {"pending": self.pending, "dropped": self.stats["dropped"]}
+
+
+class SeenCommands:
+    """Bounded LRU of cmd_ids this kiosk has accepted, persisted across restarts.
+
+    QoS 1 and controller redelivery can hand the same command over more than
+    once; add() returns False for a cmd_id already seen so it is only acked
+    again, never run twice. The file is rewritten before the command runs, so
+    a reboot or crash mid-command does not forget it.
+    """
+
+    def __init__(self, path, max_entries=512):
+        self.path = path
+        self.max_entries = max(int(max_entries), 1)
+        self.lock = threading.Lock()
+        items = load_json(path, [])
+        self.entries = OrderedDict.fromkeys(items if isinstance(items, list) else [])
+        self._trim()
+
+    def _trim(self):
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def add(self, cmd_id):
+        with self.lock:
+            if cmd_id in self.entries:
+                self.entries.move_to_end(cmd_id)
+                return False
+            self.entries[cmd_id] = None
+            self._trim()
+            ensure_parent_dir(self.path)
+            atomic_write_json(self.path, list(self.entries))
+            return True
+
+
+class OutputRing:
+    """Keeps only the last max_bytes of a byte stream."""
+
+    def __init__(self, max_bytes=4096):
+        self.max_bytes = max_bytes
+        self.buf = bytearray()
+        self.total = 0
+
+    def append(self, data):
+        self.total += len(data)
+        self.buf += data
+        if len(self.buf) > self.max_bytes:
+            del self.buf[: len(self.buf) - self.max_bytes]
+
+    def text(self):
+        return self.buf.decode("utf-8", errors="ignore")
+
+
+class ProgressPublisher:
+    """Rate-limited chunks of live command output.
+
+    Output is buffered until interval_sec has passed since the last chunk.
+    At most max_chunk_bytes are kept between flushes; older bytes are
+    counted in dropped_bytes (the full log is still on disk).
+    """
+
+    def __init__(self, publish, cmd_id, interval_sec=2.0, max_chunk_bytes=8192):
+        self.publish = publish
+        self.cmd_id = cmd_id
+        self.interval_sec = float(interval_sec)
+        self.max_chunk_bytes = max(int(max_chunk_bytes), 256)
+        self.pending = bytearray()
+        self.offset = 0
+        self.dropped = 0
+        self.seq = 0
+        self.last_flush = time.monotonic()
+
+    def feed(self, data):
+        self.pending += data
+        overflow = len(self.pending) - self.max_chunk_bytes
+        if overflow > 0:
+            del self.pending[:overflow]
+            self.offset += overflow
+            self.dropped += overflow
+        self.maybe_flush()
+
+    def maybe_flush(self, force=False, done=False):
+        now = time.monotonic()
+        if not force and now - self.last_flush < self.interval_sec:
+            return
+        if not self.pending and not done:
+            return
+        self.last_flush = now
+        self.seq += 1
+        message = {
+            "cmd_id": self.cmd_id,
+            "seq": self.seq,
+            "offset": self.offset,
+            "data": bytes(self.pending).decode("utf-8", errors="replace"),
+            "dropped_bytes": self.dropped,
+            "done": done,
+            "ts": utc_now_iso(),
+        }
+        self.offset += len(self.pending)
+        self.pending.clear()
+        try:
+            self.publish(message)
+        except Exception:
+            pass
 
 
-def append_queue_list(queue_path, lock_path, items):
-    if not items:
-        return
-    lock_file = acquire_lock(lock_path)
-    try:
-        queue = load_json(queue_path, [])
-        if not isinstance(queue, list):
-            queue = []
-        queue.extend(items)
-        ensure_parent_dir(queue_path)
-        atomic_write_json(queue_path, queue)
-    finally:
-        lock_file.close()
+class CommandLog:
+    """Per-command output file under log_dir, keeping the newest `keep` files."""
+
+    def __init__(self, log_dir, cmd_id, keep=20, max_bytes=10 * 1024 * 1024):
+        self.path = None
+        self.fh = None
+        self.max_bytes = max_bytes
+        self.written = 0
+        if not log_dir:
+            return
+        try:
+            os.makedirs(log_dir, exist_ok=True)
+            self.rotate(log_dir, keep)
+            self.path = os.path.join(log_dir, f"cmd-{cmd_id}.log")
+            self.fh = open(self.path, "ab")
+        except OSError:
+            self.fh = None
+
+    @staticmethod
+    def rotate(log_dir, keep):
+        try:
+            logs = sorted(
+                (entry for entry in os.scandir(log_dir) if entry.name.startswith("cmd-")),
+                key=lambda entry: entry.stat().st_mtime,
+            )
+        except OSError:
+            return
+        for entry in logs[: max(len(logs) - max(keep - 1, 0), 0)]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+    def write(self, data):
+        if self.fh is None or self.written >= self.max_bytes:
+            return
+        data = data[: self.max_bytes - self.written]
+        self.fh.write(data)
+        self.written += len(data)
+        if self.written >= self.max_bytes:
+            self.fh.write(b"\n[log truncated]\n")
 
+    def close(self):
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
 
-def tail_text(text, max_bytes=4096):
-    data = text.encode("utf-8", errors="ignore")
-    if len(data) <= max_bytes:
-        return text
-    return data[-max_bytes:].decode("utf-8", errors="ignore")
 
+def kill_process_group(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        try:
+            proc.kill()
+        except ProcessLookupError:
+            pass
+
+
+async def acquire_lock_async(lock_path, poll_sec=1.0):
+    """acquire_lock() for the event loop: polls instead of blocking a thread,
+    and closes the file if the waiting task is cancelled."""
+    import fcntl
 
-def run_action(action, update_runner_path, timeout_sec, logger, env=None):
+    ensure_parent_dir(lock_path)
+    lock_file = open(lock_path, "a+", encoding="utf-8")
+    try:
+        while True:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return lock_file
+            except BlockingIOError:
+                await asyncio.sleep(poll_sec)
+    except BaseException:
+        lock_file.close()
+        raise
+
+
+async def run_action(
+    action,
+    update_runner_path,
+    timeout_sec,
+    logger,
+    env=None,
+    on_output=None,
+    command_log=None,
+):
+    """Run update_runner.sh, streaming merged stdout/stderr as it arrives.
+
+    Output goes to on_output (live progress) and command_log (full log);
+    only the last 4 KB is kept in memory for the final reply. The runner's
+    process group is killed on timeout and when the calling task is
+    cancelled.
+    """
     started_at = utc_now_iso()
+    ring = OutputRing(4096)
+
+    def emit(data):
+        ring.append(data)
+        if command_log is not None:
+            command_log.write(data)
+        if on_output is not None:
+            on_output(data)
+
+    status = "failed"
     try:
-        result = subprocess.run(
-            [update_runner_path, action],
-            capture_output=True,
-            text=True,
-            timeout=timeout_sec,
+        proc = await asyncio.create_subprocess_exec(
+            update_runner_path,
+            action,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
             env=env,
+            start_new_session=True,
         )
-        output = (result.stdout or "") + (result.stderr or "")
-        status = "success" if result.returncode == 0 else "failed"
-    except subprocess.TimeoutExpired as exc:
-        output = (exc.stdout or "") + (exc.stderr or "")
-        status = "failed"
     except FileNotFoundError as exc:
-        output = f"update_runner_not_found: {exc}"
-        status = "failed"
+        ring.append(f"update_runner_not_found: {exc}".encode("utf-8"))
+        proc = None
     except Exception as exc:
-        output = f"update_runner_error: {exc}"
-        status = "failed"
+        ring.append(f"update_runner_error: {exc}".encode("utf-8"))
+        proc = None
+    if proc is not None:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout_sec
+        timed_out = False
+        try:
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    timed_out = True
+                    break
+                try:
+                    data = await asyncio.wait_for(proc.stdout.read(65536), min(remaining, 1.0))
+                except asyncio.TimeoutError:
+                    if on_output is not None:
+                        on_output(b"")
+                    continue
+                if not data:
+                    break
+                emit(data)
+        except asyncio.CancelledError:
+            kill_process_group(proc)
+            await proc.wait()
+            raise
+        if timed_out:
+            kill_process_group(proc)
+            emit(f"\nupdate_runner timed out after {timeout_sec}s\n".encode("utf-8"))
+        returncode = await proc.wait()
+        status = "success" if returncode == 0 and not timed_out else "failed"
     finished_at = utc_now_iso()
     logger.info("Action %s finished with %s", action, status)
     return {
         "status": status,
         "started_at": started_at,
         "finished_at": finished_at,
-        "output": tail_text(output),
+        "output": ring.text(),
     }
 
 
+def heartbeat_delta(previous, current):
+    """Fields of current that differ from previous; nested objects diff one level deep."""
+    changed = {}
+    for key, value in current.items():
+        old = previous.get(key)
+        if old == value:
+            continue
+        if isinstance(value, dict) and isinstance(old, dict):
+            value = {k: v for k, v in value.items() if old.get(k) != v}
+        changed[key] = value
+    return changed
+
+
+class HeartbeatEncoder:
+    """Turns heartbeats into full snapshots or sequenced deltas.
+
+    In delta mode a full snapshot is sent after reset() (connect, resync
+    request) and every full_every heartbeats; in between only fields that
+    changed since the last sent heartbeat are published.
+    """
+
+    def __init__(self, mode="full", full_every=30):
+        self.mode = mode if mode in HEARTBEAT_MODES else "full"
+        self.full_every = max(int(full_every), 1)
+        self.seq = 0
+        self.since_full = 0
+        self.last_sent = None
+        self.lock = threading.Lock()
+
+    def reset(self):
+        with self.lock:
+            self.last_sent = None
+
+    def encode(self, payload):
+        with self.lock:
+            self.seq += 1
+            if self.mode == "full":
+                return payload
+            if self.last_sent is None or self.since_full + 1 >= self.full_every:
+                message = dict(payload, type="full", seq=self.seq)
+                self.since_full = 0
+            else:
+                changed = heartbeat_delta(self.last_sent, payload)
+                changed["kiosk_id"] = payload["kiosk_id"]
+                message = dict(changed, type="delta", seq=self.seq)
+                self.since_full += 1
+            self.last_sent = payload
+            return message
+
+
+class HeartbeatScheduler:
+    """Picks the delay before each heartbeat.
+
+    A heartbeat whose tracked facts (services, ip, versions, last update)
+    match the previous one stretches the interval by `backoff`, up to
+    max_interval_sec; any change resets it to interval_sec. While busy (a
+    command is running or a metric crosses its alert threshold)
+    min_interval_sec is used instead. The controller's rate hint is a floor
+    on all of them. Every delay is spread by +/- jitter, and startup_delay()
+    (first heartbeat, first after a reconnect) is drawn from
+    [0, startup_jitter_sec) so kiosks restarting together do not report in
+    lockstep.
+    """
+
+    def __init__(
+        self,
+        interval_sec,
+        min_interval_sec=None,
+        max_interval_sec=None,
+        backoff=2.0,
+        jitter=0.1,
+        startup_jitter_sec=None,
+        thresholds=None,
+        rng=None,
+    ):
+        self.interval_sec = max(float(interval_sec), 1.0)
+        self.min_interval_sec = min(float(min_interval_sec or self.interval_sec), self.interval_sec)
+        self.max_interval_sec = max(float(max_interval_sec or 4 * self.interval_sec), self.interval_sec)
+        self.backoff = max(float(backoff), 1.0)
+        self.jitter = min(max(float(jitter), 0.0), 0.5)
+        self.startup_jitter_sec = max(
+            float(self.interval_sec if startup_jitter_sec is None else startup_jitter_sec), 0.0
+        )
+        self.thresholds = dict(DEFAULT_HEARTBEAT_THRESHOLDS, **(thresholds or {}))
+        self.rng = rng or random.Random()
+        self.current = self.interval_sec
+        self.hint_sec = None
+        self.last = None
+        self.last_alerts = []
+
+    def startup_delay(self):
+        return self.rng.uniform(0, self.startup_jitter_sec)
+
+    def set_hint(self, min_interval_sec):
+        """Apply the controller's rate hint; None clears it."""
+        self.hint_sec = float(min_interval_sec) if min_interval_sec else None
+
+    def alerts(self, payload):
+        alerts = []
+        disk = payload.get("disk") or {}
+        if disk.get("total_bytes") and 100 * disk["used_bytes"] / disk["total_bytes"] >= self.thresholds["disk_used_pct"]:
+            alerts.append("disk")
+        memory = payload.get("memory") or {}
+        if memory.get("total_bytes") and 100 * memory["used_bytes"] / memory["total_bytes"] >= self.thresholds["mem_used_pct"]:
+            alerts.append("memory")
+        load = (payload.get("load_avg") or {}).get("1m", 0.0)
+        if load / (os.cpu_count() or 1) >= self.thresholds["load_per_cpu"]:
+            alerts.append("load")
+        return alerts
+
+    def next_delay(self, payload=None, busy=False):
+        """Delay in seconds after sending payload (None: nothing was sent)."""
+        if payload is not None:
+            tracked = {key: payload.get(key) for key in HEARTBEAT_TRACKED_FIELDS}
+            changed = tracked != self.last
+            self.last = tracked
+            self.last_alerts = self.alerts(payload)
+            if busy or self.last_alerts:
+                self.current = self.min_interval_sec
+            elif changed:
+                self.current = self.interval_sec
+            else:
+                self.current = min(self.current * self.backoff, self.max_interval_sec)
+        delay = max(self.current, self.hint_sec or 0.0)
+        return delay * self.rng.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def snapshot(self):
+        return {"interval_sec": self.current, "hint_sec": self.hint_sec, "alerts": list(self.last_alerts)}
+
+
+class MqttLoop:
+    """Runs a paho client on the asyncio event loop instead of loop_start().
+
+    paho's socket callbacks add and remove the client socket from the
+    loop's reader / writer watchers, so network I/O and every paho callback
+    happen on the loop thread. Every read and write goes through _read /
+    _write, which stamp the last traffic in each direction; loop_misc()
+    (keepalive pings) runs when the older stamp is one keepalive old, so an
+    idle connection wakes the loop about once per keepalive. A supervisor
+    task connects and, once the socket closes, reconnects with exponential
+    backoff; the blocking TCP/TLS connect itself runs in the default
+    executor.
+    """
+
+    def __init__(self, client, logger, keepalive=60, min_backoff_sec=1, max_backoff_sec=60):
+        self.client = client
+        self.logger = logger
+        self.keepalive = float(keepalive)
+        self.min_backoff_sec = float(min_backoff_sec)
+        self.max_backoff_sec = float(max_backoff_sec)
+        # Set by the owner's on_connect once the broker accepted the session.
+        self.established = False
+        self.loop = None
+        self.loop_thread = None
+        self.fd = None
+        self.closed = None
+        self.rearm = None
+        self.last_in = 0.0
+        self.last_out = 0.0
+        self.tasks = []
+        client.on_socket_open = self._on_socket_open
+        client.on_socket_close = self._on_socket_close
+        client.on_socket_register_write = self._on_socket_register_write
+        client.on_socket_unregister_write = self._on_socket_unregister_write
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.closed = asyncio.Event()
+        self.closed.set()
+        self.rearm = asyncio.Event()
+        self.tasks = [
+            self.loop.create_task(self._supervise()),
+            self.loop.create_task(self._misc()),
+        ]
+
+    async def stop(self, timeout=2.0):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        if self.fd is not None:
+            self.client.disconnect()
+            try:
+                await asyncio.wait_for(self.closed.wait(), timeout)
+            except asyncio.TimeoutError:
+                self._unwatch(self.fd)
+
+    def _call(self, fn, *args):
+        # Only the socket opened by reconnect() in the executor reports from
+        # another thread; everything else already runs on the loop.
+        if threading.get_ident() == self.loop_thread:
+            fn(*args)
+        else:
+            self.loop.call_soon_threadsafe(fn, *args)
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._call(self._watch, sock)
+
+    def _on_socket_close(self, client, userdata, sock):
+        self._call(self._unwatch, sock.fileno())
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._call(self._want_write, sock)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._call(self._stop_write, sock.fileno())
+
+    def _watch(self, sock):
+        if self.client.socket() is not sock:
+            return
+        self.fd = sock.fileno()
+        self.closed.clear()
+        self.last_in = self.last_out = time.monotonic()
+        self.rearm.set()
+        self.loop.add_reader(self.fd, self._read)
+
+    def _unwatch(self, fd):
+        if fd != self.fd:
+            return
+        self.loop.remove_reader(fd)
+        self.loop.remove_writer(fd)
+        self.fd = None
+        self.closed.set()
+
+    def _want_write(self, sock):
+        if self.fd is not None and self.client.socket() is sock:
+            self.loop.add_writer(self.fd, self._write)
+
+    def _stop_write(self, fd):
+        if fd == self.fd:
+            self.loop.remove_writer(fd)
+
+    def _write(self):
+        self.client.loop_write()
+        self.last_out = time.monotonic()
+
+    def _read(self):
+        rc = self.client.loop_read()
+        self.last_in = time.monotonic()
+        # TLS can hold decrypted records the fd no longer signals.
+        while rc == mqtt.MQTT_ERR_SUCCESS:
+            sock = self.client.socket()
+            if sock is None or not hasattr(sock, "pending") or not sock.pending():
+                break
+            rc = self.client.loop_read()
+
+    def _misc_deadline(self):
+        """Monotonic time loop_misc() next has work to do, or None if never."""
+        # paho 2 exposes keepalive; 1.x only takes it in connect().
+        keepalive = getattr(self.client, "keepalive", None) or self.keepalive
+        if self.fd is None or not keepalive:
+            return None
+        # Our stamps are never older than paho's, so paho is due by then:
+        # a ping, or the timeout of one sent a keepalive ago.
+        return min(self.last_in, self.last_out) + keepalive
+
+    async def _misc(self):
+        while True:
+            deadline = self._misc_deadline()
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0.1)
+            self.rearm.clear()
+            try:
+                await asyncio.wait_for(self.rearm.wait(), timeout)
+                continue
+            except asyncio.TimeoutError:
+                pass
+            # Traffic since we slept moves the deadline; only ping when it is due.
+            deadline = self._misc_deadline()
+            if deadline is not None and deadline <= time.monotonic():
+                self.client.loop_misc()
+                # A ping resets paho's inbound clock too; its write stamps ours.
+                self.last_in = time.monotonic()
+
+    async def _supervise(self):
+        delay = 0.0
+        while True:
+            await self.closed.wait()
+            if self.established:
+                delay = self.min_backoff_sec
+            self.established = False
+            if delay:
+                await asyncio.sleep(delay)
+            delay = min(max(delay * 2, self.min_backoff_sec), self.max_backoff_sec)
+            try:
+                await self.loop.run_in_executor(None, self.client.reconnect)
+            except Exception as exc:
+                self.logger.warning("MQTT connect failed: %s", exc)
+
+
 class KioskAgent:
-    def __init__(self, config_path):
+    def __init__(self, config_path, queue_runner=False):
         self.config_path = config_path
         self.config = load_json(config_path, {})
         if not self.config:
@@ -343,31 +1410,110 @@ class KioskAgent:
         self.topic_prefix = self.config.get("topic_prefix", "kiosk")
         self.queue_path = self.config.get("queue_path", DEFAULT_QUEUE_PATH)
         self.lock_path = f"{self.queue_path}.lock"
+        self.queue_journal_path = self.config.get(
+            "queue_journal_path",
+            os.path.join(os.path.dirname(self.queue_path), "queue.journal"),
+        )
+        self.journal = CommandJournal(
+            self.queue_journal_path,
+            self.lock_path,
+            compact_after=int(self.config.get("queue_compact_after", 64)),
+        )
+        self.seen_commands = SeenCommands(
+            self.config.get(
+                "seen_commands_path",
+                os.path.join(os.path.dirname(self.queue_path), "seen_commands.json"),
+            ),
+            self.config.get("seen_commands_max", 512),
+        )
+        outbox_path = self.config.get(
+            "outbox_path", os.path.join(os.path.dirname(self.queue_path), "outbox.journal")
+        )
+        self.outbox = ReplyOutbox(
+            outbox_path,
+            f"{outbox_path}.lock",
+            max_messages=self.config.get("outbox_max_messages", 1000),
+            max_bytes=self.config.get("outbox_max_bytes", 4 * 1024 * 1024),
+        )
+        self.queue_runner = queue_runner
+        self.connected = threading.Event()
+        self.counter_lock = threading.Lock()
+        self.counters = {"heartbeats_coalesced": 0, "progress_dropped": 0, "publish_dropped": 0}
         self.log_path = self.config.get("log_path", DEFAULT_LOG_PATH)
         self.last_update_path = self.config.get(
             "last_update_path", DEFAULT_LAST_UPDATE_PATH
         )
+        self.browser_stats_path = self.config.get("browser_stats_path", DEFAULT_BROWSER_STATS_PATH)
         self.run_lock_path = self.config.get("run_lock_path", DEFAULT_RUN_LOCK_PATH)
         self.update_runner_path = self.config.get("update_runner_path")
         self.update_timeout_sec = int(self.config.get("update_timeout_sec", 1800))
+        self.command_log_dir = self.config.get("command_log_dir", DEFAULT_COMMAND_LOG_DIR)
+        self.command_log_keep = int(self.config.get("command_log_keep", 20))
+        self.command_log_max_bytes = int(
+            self.config.get("command_log_max_bytes", 10 * 1024 * 1024)
+        )
+        self.progress_interval_sec = float(self.config.get("progress_interval_sec", 2))
+        self.progress_max_chunk_bytes = int(
+            self.config.get("progress_max_chunk_bytes", 8192)
+        )
         self.heartbeat_interval_sec = int(
             self.config.get("heartbeat_interval_sec", 45)
         )
+        self.heartbeat_scheduler = HeartbeatScheduler(
+            self.heartbeat_interval_sec,
+            min_interval_sec=self.config.get("heartbeat_min_interval_sec"),
+            max_interval_sec=self.config.get("heartbeat_max_interval_sec"),
+            backoff=self.config.get("heartbeat_backoff", 2.0),
+            jitter=self.config.get("heartbeat_jitter", 0.1),
+            startup_jitter_sec=self.config.get("heartbeat_startup_jitter_sec"),
+            thresholds=self.config.get("heartbeat_alert_thresholds"),
+        )
+        self.heartbeat_next_at = float("inf")
+        self.heartbeat_encoder = HeartbeatEncoder(
+            self.config.get("heartbeat_mode", "full"),
+            self.config.get("heartbeat_full_every", 30),
+        )
+        self.heartbeat_wake = asyncio.Event()
+        self.stopping = asyncio.Event()
+        self.command_slots = asyncio.Semaphore(max(int(self.config.get("max_concurrent_commands", 1)), 1))
+        self.command_tasks = set()
+        self.shutdown_grace_sec = float(self.config.get("shutdown_grace_sec", 30))
+        self.outbox_poll_sec = float(self.config.get("outbox_poll_sec", 5))
+        self.loop = None
         self.repo_path = self.config.get("repo_path", "")
         self.services = self.config.get("services", [])
+        self.facts = FactsCache(self.config.get("facts_ttl_sec"))
+        self.netlink = NetlinkWatcher()
 
         self.status_topic = f"{self.topic_prefix}/{self.kiosk_id}/status"
         self.cmd_topic = f"{self.topic_prefix}/{self.kiosk_id}/cmd"
         self.reply_topic = f"{self.topic_prefix}/{self.kiosk_id}/reply"
+        self.progress_topic = f"{self.reply_topic}/progress"
+        self.resync_topic = f"{self.topic_prefix}/{self.kiosk_id}/resync"
+        self.rate_hint_topic = self.config.get(
+            "rate_hint_topic", f"{self.topic_prefix}/fleet/heartbeat_rate"
+        )
 
         self.logger = setup_logging(self.log_path)
-        self.client = mqtt.Client(client_id=f"{self.kiosk_id}-agent")
+        self.service_watcher = ServiceWatcher(
+            self.services, self.on_service_change, self.logger
+        )
+        # The daemon keeps a persistent session so QoS 1 commands wait at the
+        # broker while it is offline. The nightly runner uses its own clean
+        # session so it never takes that session over.
+        self.client = mqtt.Client(
+            client_id=f"{self.kiosk_id}-queue" if queue_runner else f"{self.kiosk_id}-agent",
+            clean_session=queue_runner,
+        )
+        self.client.max_queued_messages_set(int(self.config.get("mqtt_max_queued", 100)))
         self.client.on_connect = self.on_connect
         self.client.on_message = self.on_message
         self.client.on_disconnect = self.on_disconnect
-        self._connect_mqtt()
+        self.client.on_publish = self.on_publish
+        keepalive = self._configure_mqtt()
+        self.mqtt = MqttLoop(self.client, self.logger, keepalive=keepalive)
 
-    def _connect_mqtt(self):
+    def _configure_mqtt(self):
         tls_ca = self.config["tls_ca"]
         tls_cert = self.config["tls_cert"]
         tls_key = self.config["tls_key"]
@@ -381,19 +1527,82 @@ class KioskAgent:
         host = self.config["broker_host"]
         port = int(self.config.get("broker_port", 8883))
         keepalive = int(self.config.get("mqtt_keepalive", 60))
-        self.client.connect(host, port, keepalive=keepalive)
+        # MqttLoop connects (and reconnects) once the event loop runs.
+        self.client.connect_async(host, port, keepalive=keepalive)
+        return keepalive
 
     def on_connect(self, client, userdata, flags, rc, properties=None):
         if rc == 0:
-            self.logger.info("Connected to MQTT")
-            client.subscribe(self.cmd_topic)
+            self.logger.info("Connected to MQTT (session present: %s)", flags.get("session present"))
+            self.mqtt.established = True
+            self.connected.set()
+            if self.queue_runner:
+                return
+            client.subscribe([(self.cmd_topic, 1), (self.resync_topic, 1), (self.rate_hint_topic, 1)])
+            self.facts.invalidate("ip")
+            # Jittered: after a broker restart the whole fleet reconnects at once.
+            self.request_full_heartbeat(self.heartbeat_scheduler.startup_delay())
+            self.outbox.flush(self._publish_reply)
         else:
             self.logger.error("MQTT connection failed: %s", rc)
 
     def on_disconnect(self, client, userdata, rc, properties=None):
+        self.connected.clear()
         self.logger.warning("Disconnected from MQTT: %s", rc)
 
+    def on_publish(self, client, userdata, mid):
+        # paho marks the message published only after this callback returns.
+        if not self.queue_runner:
+            self.loop.call_soon(self.outbox.collect)
+
+    def _count(self, name):
+        with self.counter_lock:
+            self.counters[name] += 1
+
+    def _publish_reply(self, topic, payload):
+        info = self.client.publish(topic, json.dumps(payload), qos=1)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            return None
+        return info
+
+    def send_reply(self, reply):
+        """Store the reply in the outbox; the daemon publishes it when connected."""
+        dropped = self.outbox.put(self.reply_topic, reply)
+        if dropped:
+            self.logger.warning("Reply outbox full, dropped %s oldest replies", dropped)
+        if self.connected.is_set() and not self.queue_runner:
+            self.outbox.flush(self._publish_reply)
+
+    def publish_progress(self, message):
+        # Live output is best effort (QoS 0); nothing is buffered while offline.
+        if not self.connected.is_set():
+            self._count("progress_dropped")
+            return
+        self.client.publish(self.progress_topic, json.dumps(message), qos=0)
+
+    def on_service_change(self, service, previous, state):
+        # Runs on the service watcher's GLib thread.
+        self.logger.info("Service %s changed: %s -> %s", service, previous, state)
+        self.facts.invalidate("services")
+        self.loop.call_soon_threadsafe(self.schedule_heartbeat)
+
+    def get_services(self):
+        if self.service_watcher.running:
+            return self.service_watcher.snapshot()
+        return self.facts.get("services", lambda: get_service_status(self.services))
+
     def on_message(self, client, userdata, msg):
+        if msg.topic == self.resync_topic:
+            self.logger.info("Controller requested heartbeat resync")
+            self.request_full_heartbeat()
+            return
+        if msg.topic == self.rate_hint_topic:
+            self.on_rate_hint(msg.payload)
+            return
+        if self.stopping.is_set():
+            # Left unacknowledged so the controller redelivers it after the restart.
+            self.logger.info("Shutting down, not accepting command")
+            return
         try:
             payload = json.loads(msg.payload.decode("utf-8"))
         except json.JSONDecodeError:
@@ -402,49 +1611,169 @@ class KioskAgent:
         if not all(key in payload for key in ("cmd_id", "action", "when", "args")):
             self.logger.warning("Missing required fields in command payload")
             return
+        cmd_id = payload["cmd_id"]
         when = payload.get("when")
+        if when not in ("immediate", "nightly"):
+            self.logger.warning("Unknown command schedule: %s", when)
+            return
+        if not self.seen_commands.add(cmd_id):
+            # Redelivery of a command already accepted: ack again so the
+            # controller stops resending, but do not run it twice.
+            self.logger.info("Duplicate delivery of cmd %s (attempt %s)", cmd_id, payload.get("attempt"))
+            self.acknowledge(cmd_id, duplicate=True)
+            return
         if when == "immediate":
-            threading.Thread(
-                target=self.execute_command, args=(payload,), daemon=True
-            ).start()
-        elif when == "nightly":
-            append_queue(self.queue_path, self.lock_path, payload)
-            self.logger.info("Queued command %s", payload.get("cmd_id"))
+            self.acknowledge(cmd_id)
+            self.start_command(payload)
         else:
-            self.logger.warning("Unknown command schedule: %s", when)
+            self.journal.enqueue(payload)
+            self.acknowledge(cmd_id)
+            self.logger.info("Queued command %s", cmd_id)
+
+    def on_rate_hint(self, raw):
+        # Retained; an empty payload means the controller lifted the hint.
+        try:
+            hint = json.loads(raw.decode("utf-8")) if raw else {}
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            self.logger.warning("Invalid heartbeat rate hint")
+            return
+        value = hint.get("min_interval_sec") if isinstance(hint, dict) else None
+        if not isinstance(value, (int, float)) or value <= 0:
+            value = None
+        if value != self.heartbeat_scheduler.hint_sec:
+            self.logger.info("Heartbeat rate hint: %s", f"{value}s minimum" if value else "cleared")
+        self.heartbeat_scheduler.set_hint(value)
+
+    def acknowledge(self, cmd_id, duplicate=False):
+        reply = {"cmd_id": cmd_id, "status": "received", "received_at": utc_now_iso()}
+        if duplicate:
+            reply["duplicate"] = True
+        self.send_reply(reply)
 
     def build_heartbeat(self):
-        last_update = load_json(self.last_update_path, {})
+        last_update = self.facts.get(
+            "last_update",
+            lambda: load_json(self.last_update_path, {}),
+            stamp=file_mtime(self.last_update_path),
+        )
         payload = {
             "kiosk_id": self.kiosk_id,
             "location": self.location,
             "last_seen": utc_now_iso(),
             "uptime_sec": get_uptime_seconds(),
-            "ip": get_ip(),
-            "git_sha": get_git_sha(self.repo_path),
-            "os_version": get_os_version(),
+            "ip": self.facts.get("ip", get_ip, stamp=self.netlink.generation()),
+            "git_sha": self.facts.get(
+                "git_sha",
+                lambda: get_git_sha(self.repo_path),
+                stamp=git_head_stamp(self.repo_path),
+            ),
+            "os_version": self.facts.get(
+                "os_version", get_os_version, stamp=file_mtime("/etc/os-release")
+            ),
             "disk": get_disk_usage("/"),
             "disk_io": get_disk_io("/"),
             "memory": get_mem_usage(),
             "load_avg": get_load_avg(),
-            "services": get_service_status(self.services),
+            "services": self.get_services(),
             "last_update": last_update or {"status": "unknown", "ts": "unknown"},
+            "delivery": self.delivery_stats(),
         }
+        browser = self.facts.get(
+            "browser",
+            lambda: load_json(self.browser_stats_path, {}),
+            stamp=file_mtime(self.browser_stats_path),
+        )
+        if browser:
+            payload["browser"] = browser
         return payload
 
-    def publish_heartbeat(self):
-        payload = self.build_heartbeat()
-        self.client.publish(self.status_topic, json.dumps(payload), qos=1)
-
-    def heartbeat_loop(self):
+    def delivery_stats(self):
+        outbox = self.outbox.snapshot()
+        with self.counter_lock:
+            stats = dict(self.counters)
+        stats["outbox_pending"] = outbox["pending"]
+        stats["outbox_dropped"] = outbox["dropped"]
+        return stats
+
+    async def publish_heartbeat(self):
+        if not self.connected.is_set():
+            # Only the newest state matters: skip instead of queueing, and let
+            # the full heartbeat sent on reconnect carry it.
+            self._count("heartbeats_coalesced")
+            return None
+        # Probes may shell out (git, systemctl); keep them off the loop.
+        heartbeat = await self.loop.run_in_executor(None, self.build_heartbeat)
+        payload = self.heartbeat_encoder.encode(heartbeat)
+        info = self.client.publish(self.status_topic, json.dumps(payload), qos=1)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            self._count("publish_dropped")
+            self.heartbeat_encoder.reset()
+            return None
+        return heartbeat
+
+    def request_full_heartbeat(self, delay=0):
+        self.heartbeat_encoder.reset()
+        self.schedule_heartbeat(delay)
+
+    def schedule_heartbeat(self, delay=0):
+        """Bring the next heartbeat forward to at most delay seconds from now."""
+        self.heartbeat_next_at = min(self.heartbeat_next_at, self.loop.time() + delay)
+        self.heartbeat_wake.set()
+
+    async def heartbeat_loop(self):
+        # Timed on the loop clock, so a long-running command never delays it.
+        scheduler = self.heartbeat_scheduler
+        self.heartbeat_next_at = min(
+            self.heartbeat_next_at, self.loop.time() + scheduler.startup_delay()
+        )
         while True:
+            timeout = self.heartbeat_next_at - self.loop.time()
+            if timeout > 0:
+                try:
+                    await asyncio.wait_for(self.heartbeat_wake.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                self.heartbeat_wake.clear()
+                continue
+            # Requests arriving while this one is built keep their own time.
+            self.heartbeat_next_at = float("inf")
+            heartbeat = None
             try:
-                self.publish_heartbeat()
+                heartbeat = await self.publish_heartbeat()
             except Exception as exc:
                 self.logger.error("Heartbeat failed: %s", exc)
-            time.sleep(self.heartbeat_interval_sec)
+            delay = scheduler.next_delay(heartbeat, busy=bool(self.command_tasks))
+            self.heartbeat_next_at = min(self.heartbeat_next_at, self.loop.time() + delay)
 
-    def execute_command(self, payload):
+    async def outbox_loop(self):
+        # Confirmed replies are collected from on_publish; this picks up
+        # replies the nightly runner appended and retries a full client.
+        while True:
+            await asyncio.sleep(self.outbox_poll_sec)
+            self.outbox.collect()
+            if self.connected.is_set() and self.outbox.changed():
+                self.outbox.flush(self._publish_reply)
+
+    def start_command(self, payload, resumable=False):
+        task = self.loop.create_task(self.execute_command(payload, resumable))
+        self.command_tasks.add(task)
+        task.add_done_callback(self._command_done)
+        if not self.queue_runner:
+            self.schedule_heartbeat(self.heartbeat_scheduler.min_interval_sec)
+        return task
+
+    def _command_done(self, task):
+        self.command_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            self.logger.error("Command failed: %s", task.exception())
+
+    async def execute_command(self, payload, resumable=False):
+        """Run one command and reply with its result.
+
+        When the task is cancelled at shutdown the runner is killed; the
+        command is reported failed unless it is resumable (still journaled
+        for the next nightly run).
+        """
         cmd_id = payload["cmd_id"]
         action = payload["action"]
         args = payload.get("args") or {}
@@ -459,7 +1788,7 @@ class KioskAgent:
                 "finished_at": utc_now_iso(),
                 "output": f"Unknown action: {action}",
             }
-            self.client.publish(self.reply_topic, json.dumps(reply), qos=1)
+            self.send_reply(reply)
             return
         if not self.update_runner_path:
             self.logger.error("update_runner_path not configured")
@@ -470,7 +1799,7 @@ class KioskAgent:
                 "finished_at": utc_now_iso(),
                 "output": "update_runner_path not configured",
             }
-            self.client.publish(self.reply_topic, json.dumps(reply), qos=1)
+            self.send_reply(reply)
             return
         if not os.path.isfile(self.update_runner_path):
             self.logger.error("update_runner_path not found: %s", self.update_runner_path)
@@ -481,59 +1810,157 @@ class KioskAgent:
                 "finished_at": utc_now_iso(),
                 "output": f"update_runner_path not found: {self.update_runner_path}",
             }
-            self.client.publish(self.reply_topic, json.dumps(reply), qos=1)
+            self.send_reply(reply)
             return
-        lock_file = acquire_lock(self.run_lock_path)
+        async with self.command_slots:
+            lock_file = await acquire_lock_async(self.run_lock_path)
+            try:
+                await self._run_command(cmd_id, action, resumable)
+            finally:
+                lock_file.close()
+
+    async def _run_command(self, cmd_id, action, resumable):
+        env = os.environ.copy()
+        if self.repo_path:
+            env["KIOSK_REPO_PATH"] = self.repo_path
+        progress = ProgressPublisher(
+            self.publish_progress,
+            cmd_id,
+            self.progress_interval_sec,
+            self.progress_max_chunk_bytes,
+        )
+        command_log = CommandLog(
+            self.command_log_dir,
+            cmd_id,
+            keep=self.command_log_keep,
+            max_bytes=self.command_log_max_bytes,
+        )
+        started_at = utc_now_iso()
         try:
-            env = os.environ.copy()
-            if self.repo_path:
-                env["KIOSK_REPO_PATH"] = self.repo_path
-            result = run_action(
+            result = await run_action(
                 action,
                 self.update_runner_path,
                 self.update_timeout_sec,
                 self.logger,
                 env=env,
+                on_output=lambda data: progress.feed(data) if data else progress.maybe_flush(),
+                command_log=command_log,
             )
-            reply = {
-                "cmd_id": cmd_id,
-                "status": result["status"],
-                "started_at": result["started_at"],
-                "finished_at": result["finished_at"],
-                "output": result["output"],
-            }
-            atomic_write_json(
-                self.last_update_path,
-                {"status": result["status"], "ts": result["finished_at"]},
-            )
-            self.client.publish(self.reply_topic, json.dumps(reply), qos=1)
+        except asyncio.CancelledError:
+            progress.maybe_flush(force=True, done=True)
+            if resumable:
+                self.logger.warning("Interrupted cmd %s; it stays queued for the next run", cmd_id)
+            else:
+                self.logger.warning("Interrupted cmd %s at shutdown", cmd_id)
+                self.send_reply(
+                    {
+                        "cmd_id": cmd_id,
+                        "status": "failed",
+                        "started_at": started_at,
+                        "finished_at": utc_now_iso(),
+                        "output": "agent shut down before the command finished",
+                    }
+                )
+            raise
         finally:
-            lock_file.close()
+            command_log.close()
+        progress.maybe_flush(force=True, done=True)
+        reply = {
+            "cmd_id": cmd_id,
+            "status": result["status"],
+            "started_at": result["started_at"],
+            "finished_at": result["finished_at"],
+            "output": result["output"],
+        }
+        atomic_write_json(
+            self.last_update_path,
+            {"status": result["status"], "ts": result["finished_at"]},
+        )
+        self.facts.invalidate("last_update", *ACTION_INVALIDATES.get(action, ()))
+        self.send_reply(reply)
 
-    def run_queue(self):
-        queue = pop_all_queue(self.queue_path, self.lock_path)
+    async def _run_queue(self):
+        # Replies go to the outbox for the daemon; MQTT only carries progress.
+        self.journal.import_legacy(self.queue_path, self.logger)
+        queue = self.journal.replay(self.logger)
         if not queue:
             self.logger.info("Queue empty")
+            self.journal.compact()
             return
         self.logger.info("Running %s queued commands", len(queue))
-        remaining = []
-        for item in queue:
-            try:
-                self.execute_command(item)
-            except Exception as exc:
-                self.logger.error("Command failed: %s", exc)
-                remaining.append(item)
-        append_queue_list(self.queue_path, self.lock_path, remaining)
-
-    def run(self):
-        self.client.loop_start()
-        thread = threading.Thread(target=self.heartbeat_loop, daemon=True)
-        thread.start()
         try:
-            while True:
-                time.sleep(1)
-        except KeyboardInterrupt:
+            for item in queue:
+                if self.stopping.is_set():
+                    break
+                started_at = utc_now_iso()
+                try:
+                    await self.start_command(item, resumable=True)
+                except Exception as exc:
+                    # Report and drop it; an unacked entry would re-run every night.
+                    self.logger.error("Command failed: %s", exc)
+                    self.send_reply(
+                        {
+                            "cmd_id": item.get("cmd_id"),
+                            "status": "failed",
+                            "started_at": started_at,
+                            "finished_at": utc_now_iso(),
+                            "output": f"agent error: {exc}",
+                        }
+                    )
+                self.journal.ack(item.get("cmd_id"))
+        finally:
+            self.journal.compact()
+
+    async def _serve(self):
+        if await self.loop.run_in_executor(None, self.service_watcher.start):
+            self.logger.info("Watching service state over D-Bus")
+        await asyncio.gather(self.heartbeat_loop(), self.outbox_loop())
+
+    async def _main(self, body):
+        self.loop = asyncio.get_running_loop()
+        self.loop.set_default_executor(
+            ThreadPoolExecutor(max_workers=2, thread_name_prefix="kiosk-agent")
+        )
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            self.loop.add_signal_handler(signum, self.stopping.set)
+        self.mqtt.start()
+        work = self.loop.create_task(body)
+        stop = self.loop.create_task(self.stopping.wait())
+        await asyncio.wait({work, stop}, return_when=asyncio.FIRST_COMPLETED)
+        stop.cancel()
+        failed = work.done() and not work.cancelled() and work.exception()
+        if self.stopping.is_set():
             self.logger.info("Shutting down")
+        await self.shutdown(work)
+        if failed:
+            raise failed
+
+    async def shutdown(self, work):
+        """Let running commands finish within shutdown_grace_sec, cancel the
+        rest, hand the outbox to the broker, then disconnect."""
+        self.stopping.set()
+        if self.command_tasks:
+            self.logger.info("Waiting up to %ss for %s commands", self.shutdown_grace_sec, len(self.command_tasks))
+            _, pending = await asyncio.wait(set(self.command_tasks), timeout=self.shutdown_grace_sec)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        work.cancel()
+        await asyncio.gather(work, return_exceptions=True)
+        self.service_watcher.stop()
+        if self.connected.is_set() and not self.queue_runner:
+            self.outbox.flush(self._publish_reply)
+            deadline = self.loop.time() + 5
+            while self.outbox.in_flight() and self.loop.time() < deadline:
+                await asyncio.sleep(0.1)
+                self.outbox.collect()
+        await self.mqtt.stop()
+
+    def run_queue(self):
+        asyncio.run(self._main(self._run_queue()))
+
+    def run(self):
+        asyncio.run(self._main(self._serve()))
 
 
 def main():
@@ -545,7 +1972,7 @@ def main():
     parser.add_argument("--run-queue", action="store_true")
     args = parser.parse_args()
 
-    agent = KioskAgent(args.config)
+    agent = KioskAgent(args.config, queue_runner=args.run_queue)
     if args.run_queue:
         agent.run_queue()
     else:
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""Controller read-path micro-benchmark for GET /api/kiosks.
+
+Usage: python bench/bench_api.py [--kiosks 500] [--requests 2000] [--threads 8]
+Compares the old connect-per-request query with the pooled Database reader,
+then measures the endpoint itself through Flask's test client: a cold body
+(cache invalidated each call), a cached body, and a conditional GET (304).
+"""
+import argparse
+import itertools
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BASE_DIR, "..", "server", "controller"))
+
+import paho.mqtt.client as mqtt  # noqa: E402
+
+import app as controller  # noqa: E402
+
+
+def legacy_list(db_path):
+    conn = sqlite3.connect(db_path, timeout=5)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    rows = conn.execute(controller.LIST_KIOSKS_SQL).fetchall()
+    conn.close()
+    return rows
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    idx = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+def run_threads(fn, total, threads):
+    samples = []
+    lock = threading.Lock()
+    per_thread = max(total // threads, 1)
+
+    def worker():
+        local = []
+        for _ in range(per_thread):
+            started = time.perf_counter()
+            fn()
+            local.append((time.perf_counter() - started) * 1000)
+        with lock:
+            samples.extend(local)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    started = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - started
+    return samples, len(samples) / elapsed
+
+
+def report(label, samples, rate):
+    print(
+        f"{label:<28} p50={statistics.median(samples):7.3f}ms "
+        f"p95={percentile(samples, 95):7.3f}ms p99={percentile(samples, 99):7.3f}ms "
+        f"rate={rate:8.0f}/s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--kiosks", type=int, default=500)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=8)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cfg = {"db_path": os.path.join(tmp, "controller.db")}
+        app, _ = controller.create_app(cfg, mqtt_client=mqtt.Client())
+        db = controller.open_db(cfg)
+        controller.init_db(db)
+        for i in range(args.kiosks):
+            controller.upsert_kiosk(
+                db,
+                {
+                    "kiosk_id": f"kiosk-{i:05d}",
+                    "location": "BENCH",
+                    "last_seen": controller.utc_now_iso(),
+                    "ip": "10.0.0.1",
+                    "os_version": "Debian 13",
+                    "git_sha": "a4a35bb",
+                },
+            )
+
+        samples, rate = run_threads(lambda: legacy_list(db.db_path), args.requests, args.threads)
+        report("query, connect per call", samples, rate)
+        samples, rate = run_threads(lambda: db.read(controller.LIST_KIOSKS_SQL), args.requests, args.threads)
+        report("query, pooled reader", samples, rate)
+
+        client = app.test_client()
+
+        calls = itertools.count()
+
+        def cold():
+            # A distinct query string misses the response cache every call.
+            client.get(f"/api/kiosks?n={next(calls)}", headers={"Accept-Encoding": "gzip"})
+
+        samples, rate = run_threads(cold, args.requests, args.threads)
+        report("GET /api/kiosks, cold", samples, rate)
+        samples, rate = run_threads(
+            lambda: client.get("/api/kiosks", headers={"Accept-Encoding": "gzip"}),
+            args.requests,
+            args.threads,
+        )
+        report("GET /api/kiosks, cached", samples, rate)
+        etag = client.get("/api/kiosks").headers["ETag"]
+        samples, rate = run_threads(
+            lambda: client.get("/api/kiosks", headers={"If-None-Match": etag}),
+            args.requests,
+            args.threads,
+        )
+        report("GET /api/kiosks, 304", samples, rate)
+        db.close()
+
+    print(f"kiosks={args.kiosks} requests={args.requests} threads={args.threads}")
+
+
+if __name__ == "__main__":
+    main()
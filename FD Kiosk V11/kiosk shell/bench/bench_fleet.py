@@ -0,0 +1,540 @@
+#!/usr/bin/env python3
+"""Fleet load test: simulated kiosks against a broker and a live controller.
+
+Usage: python bench/bench_fleet.py [--kiosks 2000] [--processes 4] [--duration 120]
+           [--interval 10] [--commands-per-sec 2] [--report report.json]
+
+Starts the controller (throwaway db, see --controller-config) unless
+--controller-url and --controller-pid point at one already running, then
+runs --kiosks simulated agents split over --processes asyncio workers.
+Each publishes kiosk/<id>/status heartbeats, answers kiosk/<id>/cmd with a
+`received` then a `success` reply, honours the resync and heartbeat rate
+hint topics, and connects with its own client id. The broker must let
+those clients in: server/broker/mosquitto.bench.conf adds a localhost
+listener without client certificates on 1884.
+
+Measured over the --duration window after --warmup:
+- ingest throughput (controller /api/ingest/stats deltas),
+- heartbeat-to-DB latency (publish to the kiosk change event the
+  controller emits after the sqlite commit, matched on last_seen),
+- command round trip (POST /api/command to the `received` and final
+  change events),
+- controller (and --broker-pid) CPU and RSS from /proc.
+The report is written as JSON to --report (stdout summary either way).
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CONTROLLER_DIR = os.path.join(BASE_DIR, "..", "server", "controller")
+sys.path.insert(0, os.path.join(BASE_DIR, "..", "agent"))
+
+import paho.mqtt.client as mqtt  # noqa: E402
+
+from agent import HeartbeatEncoder, MqttLoop, utc_now_iso  # noqa: E402
+
+SERVICES = ("kiosk-session.service", "kiosk-ui.service")
+ACTIONS = ("restart_services", "update_repo")
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    idx = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+def summarize(samples_sec):
+    if not samples_sec:
+        return {"samples": 0}
+    ms = [s * 1000 for s in samples_sec]
+    return {
+        "samples": len(ms),
+        "p50_ms": round(percentile(ms, 50), 2),
+        "p95_ms": round(percentile(ms, 95), 2),
+        "p99_ms": round(percentile(ms, 99), 2),
+        "max_ms": round(max(ms), 2),
+    }
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+class SimLogger:
+    """Counts connect failures instead of logging one line per kiosk."""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def warning(self, *args):
+        self.stats["connect_errors"] += 1
+
+
+class SimKiosk:
+    """One KioskAgent-compatible MQTT client: heartbeats, replies, resync, rate hint."""
+
+    def __init__(self, kiosk_id, args, stats, sent):
+        self.kiosk_id = kiosk_id
+        self.args = args
+        self.stats = stats
+        self.sent = sent
+        self.rng = random.Random(kiosk_id)
+        self.location = f"Bench {self.rng.randrange(50):02d}"
+        self.git_sha = self.rng.choice(("a4a35bb", "b51e0c2", "c0ffee1"))
+        self.booted = time.time() - self.rng.randrange(86400)
+        self.encoder = HeartbeatEncoder(args.heartbeat_mode, 30)
+        self.hint_sec = None
+        self.connected = False
+        self.last_seen = None
+        self.prefix = f"kiosk/{kiosk_id}"
+        self.client = mqtt.Client(client_id=f"{kiosk_id}-agent", clean_session=True)
+        if args.tls_ca:
+            self.client.tls_set(ca_certs=args.tls_ca, certfile=args.tls_cert, keyfile=args.tls_key)
+        self.client.max_queued_messages_set(100)
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.on_message = self.on_message
+        self.client.connect_async(args.broker_host, args.broker_port, keepalive=60)
+        self.mqtt = MqttLoop(self.client, SimLogger(stats), misc_interval_sec=5)
+
+    def on_connect(self, client, userdata, flags, rc, properties=None):
+        if rc != 0:
+            self.stats["connect_errors"] += 1
+            return
+        self.mqtt.established = True
+        self.connected = True
+        self.stats["connected"] += 1
+        self.encoder.reset()
+        client.subscribe(
+            [(f"{self.prefix}/cmd", 1), (f"{self.prefix}/resync", 1), ("kiosk/fleet/heartbeat_rate", 1)]
+        )
+
+    def on_disconnect(self, client, userdata, rc, properties=None):
+        if self.connected:
+            self.stats["disconnects"] += 1
+        self.connected = False
+
+    def on_message(self, client, userdata, msg):
+        if msg.topic.endswith("/resync"):
+            self.encoder.reset()
+            return
+        if msg.topic == "kiosk/fleet/heartbeat_rate":
+            hint = json.loads(msg.payload) if msg.payload else {}
+            self.hint_sec = hint.get("min_interval_sec")
+            return
+        payload = json.loads(msg.payload)
+        self.stats["commands"] += 1
+        started_at = utc_now_iso()
+        self.reply({"cmd_id": payload["cmd_id"], "status": "received", "received_at": started_at})
+        done = {
+            "cmd_id": payload["cmd_id"],
+            "status": "success",
+            "started_at": started_at,
+            "output": f"bench {payload['action']}\n",
+        }
+        asyncio.get_running_loop().call_later(
+            self.args.command_runtime, lambda: self.reply(dict(done, finished_at=utc_now_iso()))
+        )
+
+    def reply(self, payload):
+        self.client.publish(f"{self.prefix}/reply", json.dumps(payload), qos=1)
+
+    def heartbeat(self):
+        now = time.time()
+        return {
+            "kiosk_id": self.kiosk_id,
+            "location": self.location,
+            "last_seen": utc_now_iso(),
+            "uptime_sec": int(now - self.booted),
+            "ip": f"10.{self.rng.randrange(256)}.0.2",
+            "git_sha": self.git_sha,
+            "os_version": "Debian GNU/Linux 13 (trixie)",
+            "disk": {"path": "/", "total_bytes": 64 << 30, "used_bytes": 21 << 30, "free_bytes": 43 << 30},
+            "disk_io": {"device": "mmcblk0", "read_bytes": int(now) * 4096, "write_bytes": int(now) * 8192},
+            "memory": {"total_bytes": 4 << 30, "used_bytes": self.rng.randrange(1 << 30, 3 << 30), "available_bytes": 1 << 30},
+            "load_avg": {"1m": round(self.rng.random(), 2), "5m": 0.4, "15m": 0.3},
+            "services": {service: "active" for service in SERVICES},
+            "last_update": {"status": "success", "ts": "2026-01-29T03:30:00Z"},
+        }
+
+    async def run(self):
+        self.mqtt.start()
+        await asyncio.sleep(self.rng.uniform(0, self.args.interval))
+        while True:
+            if self.connected:
+                payload = self.heartbeat()
+                # The controller stores last_seen at one-second resolution;
+                # skip a heartbeat that would reuse it so latency matches stay 1:1.
+                if payload["last_seen"] != self.last_seen:
+                    self.last_seen = payload["last_seen"]
+                    self.sent[(self.kiosk_id, payload["last_seen"])] = time.time()
+                    info = self.client.publish(
+                        f"{self.prefix}/status", json.dumps(self.encoder.encode(payload)), qos=1
+                    )
+                    self.stats["heartbeats" if info.rc == mqtt.MQTT_ERR_SUCCESS else "publish_errors"] += 1
+            interval = max(self.args.interval, self.hint_sec or 0)
+            await asyncio.sleep(interval * self.rng.uniform(0.9, 1.1))
+
+
+async def run_fleet(kiosk_ids, args, conn):
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=16, thread_name_prefix="bench-connect"))
+    stats = dict.fromkeys(
+        ("connected", "disconnects", "connect_errors", "heartbeats", "publish_errors", "commands"), 0
+    )
+    sent = {}
+    kiosks = []
+    tasks = []
+    for kiosk_id in kiosk_ids:
+        kiosk = SimKiosk(kiosk_id, args, stats, sent)
+        kiosks.append(kiosk)
+        tasks.append(loop.create_task(kiosk.run()))
+        # Spread connects so the broker's accept queue is not the bottleneck.
+        await asyncio.sleep(1.0 / args.connect_rate)
+    conn.send("ready")
+    await loop.run_in_executor(None, conn.recv)
+    # Snapshot before the disconnects below are counted.
+    result = {"stats": dict(stats), "sent": list(sent.items())}
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await asyncio.gather(*(kiosk.mqtt.stop(timeout=1) for kiosk in kiosks), return_exceptions=True)
+    conn.send(result)
+
+
+def fleet_worker(kiosk_ids, args, conn):
+    raise_fd_limit()
+    asyncio.run(run_fleet(kiosk_ids, args, conn))
+
+
+class Controller:
+    def __init__(self, url, pid=None, proc=None):
+        self.url = url.rstrip("/")
+        self.pid = pid
+        self.proc = proc
+
+    def get(self, path, timeout=10):
+        with urllib.request.urlopen(f"{self.url}{path}", timeout=timeout) as resp:
+            return json.load(resp)
+
+    def post(self, path, body):
+        req = urllib.request.Request(
+            f"{self.url}{path}",
+            data=json.dumps(body).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        with urllib.request.urlopen(req, timeout=10) as resp:
+            return json.load(resp)
+
+    def wait_ready(self, timeout=30):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                return self.get("/api/ingest/stats", timeout=2)
+            except OSError:
+                if self.proc is not None and self.proc.poll() is not None:
+                    break
+                time.sleep(0.5)
+        raise RuntimeError(f"controller not reachable at {self.url}")
+
+
+def start_controller(args, tmp):
+    with open(args.controller_config, "r", encoding="utf-8") as f:
+        cfg = json.load(f)
+    cfg["db_path"] = os.path.join(tmp, "controller.db")
+    cfg.setdefault("http", {}).update(host="127.0.0.1", port=args.http_port)
+    config_path = os.path.join(tmp, "controller.json")
+    with open(config_path, "w", encoding="utf-8") as f:
+        json.dump(cfg, f)
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(CONTROLLER_DIR, "app.py")],
+        env=dict(os.environ, KIOSK_CONTROLLER_CONFIG=config_path),
+        stdout=open(os.path.join(tmp, "controller.log"), "wb"),
+        stderr=subprocess.STDOUT,
+    )
+    return Controller(f"http://127.0.0.1:{args.http_port}", proc.pid, proc)
+
+
+class FeedWatcher(threading.Thread):
+    """Long-polls /api/changes and stamps each kiosk and command event on arrival."""
+
+    def __init__(self, controller):
+        super().__init__(name="feed-watcher", daemon=True)
+        self.controller = controller
+        self.kiosks = {}
+        self.commands = {}
+        self.resets = 0
+        self.stop = threading.Event()
+
+    def run(self):
+        since = self.controller.get("/api/changes")["version"]
+        while not self.stop.is_set():
+            try:
+                data = self.controller.get(f"/api/changes?since={since}&wait=2", timeout=10)
+            except OSError:
+                time.sleep(0.5)
+                continue
+            now = time.time()
+            if data["reset"]:
+                self.resets += 1
+                since = data["version"]
+                continue
+            for event in data["events"]:
+                item = event["data"]
+                if event["type"] == "kiosk":
+                    self.kiosks.setdefault((item["kiosk_id"], item["last_seen"]), now)
+                else:
+                    self.commands.setdefault(item["cmd_id"], {}).setdefault(item["status"], now)
+            if data["events"]:
+                since = data["events"][-1]["version"]
+
+
+class ProcSampler(threading.Thread):
+    """Samples RSS once a second and CPU time at start / stop from /proc."""
+
+    def __init__(self, pid):
+        super().__init__(name=f"proc-{pid}", daemon=True)
+        self.pid = pid
+        self.rss = []
+        self.stop = threading.Event()
+        self.started = self.cpu_time()
+        self.started_at = time.time()
+
+    def cpu_time(self):
+        with open(f"/proc/{self.pid}/stat", "r", encoding="utf-8") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+    def rss_bytes(self):
+        with open(f"/proc/{self.pid}/status", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+    def run(self):
+        while not self.stop.wait(1.0):
+            try:
+                self.rss.append(self.rss_bytes())
+            except OSError:
+                return
+
+    def report(self):
+        self.stop.set()
+        elapsed = time.time() - self.started_at
+        try:
+            cpu = self.cpu_time() - self.started
+        except OSError:
+            cpu = None
+        rss = self.rss or [0]
+        return {
+            "pid": self.pid,
+            "cpu_pct": round(100 * cpu / elapsed, 1) if cpu is not None else None,
+            "rss_mb_mean": round(sum(rss) / len(rss) / 2**20, 1),
+            "rss_mb_peak": round(max(rss) / 2**20, 1),
+        }
+
+
+def issue_commands(controller, kiosk_ids, rate, stop, issued, errors):
+    rng = random.Random(1)
+    while not stop.wait(1.0 / rate):
+        body = {"kiosk_id": rng.choice(kiosk_ids), "action": rng.choice(ACTIONS), "when": "immediate"}
+        started = time.time()
+        try:
+            cmd_id = controller.post("/api/command", body)["cmd_id"]
+        except OSError:
+            errors.append(started)
+            continue
+        issued[cmd_id] = started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--kiosks", type=int, default=2000)
+    parser.add_argument("--processes", type=int, default=max(min(os.cpu_count() or 1, 8) // 2, 1))
+    parser.add_argument("--duration", type=float, default=120)
+    parser.add_argument("--warmup", type=float, default=None, help="default: one heartbeat interval")
+    parser.add_argument("--interval", type=float, default=10, help="heartbeat interval per kiosk")
+    parser.add_argument("--heartbeat-mode", choices=("full", "delta"), default="full")
+    parser.add_argument("--connect-rate", type=float, default=500, help="connects per second per process")
+    parser.add_argument("--commands-per-sec", type=float, default=2)
+    parser.add_argument("--command-runtime", type=float, default=0.5)
+    parser.add_argument("--drain", type=float, default=5, help="seconds to wait for late events after the window")
+    parser.add_argument("--broker-host", default="127.0.0.1")
+    parser.add_argument("--broker-port", type=int, default=1884)
+    parser.add_argument("--tls-ca")
+    parser.add_argument("--tls-cert")
+    parser.add_argument("--tls-key")
+    parser.add_argument("--broker-pid", type=int)
+    parser.add_argument("--controller-url")
+    parser.add_argument("--controller-pid", type=int)
+    parser.add_argument("--controller-config", default=os.path.join(CONTROLLER_DIR, "config.json"))
+    parser.add_argument("--http-port", type=int, default=18080)
+    parser.add_argument("--report")
+    args = parser.parse_args()
+    warmup = args.interval if args.warmup is None else args.warmup
+    raise_fd_limit()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.controller_url:
+            controller = Controller(args.controller_url, args.controller_pid)
+        else:
+            controller = start_controller(args, tmp)
+        try:
+            controller.wait_ready()
+            report = run(args, controller, warmup)
+        finally:
+            if controller.proc is not None:
+                controller.proc.terminate()
+                controller.proc.wait(10)
+
+    print(
+        "kiosks={kiosks} processes={processes} interval={interval}s duration={duration}s".format(**vars(args))
+    )
+    ingest = report["ingest"]
+    print(
+        f"ingest: {ingest['received_per_sec']:.0f} received/s, {ingest['written_per_sec']:.0f} written/s, "
+        f"dropped={ingest['dropped']} (offered {report['fleet']['offered_per_sec']:.0f}/s)"
+    )
+    for name in ("heartbeat_to_db", "command_ack", "command_result"):
+        data = report["latency"][name]
+        if data["samples"]:
+            print(
+                f"{name:<16} n={data['samples']:<7} p50={data['p50_ms']:8.1f}ms "
+                f"p95={data['p95_ms']:8.1f}ms p99={data['p99_ms']:8.1f}ms"
+            )
+    for name in ("controller", "broker"):
+        data = report["resources"].get(name)
+        if data:
+            print(f"{name:<16} cpu={data['cpu_pct']}% rss_mean={data['rss_mb_mean']}MB rss_peak={data['rss_mb_peak']}MB")
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"report written to {args.report}")
+
+
+def run(args, controller, warmup):
+    kiosk_ids = [f"bench-{i:05d}" for i in range(args.kiosks)]
+    ctx = multiprocessing.get_context("spawn")
+    workers = []
+    for n in range(args.processes):
+        parent, child = ctx.Pipe()
+        proc = ctx.Process(target=fleet_worker, args=(kiosk_ids[n :: args.processes], args, child), daemon=True)
+        proc.start()
+        workers.append((proc, parent))
+    for _, pipe in workers:
+        pipe.recv()
+
+    feed = FeedWatcher(controller)
+    feed.start()
+    time.sleep(warmup)
+
+    before = controller.get("/api/ingest/stats")
+    samplers = {"controller": ProcSampler(controller.pid)} if controller.pid else {}
+    if args.broker_pid:
+        samplers["broker"] = ProcSampler(args.broker_pid)
+    for sampler in samplers.values():
+        sampler.start()
+    window_start = time.time()
+    stop = threading.Event()
+    issued, command_errors = {}, []
+    commander = None
+    if args.commands_per_sec > 0:
+        commander = threading.Thread(
+            target=issue_commands,
+            args=(controller, kiosk_ids, args.commands_per_sec, stop, issued, command_errors),
+            daemon=True,
+        )
+        commander.start()
+    time.sleep(args.duration)
+    stop.set()
+    window_end = time.time()
+    after = controller.get("/api/ingest/stats")
+    resources = {name: sampler.report() for name, sampler in samplers.items()}
+    if commander is not None:
+        commander.join()
+    # Let in-flight heartbeats and command results land before matching.
+    time.sleep(args.command_runtime + args.drain)
+    feed.stop.set()
+
+    stats, sent = {}, {}
+    for proc, pipe in workers:
+        pipe.send("stop")
+        result = pipe.recv()
+        for key, value in result["stats"].items():
+            stats[key] = stats.get(key, 0) + value
+        sent.update((tuple(key), ts) for key, ts in result["sent"])
+        proc.join(10)
+
+    elapsed = window_end - window_start
+    latencies = [
+        feed.kiosks[key] - ts
+        for key, ts in sent.items()
+        if window_start <= ts < window_end and key in feed.kiosks
+    ]
+    acks, results, unfinished = [], [], 0
+    for cmd_id, started in issued.items():
+        events = feed.commands.get(cmd_id, {})
+        if "received" in events:
+            acks.append(events["received"] - started)
+        if "success" in events:
+            results.append(events["success"] - started)
+        else:
+            unfinished += 1
+    return {
+        "generated_at": utc_now_iso(),
+        "params": {
+            key: getattr(args, key)
+            for key in (
+                "kiosks",
+                "processes",
+                "duration",
+                "interval",
+                "heartbeat_mode",
+                "commands_per_sec",
+                "command_runtime",
+            )
+        },
+        "fleet": dict(stats, offered_per_sec=round(args.kiosks / args.interval, 1)),
+        "ingest": {
+            "received_per_sec": round((after["received"] - before["received"]) / elapsed, 1),
+            "written_per_sec": round((after["written"] - before["written"]) / elapsed, 1),
+            "dropped": after["dropped"] - before["dropped"],
+            "coalesced": after["coalesced"] - before["coalesced"],
+            "flushes": after["flushes"] - before["flushes"],
+            "last_flush_ms": after["last_flush_ms"],
+            "queue_depth": after["queue_depth"],
+            "pacing": after.get("pacing"),
+        },
+        "latency": {
+            "heartbeat_to_db": summarize(latencies),
+            "command_ack": summarize(acks),
+            "command_result": summarize(results),
+        },
+        "commands": {
+            "issued": len(issued),
+            "post_errors": len(command_errors),
+            "unfinished": unfinished,
+        },
+        "feed_resets": feed.resets,
+        "resources": resources,
+    }
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""Heartbeat bytes per kiosk per hour in full vs delta mode.
+
+Usage: python bench/bench_heartbeat_size.py [--interval 10] [--full-every 30]
+Payloads come from the agent's own probes on this machine, with the clock
+and counters advanced as a real kiosk would between heartbeats.
+"""
+import argparse
+import json
+import os
+import sys
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BASE_DIR, "..", "agent"))
+
+import agent  # noqa: E402
+
+
+def base_heartbeat():
+    return {
+        "kiosk_id": "kiosk-nyc-01",
+        "location": "NYC - 5th Ave",
+        "last_seen": agent.utc_now_iso(),
+        "uptime_sec": agent.get_uptime_seconds(),
+        "ip": agent.get_ip(),
+        "git_sha": "a4a35bb",
+        "os_version": agent.get_os_version(),
+        "disk": agent.get_disk_usage("/"),
+        "disk_io": agent.get_disk_io("/"),
+        "memory": agent.get_mem_usage(),
+        "load_avg": agent.get_load_avg(),
+        "services": {"kiosk-session.service": "active", "kiosk-ui.service": "active"},
+        "last_update": {"status": "success", "ts": "2026-01-29T03:30:00Z"},
+    }
+
+
+def advance(payload, step, interval):
+    payload = json.loads(json.dumps(payload))
+    payload["last_seen"] = f"2026-01-30T03:{(step * interval // 60) % 60:02d}:{(step * interval) % 60:02d}Z"
+    payload["uptime_sec"] += interval
+    payload["disk_io"]["writes"] += 7
+    payload["disk_io"]["write_bytes"] += 7 * 4096
+    payload["memory"]["used_bytes"] += (step % 5 - 2) * 65536
+    payload["memory"]["available_bytes"] -= (step % 5 - 2) * 65536
+    payload["load_avg"]["1m"] = round(0.2 + (step % 7) * 0.05, 2)
+    if step % 6 == 0:
+        payload["disk"]["used_bytes"] += 4096
+        payload["disk"]["free_bytes"] -= 4096
+    return payload
+
+
+def bytes_per_hour(mode, interval, full_every):
+    encoder = agent.HeartbeatEncoder(mode, full_every)
+    payload = base_heartbeat()
+    total = 0
+    for step in range(3600 // interval):
+        payload = advance(payload, step, interval)
+        total += len(json.dumps(encoder.encode(payload)).encode("utf-8"))
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--interval", type=int, default=10)
+    parser.add_argument("--full-every", type=int, default=30)
+    args = parser.parse_args()
+
+    full = bytes_per_hour("full", args.interval, args.full_every)
+    delta = bytes_per_hour("delta", args.interval, args.full_every)
+    print(f"interval={args.interval}s full_every={args.full_every}")
+    print(f"full : {full:8d} bytes/kiosk/hour")
+    print(f"delta: {delta:8d} bytes/kiosk/hour ({delta * 100.0 / full:.1f}% of full)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""Heartbeat ingest benchmark: per-message upsert vs HeartbeatIngestor.
+
+Usage: python bench/bench_ingest.py [--kiosks 2000] [--messages 20000]
+Runs against a throwaway sqlite file; never touches server/data.
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BASE_DIR, "..", "server", "controller"))
+
+import app as controller  # noqa: E402
+
+
+def make_payload(i, kiosks):
+    kiosk_id = f"kiosk-{i % kiosks:05d}"
+    return {
+        "kiosk_id": kiosk_id,
+        "location": "BENCH",
+        "last_seen": controller.utc_now_iso(),
+        "ip": "10.0.0.1",
+        "os_version": "Debian 13",
+        "git_sha": "a4a35bb",
+        "services": {"kiosk-session.service": "active", "kiosk-ui.service": "active"},
+        "last_update": {"status": "success", "ts": "2026-01-29T03:30:00Z"},
+    }
+
+
+def legacy_upsert(db_path, payload):
+    # Pre-ingestor behaviour: fresh connection, WAL pragma and commit per message.
+    conn = sqlite3.connect(db_path, timeout=5)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute(controller.UPSERT_KIOSK_SQL, controller.kiosk_row(payload))
+    conn.commit()
+    conn.close()
+
+
+def bench_direct(db_path, kiosks, messages):
+    started = time.perf_counter()
+    for i in range(messages):
+        legacy_upsert(db_path, make_payload(i, kiosks))
+    return messages / (time.perf_counter() - started)
+
+
+def bench_ingestor(db, kiosks, messages, flush_interval, batch_size):
+    ingestor = controller.HeartbeatIngestor(
+        db,
+        flush_interval_sec=flush_interval,
+        batch_size=batch_size,
+        queue_size=messages,
+    )
+    ingestor.start()
+    started = time.perf_counter()
+    for i in range(messages):
+        ingestor.submit(make_payload(i, kiosks))
+    submit_elapsed = time.perf_counter() - started
+    ingestor.stop(timeout=60)
+    total_elapsed = time.perf_counter() - started
+    return messages / submit_elapsed, messages / total_elapsed, ingestor.snapshot()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--kiosks", type=int, default=2000)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--flush-interval", type=float, default=0.2)
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        direct_path = os.path.join(tmp, "direct.db")
+        direct_db = controller.Database(direct_path)
+        controller.init_db(direct_db)
+        direct_db.close()
+        direct_rate = bench_direct(direct_path, args.kiosks, args.messages)
+
+        batch_db = controller.Database(os.path.join(tmp, "batched.db"))
+        controller.init_db(batch_db)
+        submit_rate, sustained_rate, stats = bench_ingestor(
+            batch_db, args.kiosks, args.messages, args.flush_interval, args.batch_size
+        )
+        batch_db.close()
+
+    print(f"kiosks={args.kiosks} messages={args.messages}")
+    print(f"before (upsert per message): {direct_rate:10.0f} heartbeats/s")
+    print(f"after  (callback enqueue)  : {submit_rate:10.0f} heartbeats/s")
+    print(f"after  (enqueue + flushed) : {sustained_rate:10.0f} heartbeats/s")
+    print(
+        "ingest stats: written={written} coalesced={coalesced} dropped={dropped} "
+        "flushes={flushes}".format(**stats)
+    )
+
+
+if __name__ == "__main__":
+    main()
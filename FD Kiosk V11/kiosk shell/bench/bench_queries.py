@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""Kiosk list and command history queries before and after the index migration.
+
+Usage: python bench/bench_queries.py [--kiosks 10000] [--commands 5000000] [--samples 200]
+Builds a pre-migration controller.db (no secondary indexes, user_version 0),
+times the legacy queries, applies the migration the controller runs on start,
+then times the paginated and filtered queries the API now issues.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BASE_DIR, "..", "server", "controller"))
+
+import app as controller  # noqa: E402
+import queries  # noqa: E402
+
+LEGACY_HISTORY_SQL = """
+    SELECT cmd_id, action, when_mode, status, started_at, finished_at, output
+    FROM commands WHERE kiosk_id=? ORDER BY rowid DESC LIMIT 50
+"""
+STATUSES = ("success", "success", "success", "success", "failed", "cancelled", "queued")
+ACTIONS = ("update_full", "update_os", "update_repo", "restart_services", "reboot")
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    idx = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+def timed(label, fn, samples):
+    results = []
+    for _ in range(samples):
+        started = time.perf_counter()
+        fn()
+        results.append((time.perf_counter() - started) * 1000)
+    print(
+        f"{label:<40} p50={statistics.median(results):9.3f}ms "
+        f"p95={percentile(results, 95):9.3f}ms"
+    )
+
+
+def build_legacy_db(db, kiosks, commands, now):
+    controller.init_db(db)
+    with db.transaction() as conn:
+        names = [
+            r[0]
+            for r in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type='index' "
+                "AND (name LIKE 'idx_kiosks_%' OR name IN ('idx_commands_kiosk', 'idx_commands_kiosk_status'))"
+            )
+        ]
+        for name in names:
+            conn.execute(f"DROP INDEX {name}")
+        conn.execute("DROP TABLE IF EXISTS sqlite_stat1")
+        conn.execute("PRAGMA user_version=0")
+
+    rng = random.Random(42)
+    kiosk_ids = [f"kiosk-{i:05d}" for i in range(kiosks)]
+    db.write_many(
+        controller.UPSERT_KIOSK_SQL,
+        [
+            (
+                kiosk_id,
+                f"Store {i % 50:02d}",
+                queries.iso_at(now - rng.choice((30, 120, 900, 1500, 7200, 86400))),
+                "10.0.0.1",
+                rng.choice(("Debian 12", "Debian 13", "Debian 13.1")),
+                rng.choice(("a4a35bb", "b51e0c2", "c0ffee1", "d00d1e5", "e1e10a7")),
+                "{}",
+                "{}",
+            )
+            for i, kiosk_id in enumerate(kiosk_ids)
+        ],
+    )
+    batch = 200000
+    started = time.perf_counter()
+    for offset in range(0, commands, batch):
+        rows = [
+            (
+                f"cmd-{n:08d}",
+                kiosk_ids[n % kiosks],
+                rng.choice(ACTIONS),
+                "immediate",
+                "{}",
+                rng.choice(STATUSES),
+                None,
+                None,
+                None,
+                None,
+            )
+            for n in range(offset, min(offset + batch, commands))
+        ]
+        db.write_many(controller.INSERT_COMMAND_SQL, rows)
+    print(f"loaded {kiosks} kiosks and {commands} commands in {time.perf_counter() - started:.1f}s")
+    return kiosk_ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--kiosks", type=int, default=10000)
+    parser.add_argument("--commands", type=int, default=5000000)
+    parser.add_argument("--samples", type=int, default=200)
+    args = parser.parse_args()
+
+    now = time.time()
+    with tempfile.TemporaryDirectory() as tmp:
+        db = controller.Database(os.path.join(tmp, "controller.db"))
+        kiosk_ids = build_legacy_db(db, args.kiosks, args.commands, now)
+        rng = random.Random(7)
+        legacy_samples = max(args.samples // 20, 5)
+
+        print("-- before migration")
+        timed(
+            "history, kiosk_id=? (legacy)",
+            lambda: db.read(LEGACY_HISTORY_SQL, (rng.choice(kiosk_ids),)),
+            legacy_samples,
+        )
+        timed("kiosk list, all rows (legacy)", lambda: db.read(controller.LIST_KIOSKS_SQL), legacy_samples)
+
+        started = time.perf_counter()
+        with db.transaction() as conn:
+            controller.migrate(conn)
+        print(f"-- migration applied in {time.perf_counter() - started:.1f}s")
+
+        def history(extra):
+            kiosk_id = rng.choice(kiosk_ids)
+            sql, params = queries.history_page_query(kiosk_id, extra, 50)
+            return db.read(sql, params)
+
+        timed("history, first page", lambda: history({}), args.samples)
+        timed("history, page after cursor", lambda: history({"before": str(args.commands // 2)}), args.samples)
+        timed("history, status=failed", lambda: history({"status": "failed"}), args.samples)
+        timed("history, status=queued,running", lambda: history({"status": "queued,running"}), args.samples)
+
+        def kiosk_page(extra):
+            sql, params = queries.kiosk_page_query(extra, 500, now)
+            return db.read(sql, params)
+
+        timed("kiosks, first page (500)", lambda: kiosk_page({}), args.samples)
+        timed(
+            "kiosks, page after cursor",
+            lambda: kiosk_page({"after": rng.choice(kiosk_ids)}),
+            args.samples,
+        )
+        timed("kiosks, location=", lambda: kiosk_page({"location": "Store 07"}), args.samples)
+        timed("kiosks, location_prefix=", lambda: kiosk_page({"location_prefix": "Store 0"}), args.samples)
+        timed("kiosks, git_sha=", lambda: kiosk_page({"git_sha": "c0ffee1"}), args.samples)
+        timed("kiosks, state=online", lambda: kiosk_page({"state": "online"}), args.samples)
+        timed("kiosks, state=offline", lambda: kiosk_page({"state": "offline"}), args.samples)
+
+        print("-- query plans")
+        for label, extra in (("location=", {"location": "Store 07"}), ("location_prefix=", {"location_prefix": "Store 0"})):
+            sql, params = queries.kiosk_page_query(extra, 500, now)
+            for row in db.read("EXPLAIN QUERY PLAN " + sql, params):
+                print(f"kiosks, {label:<31} {row[-1]}")
+        db.close()
+
+    print(f"kiosks={args.kiosks} commands={args.commands} samples={args.samples}")
+
+
+if __name__ == "__main__":
+    main()
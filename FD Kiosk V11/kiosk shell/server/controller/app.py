@@ -1,16 +1,36 @@
+import atexit
 import json
 import os
-import sqlite3
+import queue
 import threading
 import time
+import traceback
 import uuid
 from datetime import datetime, timezone
+from urllib.parse import urlencode
 
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request, stream_with_context
 import paho.mqtt.client as mqtt
 
+from changes import ChangeFeed, parse_event_id
+from db import Database
+from delivery import DeliveryTracker, mark_received
+from fleet import FleetSummary
+from metrics import MetricsStore, init_metrics_schema, parse_ts, point_from_heartbeat
+from outputs import UPSERT_OUTPUT_SQL, OutputStore, init_output_schema, output_row
+from pacing import HeartbeatPacer
+from queries import (
+    DEFAULT_ONLINE_SEC,
+    DEFAULT_STALE_SEC,
+    history_page_query,
+    kiosk_page_query,
+    page_limit,
+)
+from responses import EncodedResponses
+from rollouts import RolloutManager, init_rollouts_schema
+
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-CONFIG_PATH = os.path.join(BASE_DIR, "config.json")
+CONFIG_PATH = os.getenv("KIOSK_CONTROLLER_CONFIG", os.path.join(BASE_DIR, "config.json"))
 ALLOWED_ACTIONS = {
     "update_full",
     "update_os",
@@ -20,6 +40,7 @@ ALLOWED_ACTIONS = {
     "reboot",
 }
 ALLOWED_WHEN = {"immediate", "nightly"}
+KIOSK_FIELDS = ("kiosk_id", "location", "last_seen", "ip", "os_version", "git_sha")
 
 
 def load_config():
@@ -31,121 +52,511 @@ def utc_now_iso():
     return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
 
 
-def db_connect(db_path):
-    conn = sqlite3.connect(db_path, timeout=5)
-    conn.execute("PRAGMA journal_mode=WAL")
-    conn.execute("PRAGMA busy_timeout=5000")
-    return conn
-
-
-def init_db(db_path):
-    os.makedirs(os.path.dirname(db_path), exist_ok=True)
-    conn = db_connect(db_path)
-    cur = conn.cursor()
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS kiosks (
-            kiosk_id TEXT PRIMARY KEY,
-            location TEXT,
-            last_seen TEXT,
-            ip TEXT,
-            os_version TEXT,
-            git_sha TEXT,
-            services_json TEXT,
-            last_update_json TEXT
+def init_db(db):
+    with db.transaction() as conn:
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS kiosks (
+                kiosk_id TEXT PRIMARY KEY,
+                location TEXT,
+                last_seen TEXT,
+                ip TEXT,
+                os_version TEXT,
+                git_sha TEXT,
+                services_json TEXT,
+                last_update_json TEXT
+            )
+            """
         )
-        """
-    )
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS commands (
-            cmd_id TEXT PRIMARY KEY,
-            kiosk_id TEXT,
-            action TEXT,
-            when_mode TEXT,
-            args_json TEXT,
-            status TEXT,
-            started_at TEXT,
-            finished_at TEXT,
-            output TEXT
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS commands (
+                cmd_id TEXT PRIMARY KEY,
+                kiosk_id TEXT,
+                action TEXT,
+                when_mode TEXT,
+                args_json TEXT,
+                status TEXT,
+                started_at TEXT,
+                finished_at TEXT,
+                output TEXT
+            )
+            """
         )
-        """
-    )
-    conn.commit()
-    conn.close()
-
-
-def upsert_kiosk(db_path, payload):
-    conn = db_connect(db_path)
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO kiosks (kiosk_id, location, last_seen, ip, os_version, git_sha, services_json, last_update_json)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ON CONFLICT(kiosk_id) DO UPDATE SET
-            location=excluded.location,
-            last_seen=excluded.last_seen,
-            ip=excluded.ip,
-            os_version=excluded.os_version,
-            git_sha=excluded.git_sha,
-            services_json=excluded.services_json,
-            last_update_json=excluded.last_update_json
-        """,
-        (
-            payload.get("kiosk_id"),
-            payload.get("location"),
-            payload.get("last_seen"),
-            payload.get("ip"),
-            payload.get("os_version"),
-            payload.get("git_sha"),
-            json.dumps(payload.get("services", {})),
-            json.dumps(payload.get("last_update", {})),
-        ),
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS command_progress (
+                cmd_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                byte_offset INTEGER NOT NULL,
+                data TEXT,
+                dropped_bytes INTEGER,
+                done INTEGER,
+                ts TEXT,
+                PRIMARY KEY (cmd_id, seq)
+            )
+            """
+        )
+        init_metrics_schema(conn)
+        init_rollouts_schema(conn)
+        init_output_schema(conn)
+        migrate(conn)
+
+
+def move_inline_output(conn, batch=5000):
+    """Compress commands.output into command_output and clear the inline copy."""
+    last = 0
+    while True:
+        rows = conn.execute(
+            """
+            SELECT rowid, cmd_id, output, finished_at FROM commands
+            WHERE rowid > ? AND output IS NOT NULL ORDER BY rowid LIMIT ?
+            """,
+            (last, batch),
+        ).fetchall()
+        if not rows:
+            return
+        conn.executemany(
+            UPSERT_OUTPUT_SQL,
+            [output_row(r[1], r[2], now=parse_ts(r[3], default=int(time.time()))) for r in rows],
+        )
+        conn.executemany("UPDATE commands SET output=NULL WHERE rowid=?", [(r[0],) for r in rows])
+        last = rows[-1][0]
+
+
+def add_delivery_columns(conn):
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(commands)")}
+    for name, decl in (("attempts", "INTEGER NOT NULL DEFAULT 0"), ("sent_at", "TEXT"), ("acked_at", "TEXT")):
+        if name not in columns:
+            conn.execute(f"ALTER TABLE commands ADD COLUMN {name} {decl}")
+
+
+def add_created_at(conn):
+    """Date commands on insert; outstanding rows from before this step count from now."""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(commands)")}
+    if "created_at" not in columns:
+        conn.execute("ALTER TABLE commands ADD COLUMN created_at TEXT")
+    conn.execute(
+        "UPDATE commands SET created_at=? WHERE created_at IS NULL "
+        "AND status IN ('queued', 'received', 'running')",
+        (utc_now_iso(),),
     )
-    conn.commit()
-    conn.close()
-
-
-def insert_command(db_path, cmd_id, kiosk_id, action, when_mode, args):
-    conn = db_connect(db_path)
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO commands (cmd_id, kiosk_id, action, when_mode, args_json, status, started_at, finished_at, output)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """,
-        (cmd_id, kiosk_id, action, when_mode, json.dumps(args or {}), "queued", None, None, None),
+
+
+# Each entry upgrades PRAGMA user_version by one; existing controller.db files
+# pick up new steps on the next start. Steps are SQL strings or callables
+# taking the connection. Never edit a released step, append one.
+MIGRATIONS = (
+    # 1: secondary indexes for filtered, keyset-paginated reads.
+    (
+        "CREATE INDEX IF NOT EXISTS idx_kiosks_location ON kiosks (location, kiosk_id)",
+        "CREATE INDEX IF NOT EXISTS idx_kiosks_git_sha ON kiosks (git_sha, kiosk_id)",
+        "CREATE INDEX IF NOT EXISTS idx_kiosks_os_version ON kiosks (os_version, kiosk_id)",
+        "CREATE INDEX IF NOT EXISTS idx_kiosks_last_seen ON kiosks (last_seen)",
+        "CREATE INDEX IF NOT EXISTS idx_commands_kiosk ON commands (kiosk_id)",
+        "CREATE INDEX IF NOT EXISTS idx_commands_kiosk_status ON commands (kiosk_id, status)",
+        "PRAGMA analysis_limit=1000",
+        "ANALYZE",
+    ),
+    # 2: command output moves to the compressed command_output table.
+    (
+        move_inline_output,
+        "CREATE INDEX IF NOT EXISTS idx_command_progress_ts ON command_progress (ts)",
+    ),
+    # 3: delivery tracking (acks, redelivery attempts, timeouts).
+    (
+        add_delivery_columns,
+        "CREATE INDEX IF NOT EXISTS idx_commands_outstanding ON commands (status) "
+        "WHERE status IN ('queued', 'received', 'running')",
+    ),
+    # 4: creation time, so undelivered legacy commands expire across restarts.
+    (add_created_at,),
+)
+
+
+def migrate(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for target in range(version + 1, len(MIGRATIONS) + 1):
+        started = time.perf_counter()
+        for step in MIGRATIONS[target - 1]:
+            if callable(step):
+                step(conn)
+            else:
+                conn.execute(step)
+        conn.execute(f"PRAGMA user_version={target}")
+        print(f"Applied schema migration {target} in {time.perf_counter() - started:.1f}s")
+
+
+UPSERT_KIOSK_SQL = """
+    INSERT INTO kiosks (kiosk_id, location, last_seen, ip, os_version, git_sha, services_json, last_update_json)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(kiosk_id) DO UPDATE SET
+        location=excluded.location,
+        last_seen=excluded.last_seen,
+        ip=excluded.ip,
+        os_version=excluded.os_version,
+        git_sha=excluded.git_sha,
+        services_json=excluded.services_json,
+        last_update_json=excluded.last_update_json
+"""
+
+INSERT_COMMAND_SQL = """
+    INSERT INTO commands (cmd_id, kiosk_id, action, when_mode, args_json, status, started_at, finished_at, output,
+                          created_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+UPDATE_COMMAND_SQL = """
+    UPDATE commands
+    SET status=?, started_at=?, finished_at=?
+    WHERE cmd_id=?
+"""
+
+INSERT_PROGRESS_SQL = """
+    INSERT OR REPLACE INTO command_progress (cmd_id, seq, byte_offset, data, dropped_bytes, done, ts)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
+TRIM_PROGRESS_SQL = "DELETE FROM command_progress WHERE cmd_id=? AND seq<=?"
+
+MARK_RUNNING_SQL = """
+    UPDATE commands SET status='running', started_at=?
+    WHERE cmd_id=? AND status IN ('queued', 'received')
+"""
+
+COMMAND_PROGRESS_SQL = """
+    SELECT seq, byte_offset, data, dropped_bytes, done, ts
+    FROM command_progress WHERE cmd_id=? AND seq>? ORDER BY seq LIMIT ?
+"""
+
+LIST_KIOSKS_SQL = """
+    SELECT kiosk_id, location, last_seen, ip, os_version, git_sha
+    FROM kiosks ORDER BY kiosk_id
+"""
+
+GET_KIOSK_SQL = """
+    SELECT kiosk_id, location, last_seen, ip, os_version, git_sha
+    FROM kiosks WHERE kiosk_id=?
+"""
+
+
+def kiosk_row(payload):
+    return (
+        payload.get("kiosk_id"),
+        payload.get("location"),
+        payload.get("last_seen"),
+        payload.get("ip"),
+        payload.get("os_version"),
+        payload.get("git_sha"),
+        json.dumps(payload.get("services", {})),
+        json.dumps(payload.get("last_update", {})),
     )
-    conn.commit()
-    conn.close()
-
-
-def update_command_result(db_path, payload):
-    conn = db_connect(db_path)
-    cur = conn.cursor()
-    cur.execute(
-        """
-        UPDATE commands
-        SET status=?, started_at=?, finished_at=?, output=?
-        WHERE cmd_id=?
-        """,
-        (
-            payload.get("status"),
-            payload.get("started_at"),
-            payload.get("finished_at"),
-            payload.get("output"),
-            payload.get("cmd_id"),
-        ),
+
+
+def kiosk_summary(payload):
+    return {name: payload.get(name) for name in KIOSK_FIELDS}
+
+
+def command_change(cmd_id, kiosk_id, status, **fields):
+    return dict(fields, cmd_id=cmd_id, kiosk_id=kiosk_id, status=status)
+
+
+def upsert_kiosk(db, payload):
+    db.write(UPSERT_KIOSK_SQL, kiosk_row(payload))
+    db.bump("kiosks")
+
+
+class HeartbeatIngestor:
+    """Buffers heartbeats off the MQTT thread and writes them in batches.
+
+    A single writer thread keeps the newest payload per kiosk_id and flushes
+    each tick in one transaction, with every heartbeat's metrics points.
+    After commit it feeds the change feed and fleet summary, then runs maintenance.
+    """
+
+    def __init__(
+        self,
+        db,
+        flush_interval_sec=1.0,
+        batch_size=500,
+        queue_size=10000,
+        metrics=None,
+        feed=None,
+        maintenance=(),
+        fleet=None,
+    ):
+        self.db = db
+        self.metrics = metrics
+        self.feed = feed
+        self.fleet = fleet
+        self.maintenance = list(maintenance)
+        self.flush_interval_sec = max(float(flush_interval_sec), 0.01)
+        self.batch_size = max(int(batch_size), 1)
+        self.queue = queue.Queue(maxsize=max(int(queue_size), 1))
+        self.lock = threading.Lock()
+        self.stats = {
+            "received": 0,
+            "dropped": 0,
+            "coalesced": 0,
+            "written": 0,
+            "flushes": 0,
+            "errors": 0,
+            "last_batch_size": 0,
+            "last_flush_ms": 0.0,
+        }
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="heartbeat-ingest", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def submit(self, payload):
+        """Enqueue without blocking; returns False when the queue is full."""
+        try:
+            self.queue.put_nowait(payload)
+        except queue.Full:
+            with self.lock:
+                self.stats["dropped"] += 1
+            return False
+        with self.lock:
+            self.stats["received"] += 1
+        return True
+
+    def snapshot(self):
+        with self.lock:
+            data = dict(self.stats)
+        data["queue_depth"] = self.queue.qsize()
+        data["queue_size"] = self.queue.maxsize
+        data["flush_interval_sec"] = self.flush_interval_sec
+        data["batch_size"] = self.batch_size
+        return data
+
+    def _collect(self):
+        pending = {}
+        points = []
+        coalesced = 0
+        deadline = time.monotonic() + self.flush_interval_sec
+        while len(pending) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                payload = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            coalesced += self._add(pending, points, payload)
+        return pending, points, coalesced
+
+    def _drain(self):
+        pending = {}
+        points = []
+        coalesced = 0
+        while True:
+            try:
+                payload = self.queue.get_nowait()
+            except queue.Empty:
+                return pending, points, coalesced
+            coalesced += self._add(pending, points, payload)
+
+    def _error(self, what, detail=None):
+        # Log and count, but never let one bad payload or job end the writer thread.
+        print(f"{what} failed: {detail}" if detail else f"{what} failed:\n{traceback.format_exc()}")
+        with self.lock:
+            self.stats["errors"] += 1
+
+    def _add(self, pending, points, payload):
+        if not isinstance(payload, dict):
+            self._error("Heartbeat decode", f"not an object: {type(payload).__name__}")
+            return 0
+        if self.metrics is not None:
+            try:
+                point = point_from_heartbeat(payload)
+            except Exception:
+                # Malformed telemetry only costs its metrics point, not the kiosk row.
+                self._error("Heartbeat telemetry")
+                point = None
+            if point is not None:
+                points.append(point)
+        kiosk_id = payload.get("kiosk_id")
+        replaced = kiosk_id in pending
+        pending[kiosk_id] = payload
+        return 1 if replaced else 0
+
+    def _flush(self, pending, points, coalesced):
+        if not pending and not coalesced:
+            return
+        started = time.perf_counter()
+        try:
+            with self.db.transaction() as conn:
+                conn.executemany(UPSERT_KIOSK_SQL, [kiosk_row(p) for p in pending.values()])
+                if self.metrics is not None:
+                    self.metrics.write(conn, points)
+        except Exception:
+            self._error("Heartbeat flush")
+            with self.lock:
+                self.stats["coalesced"] += coalesced
+            return
+        if pending:
+            self.db.bump("kiosks")
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with self.lock:
+            self.stats["coalesced"] += coalesced
+            self.stats["written"] += len(pending)
+            self.stats["flushes"] += 1
+            self.stats["last_batch_size"] = len(pending)
+            self.stats["last_flush_ms"] = round(elapsed_ms, 3)
+        if self.fleet is not None and pending:
+            try:
+                self.fleet.update_many(pending.values())
+            except Exception:
+                self._error("Fleet summary update")
+        if self.feed is not None and pending:
+            try:
+                self.feed.publish_many("kiosk", [kiosk_summary(p) for p in pending.values()])
+            except Exception:
+                self._error("Change feed publish")
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self._flush(*self._collect())
+            except Exception:
+                self._error("Heartbeat batch")
+            for job in self.maintenance:
+                try:
+                    job()
+                except Exception:
+                    self._error(f"Maintenance job {getattr(job, '__qualname__', job)}")
+        try:
+            self._flush(*self._drain())
+        except Exception:
+            self._error("Final heartbeat flush")
+
+
+def apply_delta(state, delta):
+    """Merge a delta heartbeat into state; nested objects merge one level deep."""
+    for key, value in delta.items():
+        current = state.get(key)
+        if isinstance(value, dict) and isinstance(current, dict):
+            state[key] = dict(current, **value)
+        else:
+            state[key] = value
+
+
+class HeartbeatMerger:
+    """Rebuilds full heartbeat state from agents running in delta mode.
+
+    Full snapshots (no "type", or type "full") replace the stored state.
+    Deltas are merged only when their seq follows the last one seen;
+    otherwise the caller is told to request a resync, rate limited per kiosk.
+    """
+
+    def __init__(self, resync_interval_sec=30):
+        self.resync_interval_sec = resync_interval_sec
+        self.state = {}
+        self.last_resync = {}
+        self.stats = {"full": 0, "delta": 0, "gaps": 0, "resyncs": 0}
+
+    def merge(self, payload):
+        """Return (merged payload or None, resync_needed)."""
+        kiosk_id = payload["kiosk_id"]
+        kind = payload.pop("type", "full")
+        seq = payload.pop("seq", None)
+        if kind != "delta":
+            self.stats["full"] += 1
+            self.state[kiosk_id] = {"seq": seq, "payload": dict(payload)}
+            return payload, False
+        self.stats["delta"] += 1
+        known = self.state.get(kiosk_id)
+        if known is None or known["seq"] is None or seq != known["seq"] + 1:
+            self.stats["gaps"] += 1
+            merged = None
+            if known is not None:
+                apply_delta(known["payload"], payload)
+                known["seq"] = None
+                merged = dict(known["payload"])
+            return merged, self._resync_due(kiosk_id)
+        apply_delta(known["payload"], payload)
+        known["seq"] = seq
+        return dict(known["payload"]), False
+
+    def _resync_due(self, kiosk_id):
+        now = time.monotonic()
+        if now - self.last_resync.get(kiosk_id, -self.resync_interval_sec) < self.resync_interval_sec:
+            return False
+        self.last_resync[kiosk_id] = now
+        self.stats["resyncs"] += 1
+        return True
+
+
+def insert_command(db, cmd_id, kiosk_id, action, when_mode, args):
+    db.write(
+        INSERT_COMMAND_SQL,
+        (cmd_id, kiosk_id, action, when_mode, json.dumps(args or {}), "queued", None, None, None, utc_now_iso()),
     )
-    conn.commit()
-    conn.close()
+    db.bump("commands")
+
+
+def update_command_result(db, payload, level=6):
+    with db.transaction() as conn:
+        conn.execute(
+            UPDATE_COMMAND_SQL,
+            (
+                payload.get("status"),
+                payload.get("started_at"),
+                payload.get("finished_at"),
+                payload.get("cmd_id"),
+            ),
+        )
+        if payload.get("output"):
+            conn.execute(UPSERT_OUTPUT_SQL, output_row(payload.get("cmd_id"), payload["output"], level))
+    db.bump("commands")
+
+
+def record_progress(db, payload, keep_chunks=500):
+    """Store one live-output chunk, keeping only the newest keep_chunks per command.
+
+    Returns True when this chunk moved the command from queued/received to running.
+    """
+    cmd_id = payload.get("cmd_id")
+    seq = int(payload.get("seq") or 0)
+    with db.transaction() as conn:
+        conn.execute(
+            INSERT_PROGRESS_SQL,
+            (
+                cmd_id,
+                seq,
+                int(payload.get("offset") or 0),
+                payload.get("data") or "",
+                int(payload.get("dropped_bytes") or 0),
+                1 if payload.get("done") else 0,
+                payload.get("ts") or utc_now_iso(),
+            ),
+        )
+        started = conn.execute(MARK_RUNNING_SQL, (payload.get("ts") or utc_now_iso(), cmd_id)).rowcount
+        if seq > keep_chunks:
+            conn.execute(TRIM_PROGRESS_SQL, (cmd_id, seq - keep_chunks))
+    if started:
+        db.bump("commands")
+    return started > 0
 
 
-def make_mqtt_client(cfg, db_path):
+def make_mqtt_client(cfg, db, ingestor, merger, rollouts, feed, outputs, tracker, pacer):
     def on_connect(client, userdata, flags, rc, _properties=None):
         if rc == 0:
             client.subscribe("kiosk/+/status")
             client.subscribe("kiosk/+/reply")
+            client.subscribe("kiosk/+/reply/progress")
+            pacer.republish()
         else:
             print(f"MQTT connect failed: {rc}")
 
@@ -156,17 +567,63 @@ def make_mqtt_client(cfg, db_path):
             return
 
         if msg.topic.endswith("/status"):
-            if not payload.get("kiosk_id"):
+            kiosk_id = payload.get("kiosk_id")
+            if not kiosk_id:
                 print("Ignoring heartbeat without kiosk_id")
                 return
+            payload, resync = merger.merge(payload)
+            if resync:
+                client.publish(f"kiosk/{kiosk_id}/resync", "{}", qos=1)
+            tracker.kiosk_seen(kiosk_id)
+            if payload is None:
+                return
             if "last_seen" not in payload:
                 payload["last_seen"] = utc_now_iso()
-            upsert_kiosk(db_path, payload)
+            ingestor.submit(payload)
         elif msg.topic.endswith("/reply"):
             if not payload.get("cmd_id"):
                 print("Ignoring reply without cmd_id")
                 return
-            update_command_result(db_path, payload)
+            if payload.get("status") == "received":
+                acked_at = payload.get("received_at") or utc_now_iso()
+                tracker.on_command_status(payload["cmd_id"], "received")
+                if mark_received(db, payload["cmd_id"], acked_at):
+                    rollouts.on_command_status(payload["cmd_id"], "received")
+                    feed.publish(
+                        "command",
+                        command_change(
+                            payload["cmd_id"], msg.topic.split("/")[1], "received", acked_at=acked_at
+                        ),
+                    )
+                return
+            update_command_result(db, payload, outputs.level)
+            tracker.on_command_status(payload["cmd_id"], payload.get("status"))
+            rollouts.on_command_status(payload["cmd_id"], payload.get("status"))
+            feed.publish(
+                "command",
+                command_change(
+                    payload["cmd_id"],
+                    msg.topic.split("/")[1],
+                    payload.get("status"),
+                    started_at=payload.get("started_at"),
+                    finished_at=payload.get("finished_at"),
+                ),
+            )
+        elif msg.topic.endswith("/reply/progress"):
+            if not payload.get("cmd_id"):
+                return
+            tracker.on_command_status(payload["cmd_id"], "running")
+            if record_progress(db, payload):
+                feed.publish(
+                    "command",
+                    command_change(
+                        payload["cmd_id"],
+                        msg.topic.split("/")[1],
+                        "running",
+                        started_at=payload.get("ts"),
+                    ),
+                )
+            rollouts.on_command_status(payload["cmd_id"], "running")
 
     client = mqtt.Client()
     client.tls_set(
@@ -180,66 +637,339 @@ def make_mqtt_client(cfg, db_path):
     return client
 
 
-def create_app():
-    cfg = load_config()
+def open_db(cfg):
     db_path = os.path.abspath(os.path.join(BASE_DIR, cfg["db_path"]))
-    init_db(db_path)
+    sqlite_cfg = cfg.get("sqlite", {})
+    return Database(
+        db_path,
+        pragmas=sqlite_cfg.get("pragmas"),
+        read_pool_size=sqlite_cfg.get("read_pool_size", 4),
+    )
+
+
+def create_app(cfg=None, mqtt_client=None):
+    if cfg is None:
+        cfg = load_config()
+    db = open_db(cfg)
+    init_db(db)
+
+    metrics_cfg = cfg.get("metrics", {})
+    metrics = None
+    if metrics_cfg.get("enabled", True):
+        metrics = MetricsStore(
+            db,
+            retention_sec={
+                "kiosk_metrics_raw": metrics_cfg.get("raw_retention_sec", 6 * 3600),
+                "kiosk_metrics_1m": metrics_cfg.get("minute_retention_sec", 14 * 86400),
+                "kiosk_metrics_1h": metrics_cfg.get("hour_retention_sec", 400 * 86400),
+            },
+            prune_interval_sec=metrics_cfg.get("prune_interval_sec", 300),
+            prune_batch=metrics_cfg.get("prune_batch", 5000),
+        )
+
+    feed = ChangeFeed(cfg.get("changes", {}).get("max_events", 10000))
+
+    outputs_cfg = cfg.get("outputs", {})
+    outputs = OutputStore(
+        db,
+        max_age_sec=outputs_cfg.get("max_age_sec", 90 * 86400),
+        max_total_bytes=outputs_cfg.get("max_total_bytes", 1024 * 1024 * 1024),
+        prune_interval_sec=outputs_cfg.get("prune_interval_sec", 300),
+        prune_batch=outputs_cfg.get("prune_batch", 2000),
+        level=outputs_cfg.get("compress_level", 6),
+    )
+    maintenance = [outputs.maybe_prune]
+    if metrics is not None:
+        maintenance.append(metrics.maybe_prune)
+
+    fleet_cfg = cfg.get("fleet", {})
+    online_sec = fleet_cfg.get("online_sec", DEFAULT_ONLINE_SEC)
+    stale_sec = fleet_cfg.get("stale_sec", DEFAULT_STALE_SEC)
+    fleet = FleetSummary(online_sec, stale_sec, sweep_sec=fleet_cfg.get("sweep_sec", 5))
+    fleet.load(db)
+    fleet.start()
+    atexit.register(fleet.stop)
+
+    def publish_retained(topic, payload):
+        info = mqtt_client.publish(topic, payload, qos=1, retain=True)
+        return info.rc == mqtt.MQTT_ERR_SUCCESS
+
+    def reporting_kiosks():
+        status = fleet.snapshot()["status"]
+        return status["online"] + status["stale"]
+
+    ingest_cfg = cfg.get("ingest", {})
+    ingestor = HeartbeatIngestor(
+        db,
+        flush_interval_sec=ingest_cfg.get("flush_interval_sec", 1.0),
+        batch_size=ingest_cfg.get("batch_size", 500),
+        queue_size=ingest_cfg.get("queue_size", 10000),
+        metrics=metrics,
+        feed=feed,
+        maintenance=maintenance,
+        fleet=fleet,
+    )
+
+    pacing_cfg = cfg.get("heartbeat_pacing", {})
+    pacer = HeartbeatPacer(
+        publish_retained,
+        ingestor.snapshot,
+        reporting_kiosks,
+        max_per_sec=pacing_cfg.get("max_per_sec", 200),
+        queue_high_water=pacing_cfg.get("queue_high_water", 0.5),
+        # Never throttle kiosks into looking stale.
+        max_interval_sec=min(pacing_cfg.get("max_interval_sec", 120), online_sec // 2),
+        release_after_sec=pacing_cfg.get("release_after_sec", 300),
+        release_below_sec=pacing_cfg.get("release_below_sec", 10),
+        eval_sec=pacing_cfg.get("eval_sec", 10),
+    )
+    ingestor.maintenance.append(pacer.maybe_update)
 
-    mqtt_client = make_mqtt_client(cfg, db_path)
+    merger = HeartbeatMerger(cfg.get("ingest", {}).get("resync_interval_sec", 30))
 
-    thread = threading.Thread(target=mqtt_client.loop_forever, daemon=True)
-    thread.start()
+    def publish_command(kiosk_id, payload):
+        info = mqtt_client.publish(f"kiosk/{kiosk_id}/cmd", json.dumps(payload), qos=1)
+        return info.rc == mqtt.MQTT_ERR_SUCCESS
+
+    delivery_cfg = cfg.get("delivery", {})
+    tracker = DeliveryTracker(
+        db,
+        publish_command,
+        ack_timeout_sec=delivery_cfg.get("ack_timeout_sec", 30),
+        max_backoff_sec=delivery_cfg.get("max_backoff_sec", 600),
+        max_attempts=delivery_cfg.get("max_attempts", 4),
+        expire_sec=delivery_cfg.get("expire_sec", 86400),
+        run_timeout_sec=delivery_cfg.get("run_timeout_sec", 3600),
+        nightly_timeout_sec=delivery_cfg.get("nightly_timeout_sec", 2 * 86400),
+        tick_sec=delivery_cfg.get("tick_sec", 1.0),
+        feed=feed,
+    )
+
+    rollout_cfg = cfg.get("rollouts", {})
+    rollouts = RolloutManager(
+        db, tracker.send, tick_sec=rollout_cfg.get("tick_sec", 1.0), feed=feed
+    )
+    tracker.on_status_change = rollouts.on_command_status
+
+    # The publish helpers above use mqtt_client, so it must exist before any
+    # thread that publishes (pacer via ingest maintenance, redelivery, waves).
+    loop_thread = None
+    if mqtt_client is None:
+        mqtt_client = make_mqtt_client(cfg, db, ingestor, merger, rollouts, feed, outputs, tracker, pacer)
+        loop_thread = threading.Thread(target=mqtt_client.loop_forever, daemon=True)
+    ingestor.start()
+    atexit.register(ingestor.stop)
+    tracker.start()
+    atexit.register(tracker.stop)
+    rollouts.start()
+    atexit.register(rollouts.stop)
+    if loop_thread is not None:
+        loop_thread.start()
+
+    http_cfg = cfg.get("http", {})
+    responses = EncodedResponses(
+        max_entries=http_cfg.get("response_cache_entries", 256),
+        max_bytes=http_cfg.get("response_cache_bytes", 32 * 1024 * 1024),
+        gzip_min_bytes=http_cfg.get("gzip_min_bytes", 1024),
+    )
 
     app = Flask(__name__)
 
+    def page_headers(version, cursor_name, cursor):
+        headers = {"X-Change-Version": str(version)}
+        if cursor is not None:
+            args = request.args.to_dict()
+            args[cursor_name] = cursor
+            headers["X-Next-Cursor"] = str(cursor)
+            headers["Link"] = f'<{request.path}?{urlencode(args)}>; rel="next"'
+        return headers
+
     @app.get("/api/kiosks")
     def list_kiosks():
-        conn = db_connect(db_path)
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT kiosk_id, location, last_seen, ip, os_version, git_sha FROM kiosks ORDER BY kiosk_id"
-        )
-        rows = cur.fetchall()
-        conn.close()
-        kiosks = [
-            {
-                "kiosk_id": r[0],
-                "location": r[1],
-                "last_seen": r[2],
-                "ip": r[3],
-                "os_version": r[4],
-                "git_sha": r[5],
-            }
-            for r in rows
-        ]
-        return jsonify(kiosks)
+        # Take validators before the query: a racing write can only make the
+        # body newer than its ETag/version, which costs one refetch, never a miss.
+        etag = db.etag("kiosks")
+        now = time.time()
+        if request.args.get("state"):
+            # online/stale/offline move with the clock, not just with writes.
+            etag += f"-t{int(now) // 15}"
+        cached = responses.not_modified(etag)
+        if cached is not None:
+            return cached
+        entry = responses.get(request.full_path, etag)
+        if entry is None:
+            try:
+                limit = page_limit(request.args, 1000, 5000)
+                sql, params = kiosk_page_query(request.args, limit, now, online_sec, stale_sec)
+            except ValueError as exc:
+                return jsonify({"error": str(exc)}), 400
+            version = feed.version
+            rows = db.read(sql, params)
+            kiosks = [dict(zip(KIOSK_FIELDS, r)) for r in rows[:limit]]
+            cursor = kiosks[-1]["kiosk_id"] if len(rows) > limit else None
+            entry = responses.put(
+                request.full_path, etag, kiosks, page_headers(version, "after", cursor)
+            )
+        return responses.respond(entry)
+
+    @app.get("/api/kiosks/<kiosk_id>")
+    def get_kiosk(kiosk_id):
+        etag = db.etag("kiosks")
+        cached = responses.not_modified(etag)
+        if cached is not None:
+            return cached
+        entry = responses.get(request.full_path, etag)
+        if entry is None:
+            version = feed.version
+            row = db.read_one(GET_KIOSK_SQL, (kiosk_id,))
+            if row is None:
+                return jsonify({"error": "not_found"}), 404
+            entry = responses.put(
+                request.full_path, etag, dict(zip(KIOSK_FIELDS, row)), {"X-Change-Version": str(version)}
+            )
+        return responses.respond(entry)
 
     @app.get("/api/kiosks/<kiosk_id>/history")
     def kiosk_history(kiosk_id):
-        conn = db_connect(db_path)
-        cur = conn.cursor()
-        cur.execute(
-            """
-            SELECT cmd_id, action, when_mode, status, started_at, finished_at, output
-            FROM commands WHERE kiosk_id=? ORDER BY rowid DESC LIMIT 50
-            """,
-            (kiosk_id,),
-        )
-        rows = cur.fetchall()
-        conn.close()
+        etag = db.etag("commands")
+        cached = responses.not_modified(etag)
+        if cached is not None:
+            return cached
+        entry = responses.get(request.full_path, etag)
+        if entry is not None:
+            return responses.respond(entry)
+        try:
+            limit = page_limit(request.args, 50, 500)
+            sql, params = history_page_query(kiosk_id, request.args, limit)
+        except ValueError as exc:
+            return jsonify({"error": str(exc)}), 400
+        version = feed.version
+        rows = db.read(sql, params)
         history = [
             {
-                "cmd_id": r[0],
-                "action": r[1],
-                "when": r[2],
-                "status": r[3],
-                "started_at": r[4],
-                "finished_at": r[5],
-                "output": r[6],
+                "cmd_id": r[1],
+                "action": r[2],
+                "when": r[3],
+                "status": r[4],
+                "started_at": r[5],
+                "finished_at": r[6],
+                "output_bytes": r[7],
+                "attempts": r[8],
+                "acked_at": r[9],
+            }
+            for r in rows[:limit]
+        ]
+        cursor = rows[limit - 1][0] if len(rows) > limit else None
+        entry = responses.put(
+            request.full_path, etag, history, page_headers(version, "before", cursor)
+        )
+        return responses.respond(entry)
+
+    @app.get("/api/kiosks/<kiosk_id>/metrics")
+    def kiosk_metrics(kiosk_id):
+        if metrics is None:
+            return jsonify({"error": "metrics_disabled"}), 404
+        now = int(time.time())
+        end = parse_ts(request.args.get("to"), default=now)
+        start = parse_ts(request.args.get("from"), default=end - 3600)
+        if start is None or end is None or start >= end:
+            return jsonify({"error": "invalid_range"}), 400
+        try:
+            step = int(request.args.get("step") or max((end - start) // 300, 60))
+        except ValueError:
+            return jsonify({"error": "invalid_step"}), 400
+        if step <= 0:
+            return jsonify({"error": "invalid_step"}), 400
+        result = metrics.query(kiosk_id, start, end, step)
+        result.update({"kiosk_id": kiosk_id, "from": start, "to": end})
+        return jsonify(result)
+
+    @app.get("/api/commands/<cmd_id>/progress")
+    def command_progress(cmd_id):
+        try:
+            after = int(request.args.get("after", 0))
+            limit = min(int(request.args.get("limit", 100)), 500)
+        except ValueError:
+            return jsonify({"error": "invalid_paging"}), 400
+        rows = db.read(COMMAND_PROGRESS_SQL, (cmd_id, after, limit))
+        status = db.read_one("SELECT status FROM commands WHERE cmd_id=?", (cmd_id,))
+        chunks = [
+            {
+                "seq": r[0],
+                "offset": r[1],
+                "data": r[2],
+                "dropped_bytes": r[3],
+                "done": bool(r[4]),
+                "ts": r[5],
             }
             for r in rows
         ]
-        return jsonify(history)
+        return jsonify(
+            {
+                "cmd_id": cmd_id,
+                "status": status[0] if status else None,
+                "last_seq": chunks[-1]["seq"] if chunks else after,
+                "chunks": chunks,
+            }
+        )
+
+    @app.get("/api/changes")
+    def list_changes():
+        try:
+            since = int(request.args.get("since", 0))
+            wait = min(float(request.args.get("wait", 0)), 30.0)
+        except ValueError:
+            return jsonify({"error": "invalid_since"}), 400
+        epoch = request.args.get("epoch") or None
+        if wait > 0:
+            events, reset = feed.wait(since, wait, epoch)
+        else:
+            events, reset = feed.since(since, epoch)
+        return jsonify({"epoch": feed.epoch, "version": feed.version, "reset": reset, "events": events})
+
+    @app.get("/api/changes/stream")
+    def stream_changes():
+        try:
+            epoch, since = parse_event_id(
+                request.headers.get("Last-Event-ID") or request.args.get("since") or feed.version
+            )
+        except ValueError:
+            return jsonify({"error": "invalid_since"}), 400
+        return Response(
+            stream_with_context(feed.stream(since, epoch=epoch or request.args.get("epoch") or None)),
+            content_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    @app.get("/api/commands/<cmd_id>/output")
+    def command_output(cmd_id):
+        stored = outputs.read(cmd_id)
+        if stored is None:
+            return jsonify({"error": "not_found"}), 404
+        text, size = stored
+        return jsonify({"cmd_id": cmd_id, "size": size, "output": text})
+
+    @app.get("/api/fleet/summary")
+    def fleet_summary():
+        # Served from memory; the sweeper bumps version as kiosks age out too.
+        summary = fleet.snapshot()
+        etag = f"{db.epoch}-fleet.{summary['version']}"
+        cached = responses.not_modified(etag)
+        if cached is not None:
+            return cached
+        resp = jsonify(summary)
+        resp.set_etag(etag, weak=True)
+        return resp
+
+    @app.get("/api/ingest/stats")
+    def ingest_stats():
+        data = ingestor.snapshot()
+        data["heartbeats"] = dict(merger.stats)
+        data["responses"] = responses.snapshot()
+        data["outputs"] = dict(outputs.stats)
+        data["delivery"] = tracker.snapshot()
+        data["pacing"] = pacer.snapshot()
+        return jsonify(data)
 
     @app.post("/api/command")
     def issue_command():
@@ -270,24 +1000,73 @@ def create_app():
             "when": when_mode,
             "args": args,
         }
-        insert_command(db_path, cmd_id, kiosk_id, action, when_mode, args)
-        info = mqtt_client.publish(
-            f"kiosk/{kiosk_id}/cmd", json.dumps(payload), qos=1
-        )
-        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+        insert_command(db, cmd_id, kiosk_id, action, when_mode, args)
+        feed.publish("command", command_change(cmd_id, kiosk_id, "queued", action=action, when=when_mode))
+        if not tracker.send(kiosk_id, payload):
+            now = utc_now_iso()
             update_command_result(
-                db_path,
+                db,
                 {
                     "cmd_id": cmd_id,
                     "status": "failed",
-                    "started_at": utc_now_iso(),
-                    "finished_at": utc_now_iso(),
-                    "output": f"publish_failed_rc_{info.rc}",
+                    "started_at": now,
+                    "finished_at": now,
+                    "output": "publish_failed",
                 },
             )
+            feed.publish(
+                "command", command_change(cmd_id, kiosk_id, "failed", started_at=now, finished_at=now)
+            )
             return jsonify({"error": "publish_failed", "cmd_id": cmd_id}), 502
         return jsonify({"cmd_id": cmd_id})
 
+    @app.post("/api/rollouts")
+    def create_rollout():
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({"error": "invalid_json"}), 400
+        selector = data.get("selector")
+        action = data.get("action")
+        when_mode = data.get("when", "immediate")
+        args = data.get("args", {})
+        if selector is None or not action:
+            return jsonify({"error": "selector and action are required"}), 400
+        if not isinstance(args, dict):
+            return jsonify({"error": "args must be an object"}), 400
+        if action not in ALLOWED_ACTIONS:
+            return jsonify({"error": "invalid_action"}), 400
+        if when_mode not in ALLOWED_WHEN:
+            return jsonify({"error": "invalid_when"}), 400
+        try:
+            max_in_flight = int(data.get("max_in_flight", rollout_cfg.get("max_in_flight", 50)))
+            wave_delay_sec = float(data.get("wave_delay_sec", rollout_cfg.get("wave_delay_sec", 30)))
+        except (TypeError, ValueError):
+            return jsonify({"error": "invalid_wave_settings"}), 400
+        try:
+            rollout = rollouts.create(
+                selector, action, when_mode, args, max_in_flight, wave_delay_sec
+            )
+        except ValueError as exc:
+            return jsonify({"error": str(exc)}), 400
+        return jsonify(rollout), 201
+
+    @app.get("/api/rollouts")
+    def list_rollouts():
+        return jsonify(rollouts.list())
+
+    @app.get("/api/rollouts/<rollout_id>")
+    def get_rollout(rollout_id):
+        rollout = rollouts.get(rollout_id)
+        if rollout is None:
+            return jsonify({"error": "not_found"}), 404
+        return jsonify(rollout)
+
+    @app.post("/api/rollouts/<rollout_id>/cancel")
+    def cancel_rollout(rollout_id):
+        if not rollouts.cancel(rollout_id):
+            return jsonify({"error": "not_active"}), 404
+        return jsonify(rollouts.get(rollout_id))
+
     return app, cfg
 
 
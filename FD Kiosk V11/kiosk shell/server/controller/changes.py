@@ -0,0 +1,82 @@
+import json
+import threading
+import uuid
+from collections import deque
+
+
+def parse_event_id(value):
+    """Split an "epoch:version" event id; a bare version has epoch None.
+
+    Raises ValueError if the version is not an integer.
+    """
+    epoch, sep, version = str(value).rpartition(":")
+    return (epoch if sep else None), int(version)
+
+
+class ChangeFeed:
+    """In-memory feed of kiosk and command changes with a monotonic version.
+
+    The newest max_events events are kept. A client that asks for changes
+    older than the buffer, or for a version from before a controller restart,
+    gets reset=True and must reload its snapshot. Versions restart at zero
+    with the process, so each process picks a random epoch; streams send it
+    in hello and in every event id, and a client presenting another epoch is
+    reset even if its version happens to still be in range.
+    """
+
+    def __init__(self, max_events=10000):
+        self.epoch = uuid.uuid4().hex[:12]
+        self.version = 0
+        self.events = deque(maxlen=max_events)
+        self.cond = threading.Condition()
+
+    def publish(self, kind, data):
+        return self.publish_many(kind, [data])
+
+    def publish_many(self, kind, items):
+        with self.cond:
+            for data in items:
+                self.version += 1
+                self.events.append({"version": self.version, "type": kind, "data": data})
+            self.cond.notify_all()
+            return self.version
+
+    def since(self, version, epoch=None):
+        """Return (events newer than version, reset flag)."""
+        with self.cond:
+            return self._since(version, epoch)
+
+    def _since(self, version, epoch=None):
+        if (epoch is not None and epoch != self.epoch) or version > self.version:
+            return [], True
+        if version == self.version:
+            return [], False
+        oldest = self.events[0]["version"] if self.events else self.version + 1
+        if version < oldest - 1:
+            return [], True
+        return [e for e in self.events if e["version"] > version], False
+
+    def wait(self, version, timeout, epoch=None):
+        with self.cond:
+            if epoch is None or epoch == self.epoch:
+                self.cond.wait_for(lambda: self.version != version, timeout)
+            return self._since(version, epoch)
+
+    def stream(self, version, keepalive_sec=15, epoch=None):
+        """Yield server-sent event frames starting after version."""
+        hello = {"version": self.version, "epoch": self.epoch}
+        yield f"retry: 3000\nevent: hello\ndata: {json.dumps(hello)}\n\n"
+        while True:
+            events, reset = self.wait(version, keepalive_sec, epoch)
+            epoch = self.epoch
+            if reset:
+                version = self.version
+                data = json.dumps({"version": version, "epoch": epoch})
+                yield f"id: {epoch}:{version}\nevent: reset\ndata: {data}\n\n"
+                continue
+            if not events:
+                yield ": keepalive\n\n"
+                continue
+            for event in events:
+                yield f"id: {epoch}:{event['version']}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n"
+            version = events[-1]["version"]
@@ -0,0 +1,120 @@
+import os
+import queue
+import sqlite3
+import threading
+import uuid
+from contextlib import contextmanager
+
+DEFAULT_PRAGMAS = {
+    "busy_timeout": 5000,
+    "synchronous": "NORMAL",
+    "mmap_size": 268435456,
+    "cache_size": -16384,
+    "temp_store": "MEMORY",
+}
+STATEMENT_CACHE_SIZE = 128
+
+
+class Database:
+    """Long-lived sqlite connections for the controller.
+
+    One writer connection is shared behind a lock; reads check out a
+    read-only connection from a small pool. Pragmas are applied once per
+    connection and sqlite's per-connection statement cache is sized so the
+    hot queries are prepared once and reused.
+
+    Writers bump a per-table change counter after commit; etag() turns the
+    counters into a validator that read endpoints can check without a query.
+    """
+
+    def __init__(self, db_path, pragmas=None, read_pool_size=4):
+        self.db_path = db_path
+        self.pragmas = dict(DEFAULT_PRAGMAS)
+        self.pragmas.update(pragmas or {})
+        self.write_lock = threading.RLock()
+        parent = os.path.dirname(db_path)
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+        self.writer = self._open(db_path)
+        self.writer.execute("PRAGMA journal_mode=WAL")
+        self.read_pool_size = max(int(read_pool_size), 1)
+        self.readers = queue.LifoQueue(maxsize=self.read_pool_size)
+        self.readers_opened = 0
+        self.readers_lock = threading.Lock()
+        # Random per process so validators from before a restart never match.
+        self.epoch = uuid.uuid4().hex[:8]
+        self.versions = {}
+        self.versions_lock = threading.Lock()
+
+    def _open(self, target, uri=False):
+        conn = sqlite3.connect(
+            target,
+            timeout=5,
+            uri=uri,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE,
+        )
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name}={value}")
+        return conn
+
+    def _open_reader(self):
+        return self._open(f"file:{self.db_path}?mode=ro", uri=True)
+
+    @contextmanager
+    def reader(self):
+        try:
+            conn = self.readers.get_nowait()
+        except queue.Empty:
+            conn = None
+            with self.readers_lock:
+                if self.readers_opened < self.read_pool_size:
+                    self.readers_opened += 1
+                    conn = self._open_reader()
+            if conn is None:
+                conn = self.readers.get()
+        try:
+            yield conn
+        finally:
+            self.readers.put(conn)
+
+    @contextmanager
+    def transaction(self):
+        with self.write_lock:
+            with self.writer:
+                yield self.writer
+
+    def read(self, sql, params=()):
+        with self.reader() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def read_one(self, sql, params=()):
+        with self.reader() as conn:
+            return conn.execute(sql, params).fetchone()
+
+    def write(self, sql, params=()):
+        with self.transaction() as conn:
+            return conn.execute(sql, params).rowcount
+
+    def write_many(self, sql, rows):
+        with self.transaction() as conn:
+            return conn.executemany(sql, rows).rowcount
+
+    def bump(self, *tables):
+        with self.versions_lock:
+            for table in tables:
+                self.versions[table] = self.versions.get(table, 0) + 1
+
+    def etag(self, *tables):
+        with self.versions_lock:
+            parts = [f"{table}.{self.versions.get(table, 0)}" for table in tables]
+        return "-".join([self.epoch] + parts)
+
+    def close(self):
+        while True:
+            try:
+                self.readers.get_nowait().close()
+            except queue.Empty:
+                break
+        with self.write_lock:
+            self.writer.close()
@@ -0,0 +1,322 @@
+import heapq
+import json
+import threading
+import time
+from datetime import datetime, timezone
+
+from metrics import parse_ts
+from outputs import UPSERT_OUTPUT_SQL, output_row
+
+OUTSTANDING_STATUSES = ("queued", "received", "running")
+
+MARK_SENT_SQL = "UPDATE commands SET attempts=?, sent_at=coalesce(sent_at, ?) WHERE cmd_id=?"
+
+# pending covers a rollout command acked before its wave is marked queued.
+MARK_RECEIVED_SQL = """
+    UPDATE commands SET status='received', acked_at=?
+    WHERE cmd_id=? AND status IN ('pending', 'queued')
+"""
+
+MARK_TIMEOUT_SQL = """
+    UPDATE commands SET status='timeout', finished_at=?
+    WHERE cmd_id=? AND status IN ('queued', 'received', 'running')
+"""
+
+OUTSTANDING_SQL = """
+    SELECT cmd_id, kiosk_id, action, when_mode, args_json, status, attempts, sent_at, acked_at, started_at,
+           created_at
+    FROM commands WHERE status IN ('queued', 'received', 'running')
+"""
+
+
+def utc_now_iso():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def mark_received(db, cmd_id, ts=None):
+    """Record the kiosk's acknowledgement; returns True if the command was still queued."""
+    changed = db.write(MARK_RECEIVED_SQL, (ts or utc_now_iso(), cmd_id)) > 0
+    if changed:
+        db.bump("commands")
+    return changed
+
+
+class DeliveryTracker:
+    """Outstanding commands and their redelivery / timeout deadlines.
+
+    send() publishes a command and indexes it by cmd_id and kiosk_id. Until
+    the kiosk replies `received`, the dispatcher republishes it with
+    exponential backoff (ack_timeout_sec doubling up to max_backoff_sec) for
+    at most max_attempts sends, and right away once a heartbeat shows the
+    kiosk is back. The broker queues QoS 1 commands for an offline kiosk's
+    persistent session, so timed copies past the cap would only fill that
+    queue. Commands never
+    acknowledged within expire_sec, or acknowledged but without a result
+    within run_timeout_sec (nightly_timeout_sec for nightly commands), are
+    marked `timeout` with the reason stored as their output. A min-heap holds
+    one deadline per command; superseded heap entries are skipped lazily.
+    """
+
+    def __init__(
+        self,
+        db,
+        publish,
+        ack_timeout_sec=30,
+        max_backoff_sec=600,
+        max_attempts=4,
+        expire_sec=86400,
+        run_timeout_sec=3600,
+        nightly_timeout_sec=2 * 86400,
+        tick_sec=1.0,
+        feed=None,
+        on_status_change=None,
+    ):
+        self.db = db
+        self.publish = publish
+        self.ack_timeout_sec = float(ack_timeout_sec)
+        self.max_backoff_sec = float(max_backoff_sec)
+        self.max_attempts = max(int(max_attempts), 1)
+        self.expire_sec = float(expire_sec)
+        self.run_timeout_sec = float(run_timeout_sec)
+        self.nightly_timeout_sec = float(nightly_timeout_sec)
+        self.tick_sec = tick_sec
+        self.feed = feed
+        self.on_status_change = on_status_change
+        self.lock = threading.Lock()
+        self.commands = {}
+        self.by_kiosk = {}
+        self.deadlines = []
+        self.stats = {"sent": 0, "redelivered": 0, "acknowledged": 0, "timed_out": 0}
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run_limit(self, entry):
+        return self.nightly_timeout_sec if entry["payload"]["when"] == "nightly" else self.run_timeout_sec
+
+    def _schedule(self, cmd_id, entry, deadline):
+        entry["deadline"] = deadline
+        heapq.heappush(self.deadlines, (deadline, cmd_id))
+
+    def _track(self, cmd_id, kiosk_id, payload, status, attempts, sent_at):
+        entry = {
+            "kiosk_id": kiosk_id,
+            "payload": payload,
+            "status": status,
+            "attempts": attempts,
+            "sent_at": sent_at,
+            "last_sent": sent_at,
+            "deadline": None,
+            "seen": False,
+        }
+        self.commands[cmd_id] = entry
+        self.by_kiosk.setdefault(kiosk_id, set()).add(cmd_id)
+        return entry
+
+    def _untrack(self, cmd_id):
+        entry = self.commands.pop(cmd_id, None)
+        if entry is None:
+            return None
+        cmd_ids = self.by_kiosk.get(entry["kiosk_id"])
+        if cmd_ids is not None:
+            cmd_ids.discard(cmd_id)
+            if not cmd_ids:
+                del self.by_kiosk[entry["kiosk_id"]]
+        return entry
+
+    def _backoff(self, attempts):
+        return min(self.ack_timeout_sec * (2 ** max(attempts - 1, 0)), self.max_backoff_sec)
+
+    def _next_send(self, entry, now):
+        """Next timed redelivery, or the expiry once max_attempts sends are out."""
+        if entry["attempts"] >= self.max_attempts:
+            return entry["sent_at"] + self.expire_sec
+        return now + self._backoff(entry["attempts"])
+
+    def send(self, kiosk_id, payload):
+        """Publish payload and track it until the kiosk acknowledges; returns publish success."""
+        cmd_id = payload["cmd_id"]
+        now = time.time()
+        # Track first so an ack racing the publish call finds its entry.
+        with self.lock:
+            entry = self._track(cmd_id, kiosk_id, payload, "queued", 1, now)
+            self._schedule(cmd_id, entry, now + self._backoff(1))
+        if not self.publish(kiosk_id, dict(payload, attempt=1)):
+            with self.lock:
+                self._untrack(cmd_id)
+            return False
+        self.db.write(MARK_SENT_SQL, (1, utc_now_iso(), cmd_id))
+        self.db.bump("commands")
+        with self.lock:
+            self.stats["sent"] += 1
+        return True
+
+    def load(self):
+        """Rebuild the index from commands still outstanding in sqlite."""
+        now = time.time()
+        rows = self.db.read(OUTSTANDING_SQL)
+        with self.lock:
+            for row in rows:
+                cmd_id, kiosk_id, action, when_mode, args_json, status, attempts, sent_at = row[:8]
+                acked_at, started_at, created_at = row[8:]
+                payload = {
+                    "cmd_id": cmd_id,
+                    "action": action,
+                    "when": when_mode,
+                    "args": json.loads(args_json or "{}"),
+                }
+                sent = parse_ts(sent_at)
+                if status == "queued" and sent is not None:
+                    entry = self._track(cmd_id, kiosk_id, payload, status, attempts or 1, sent)
+                    self._schedule(cmd_id, entry, now + self.ack_timeout_sec)
+                    continue
+                entry = self._track(cmd_id, kiosk_id, payload, status, attempts or 0, sent)
+                if status == "queued":
+                    # Queued before delivery was tracked (sent_at is NULL): never
+                    # redeliver what cannot be dated, only let it expire.
+                    self._schedule(cmd_id, entry, parse_ts(created_at, default=now) + self.expire_sec)
+                    continue
+                since = parse_ts(started_at if status == "running" else acked_at, default=now)
+                self._schedule(cmd_id, entry, since + self._run_limit(entry))
+        return len(rows)
+
+    def on_command_status(self, cmd_id, status):
+        """Record a status reported by the kiosk (ack, progress or result)."""
+        now = time.time()
+        with self.lock:
+            entry = self.commands.get(cmd_id)
+            if entry is None or entry["status"] == status:
+                return
+            if status == "received":
+                if entry["status"] != "queued":
+                    return
+                self.stats["acknowledged"] += 1
+                entry["status"] = status
+                self._schedule(cmd_id, entry, now + self._run_limit(entry))
+            elif status == "running":
+                entry["status"] = status
+                self._schedule(cmd_id, entry, now + self._run_limit(entry))
+            else:
+                self._untrack(cmd_id)
+
+    def kiosk_seen(self, kiosk_id):
+        """Redeliver unacknowledged commands as soon as their kiosk reports again."""
+        with self.lock:
+            cmd_ids = self.by_kiosk.get(kiosk_id)
+            if not cmd_ids:
+                return
+            now = time.time()
+            due = False
+            for cmd_id in cmd_ids:
+                entry = self.commands[cmd_id]
+                # Skip sends younger than one ack window; they are still in flight.
+                if (
+                    entry["status"] == "queued"
+                    and entry["last_sent"] is not None
+                    and now - entry["last_sent"] >= self.ack_timeout_sec
+                    and entry["deadline"] > now
+                ):
+                    entry["seen"] = True
+                    self._schedule(cmd_id, entry, now)
+                    due = True
+        if due:
+            self._wake.set()
+
+    def start(self):
+        self.load()
+        self._thread = threading.Thread(target=self._run, name="delivery", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.tick_sec)
+            self._wake.clear()
+            try:
+                self.tick()
+            except Exception as exc:
+                print(f"Command delivery tick failed: {exc}")
+
+    def tick(self, now=None):
+        now = time.time() if now is None else now
+        redeliver, expired = [], []
+        with self.lock:
+            while self.deadlines and self.deadlines[0][0] <= now:
+                deadline, cmd_id = heapq.heappop(self.deadlines)
+                entry = self.commands.get(cmd_id)
+                if entry is None or entry["deadline"] != deadline:
+                    continue
+                if entry["status"] == "queued" and entry["sent_at"] is None:
+                    reason = "never delivered (queued before delivery tracking)"
+                    expired.append((cmd_id, self._untrack(cmd_id), reason))
+                elif entry["status"] != "queued":
+                    reason = f"no result within {int(self._run_limit(entry))}s of acknowledgement"
+                    expired.append((cmd_id, self._untrack(cmd_id), reason))
+                elif now - entry["sent_at"] >= self.expire_sec:
+                    reason = f"not acknowledged after {entry['attempts']} deliveries"
+                    expired.append((cmd_id, self._untrack(cmd_id), reason))
+                elif entry["attempts"] < self.max_attempts or entry["seen"]:
+                    entry["seen"] = False
+                    redeliver.append((cmd_id, entry))
+                else:
+                    # Out of timed sends: wait for a heartbeat or the expiry.
+                    self._schedule(cmd_id, entry, entry["sent_at"] + self.expire_sec)
+
+        sent = []
+        for cmd_id, entry in redeliver:
+            attempt = entry["attempts"] + 1
+            ok = self.publish(entry["kiosk_id"], dict(entry["payload"], attempt=attempt))
+            with self.lock:
+                if self.commands.get(cmd_id) is not entry or entry["status"] != "queued":
+                    continue
+                if ok:
+                    entry["attempts"] = attempt
+                    entry["last_sent"] = now
+                    sent.append((attempt, cmd_id))
+                # A failed publish (broker down) is retried without counting it.
+                self._schedule(cmd_id, entry, self._next_send(entry, now))
+        if sent:
+            self.db.write_many(MARK_SENT_SQL, [(attempt, None, cmd_id) for attempt, cmd_id in sent])
+            self.db.bump("commands")
+            with self.lock:
+                self.stats["redelivered"] += len(sent)
+        if expired:
+            self._expire(expired)
+
+    def _expire(self, expired):
+        finished_at = utc_now_iso()
+        timed_out = []
+        with self.db.transaction() as conn:
+            for cmd_id, entry, reason in expired:
+                if conn.execute(MARK_TIMEOUT_SQL, (finished_at, cmd_id)).rowcount:
+                    conn.execute(UPSERT_OUTPUT_SQL, output_row(cmd_id, f"timeout: {reason}"))
+                    timed_out.append((cmd_id, entry))
+        if not timed_out:
+            return
+        self.db.bump("commands")
+        with self.lock:
+            self.stats["timed_out"] += len(timed_out)
+        for cmd_id, _ in timed_out:
+            if self.on_status_change is not None:
+                self.on_status_change(cmd_id, "timeout")
+        if self.feed is not None:
+            self.feed.publish_many(
+                "command",
+                [
+                    {"cmd_id": cmd_id, "kiosk_id": entry["kiosk_id"], "status": "timeout", "finished_at": finished_at}
+                    for cmd_id, entry in timed_out
+                ],
+            )
+
+    def snapshot(self):
+        with self.lock:
+            data = dict(self.stats)
+            data["outstanding"] = {status: 0 for status in OUTSTANDING_STATUSES}
+            for entry in self.commands.values():
+                data["outstanding"][entry["status"]] += 1
+        return data
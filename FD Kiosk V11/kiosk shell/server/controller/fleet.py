@@ -0,0 +1,178 @@
+import heapq
+import json
+import threading
+import time
+from collections import Counter
+
+from metrics import parse_ts
+from queries import DEFAULT_ONLINE_SEC, DEFAULT_STALE_SEC
+
+BUCKETS = ("online", "stale", "offline")
+GROUPS = ("location", "git_sha", "os_version")
+
+
+class FleetSummary:
+    """Fleet-wide counts kept up to date as heartbeats are written.
+
+    Each kiosk contributes to one status bucket, to its location / git_sha /
+    os_version groups and to the count of every service it reports as
+    failed. update() adjusts only the counters the heartbeat changed. A
+    min-heap holds one bucket deadline per kiosk (online -> stale ->
+    offline); the sweeper pops only due deadlines and re-arms those whose
+    kiosk has reported since, so heartbeats never touch the heap.
+    snapshot() returns a dict rebuilt only after something changed.
+    """
+
+    def __init__(self, online_sec=DEFAULT_ONLINE_SEC, stale_sec=DEFAULT_STALE_SEC, sweep_sec=5):
+        self.online_sec = online_sec
+        self.stale_sec = stale_sec
+        self.sweep_sec = sweep_sec
+        self.lock = threading.Lock()
+        self.kiosks = {}
+        self.buckets = Counter()
+        self.groups = {name: Counter() for name in GROUPS}
+        self.failed_services = Counter()
+        self.kiosks_with_failures = 0
+        self.deadlines = []
+        self.version = 0
+        self._snapshot = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def bucket(self, last_seen, now):
+        if last_seen is None:
+            return "offline"
+        age = now - last_seen
+        if age <= self.online_sec:
+            return "online"
+        if age <= self.stale_sec:
+            return "stale"
+        return "offline"
+
+    def _arm(self, kiosk_id, entry):
+        if entry["bucket"] == "online":
+            entry["due"] = entry["last_seen"] + self.online_sec
+        elif entry["bucket"] == "stale":
+            entry["due"] = entry["last_seen"] + self.stale_sec
+        else:
+            entry["due"] = None
+            return
+        heapq.heappush(self.deadlines, (entry["due"], kiosk_id))
+
+    def _apply(self, entry, delta):
+        self.buckets[entry["bucket"]] += delta
+        for name in GROUPS:
+            self.groups[name][entry[name]] += delta
+        for service in entry["failed"]:
+            self.failed_services[service] += delta
+        if entry["failed"]:
+            self.kiosks_with_failures += delta
+
+    def update(self, payload, now=None):
+        self.update_many([payload], now)
+
+    def update_many(self, payloads, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            for payload in payloads:
+                kiosk_id = payload.get("kiosk_id")
+                services = payload.get("services") or {}
+                if isinstance(services, str):
+                    services = json.loads(services or "{}")
+                last_seen = parse_ts(payload.get("last_seen"))
+                entry = {
+                    "last_seen": last_seen,
+                    "bucket": self.bucket(last_seen, now),
+                    "location": payload.get("location"),
+                    "git_sha": payload.get("git_sha"),
+                    "os_version": payload.get("os_version"),
+                    "failed": frozenset(k for k, v in services.items() if v == "failed"),
+                    "due": None,
+                }
+                previous = self.kiosks.get(kiosk_id)
+                if previous is not None and all(
+                    previous[k] == entry[k] for k in ("bucket", "failed") + GROUPS
+                ):
+                    # Same counters; the sweeper re-arms from the new last_seen.
+                    previous["last_seen"] = last_seen
+                    continue
+                if previous is not None:
+                    self._apply(previous, -1)
+                self.kiosks[kiosk_id] = entry
+                self._apply(entry, 1)
+                self._arm(kiosk_id, entry)
+                self._changed()
+
+    def load(self, db):
+        rows = db.read(
+            "SELECT kiosk_id, location, last_seen, git_sha, os_version, services_json FROM kiosks"
+        )
+        self.update_many(
+            {
+                "kiosk_id": r[0],
+                "location": r[1],
+                "last_seen": r[2],
+                "git_sha": r[3],
+                "os_version": r[4],
+                "services": r[5],
+            }
+            for r in rows
+        )
+
+    def sweep(self, now=None):
+        """Move kiosks whose bucket deadline has passed; returns how many moved."""
+        now = time.time() if now is None else now
+        moved = 0
+        with self.lock:
+            while self.deadlines and self.deadlines[0][0] < now:
+                due, kiosk_id = heapq.heappop(self.deadlines)
+                entry = self.kiosks.get(kiosk_id)
+                if entry is None or entry["due"] != due:
+                    continue
+                bucket = self.bucket(entry["last_seen"], now)
+                if bucket != entry["bucket"]:
+                    self.buckets[entry["bucket"]] -= 1
+                    self.buckets[bucket] += 1
+                    entry["bucket"] = bucket
+                    moved += 1
+                self._arm(kiosk_id, entry)
+            if moved:
+                self._changed()
+        return moved
+
+    def _changed(self):
+        self.version += 1
+        self._snapshot = None
+
+    def snapshot(self):
+        with self.lock:
+            if self._snapshot is None:
+                self._snapshot = {
+                    "version": self.version,
+                    "total": len(self.kiosks),
+                    "status": {name: self.buckets[name] for name in BUCKETS},
+                    "by_location": _counts(self.groups["location"]),
+                    "by_git_sha": _counts(self.groups["git_sha"]),
+                    "by_os_version": _counts(self.groups["os_version"]),
+                    "failed_services": _counts(self.failed_services),
+                    "kiosks_with_failures": self.kiosks_with_failures,
+                    "thresholds": {"online_sec": self.online_sec, "stale_sec": self.stale_sec},
+                }
+            return self._snapshot
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="fleet-sweeper", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.wait(self.sweep_sec):
+            self.sweep()
+
+
+def _counts(counter):
+    return {str(key) if key is not None else "unknown": n for key, n in counter.most_common() if n > 0}
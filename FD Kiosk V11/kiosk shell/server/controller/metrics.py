@@ -0,0 +1,250 @@
+import calendar
+import time
+
+METRICS = (
+    "load_1m",
+    "mem_used_pct",
+    "disk_used_pct",
+    "disk_read_bytes",
+    "disk_write_bytes",
+    "uptime_sec",
+)
+# Cumulative counters: a bucket's max is its latest value; an average is meaningless.
+COUNTERS = frozenset(("disk_read_bytes", "disk_write_bytes", "uptime_sec"))
+RAW_TABLE = "kiosk_metrics_raw"
+# (step seconds, table) from finest to coarsest rollup tier.
+ROLLUP_TIERS = (
+    (60, "kiosk_metrics_1m"),
+    (3600, "kiosk_metrics_1h"),
+)
+DEFAULT_RETENTION_SEC = {
+    RAW_TABLE: 6 * 3600,
+    "kiosk_metrics_1m": 14 * 86400,
+    "kiosk_metrics_1h": 400 * 86400,
+}
+
+INSERT_RAW_SQL = (
+    f"INSERT INTO {RAW_TABLE} (kiosk_id, ts, {', '.join(METRICS)}) "
+    f"VALUES (?, ?, {', '.join('?' for _ in METRICS)})"
+)
+
+
+def _rollup_upsert_sql(table):
+    columns = ["kiosk_id", "bucket", "samples"]
+    updates = ["samples=samples+excluded.samples"]
+    for name in METRICS:
+        columns += [f"{name}_sum", f"{name}_min", f"{name}_max"]
+        # coalesce() keeps an aggregate when either side is NULL (metric missing).
+        updates += [
+            f"{name}_sum=coalesce({name}_sum+excluded.{name}_sum, {name}_sum, excluded.{name}_sum)",
+            f"{name}_min=coalesce(min({name}_min, excluded.{name}_min), {name}_min, excluded.{name}_min)",
+            f"{name}_max=coalesce(max({name}_max, excluded.{name}_max), {name}_max, excluded.{name}_max)",
+        ]
+    return (
+        f"INSERT INTO {table} ({', '.join(columns)}) "
+        f"VALUES ({', '.join('?' for _ in columns)}) "
+        f"ON CONFLICT(kiosk_id, bucket) DO UPDATE SET {', '.join(updates)}"
+    )
+
+
+ROLLUP_UPSERT_SQL = {table: _rollup_upsert_sql(table) for _, table in ROLLUP_TIERS}
+
+
+def parse_ts(value, default=None):
+    """Accept epoch seconds or the ISO-8601 UTC format used in payloads."""
+    if value in (None, ""):
+        return default
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        return calendar.timegm(time.strptime(str(value), "%Y-%m-%dT%H:%M:%SZ"))
+    except ValueError:
+        return default
+
+
+def _pct(used, total):
+    try:
+        total = float(total)
+        return round(float(used) * 100.0 / total, 2) if total > 0 else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _num(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def point_from_heartbeat(payload):
+    """Return a raw metrics row for a heartbeat, or None if it carries no telemetry."""
+    disk = payload.get("disk") or {}
+    disk_io = payload.get("disk_io") or {}
+    memory = payload.get("memory") or {}
+    load_avg = payload.get("load_avg") or {}
+    values = (
+        _num(load_avg.get("1m")),
+        _pct(memory.get("used_bytes"), memory.get("total_bytes")),
+        _pct(disk.get("used_bytes"), disk.get("total_bytes")),
+        _num(disk_io.get("read_bytes")),
+        _num(disk_io.get("write_bytes")),
+        _num(payload.get("uptime_sec")),
+    )
+    if all(v is None for v in values):
+        return None
+    ts = parse_ts(payload.get("last_seen"), default=int(time.time()))
+    return (payload.get("kiosk_id"), ts) + values
+
+
+def init_metrics_schema(conn):
+    metric_cols = ", ".join(f"{name} REAL" for name in METRICS)
+    conn.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {RAW_TABLE} (
+            kiosk_id TEXT NOT NULL,
+            ts INTEGER NOT NULL,
+            {metric_cols}
+        )
+        """
+    )
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{RAW_TABLE}_kiosk_ts ON {RAW_TABLE} (kiosk_id, ts)")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{RAW_TABLE}_ts ON {RAW_TABLE} (ts)")
+    agg_cols = ", ".join(
+        f"{name}_sum REAL, {name}_min REAL, {name}_max REAL" for name in METRICS
+    )
+    for _, table in ROLLUP_TIERS:
+        conn.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                kiosk_id TEXT NOT NULL,
+                bucket INTEGER NOT NULL,
+                samples INTEGER NOT NULL,
+                {agg_cols},
+                UNIQUE (kiosk_id, bucket)
+            )
+            """
+        )
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_bucket ON {table} (bucket)")
+
+
+def _rollup_row(point, step):
+    kiosk_id, ts = point[0], point[1]
+    row = [kiosk_id, ts - ts % step, 1]
+    for value in point[2:]:
+        row += [value, value, value]
+    return row
+
+
+class MetricsStore:
+    """Raw heartbeat telemetry plus 1-minute and 1-hour rollups.
+
+    Rollups are updated in the same transaction as the raw insert, so reads
+    at coarse steps never touch raw rows. Retention deletes old rows in
+    small chunks so the writer lock is only held briefly.
+    """
+
+    def __init__(self, db, retention_sec=None, prune_interval_sec=300, prune_batch=5000):
+        self.db = db
+        self.retention_sec = dict(DEFAULT_RETENTION_SEC)
+        self.retention_sec.update(retention_sec or {})
+        self.prune_interval_sec = float(prune_interval_sec)
+        self.prune_batch = max(int(prune_batch), 1)
+        self.last_prune = 0.0
+        self.pruned = 0
+
+    def write(self, conn, points):
+        """Insert points using an open writer transaction."""
+        if not points:
+            return
+        conn.executemany(INSERT_RAW_SQL, points)
+        for step, table in ROLLUP_TIERS:
+            conn.executemany(ROLLUP_UPSERT_SQL[table], [_rollup_row(p, step) for p in points])
+
+    def record(self, points):
+        with self.db.transaction() as conn:
+            self.write(conn, points)
+
+    def maybe_prune(self, now=None):
+        now = time.time() if now is None else now
+        if now - self.last_prune < self.prune_interval_sec:
+            return 0
+        self.last_prune = now
+        return self.prune(now)
+
+    def prune(self, now=None):
+        now = time.time() if now is None else now
+        total = 0
+        tables = [(RAW_TABLE, "ts")] + [(table, "bucket") for _, table in ROLLUP_TIERS]
+        for table, column in tables:
+            cutoff = int(now - self.retention_sec[table])
+            while True:
+                with self.db.transaction() as conn:
+                    deleted = conn.execute(
+                        f"DELETE FROM {table} WHERE rowid IN "
+                        f"(SELECT rowid FROM {table} WHERE {column} < ? LIMIT ?)",
+                        (cutoff, self.prune_batch),
+                    ).rowcount
+                total += deleted
+                if deleted < self.prune_batch:
+                    break
+        self.pruned += total
+        return total
+
+    def pick_tier(self, start, step, now=None):
+        """Return (tier_step, table) for the coarsest tier that satisfies step and retention."""
+        now = time.time() if now is None else now
+        candidates = [(1, RAW_TABLE)] + list(ROLLUP_TIERS)
+        chosen = candidates[-1]
+        for tier_step, table in candidates:
+            if tier_step > step:
+                break
+            chosen = (tier_step, table)
+        idx = candidates.index(chosen)
+        # Move to a coarser tier if the finer one has already been pruned.
+        while idx < len(candidates) - 1 and start < now - self.retention_sec[candidates[idx][1]]:
+            idx += 1
+        return candidates[idx]
+
+    def query(self, kiosk_id, start, end, step):
+        tier_step, table = self.pick_tier(start, step)
+        step = max(int(step), tier_step)
+        if table == RAW_TABLE:
+            ts_col = "ts"
+            selects = ", ".join(
+                f"sum({name}), min({name}), max({name}), count({name})" for name in METRICS
+            )
+            samples = "count(*)"
+        else:
+            ts_col = "bucket"
+            selects = ", ".join(
+                f"sum({name}_sum), min({name}_min), max({name}_max), "
+                f"sum(CASE WHEN {name}_sum IS NULL THEN 0 ELSE samples END)"
+                for name in METRICS
+            )
+            samples = "sum(samples)"
+        rows = self.db.read(
+            f"""
+            SELECT ({ts_col} / ?) * ? AS slot, {samples}, {selects}
+            FROM {table}
+            WHERE kiosk_id=? AND {ts_col} >= ? AND {ts_col} < ?
+            GROUP BY slot ORDER BY slot
+            """,
+            (step, step, kiosk_id, start - start % tier_step, end),
+        )
+        points = []
+        for row in rows:
+            point = {"ts": row[0], "samples": row[1]}
+            for i, name in enumerate(METRICS):
+                total, low, high, count = row[2 + i * 4: 6 + i * 4]
+                if not count:
+                    point[name] = None
+                    continue
+                if name in COUNTERS:
+                    point[name] = {"last": high, "min": low, "max": high}
+                else:
+                    point[name] = {"avg": round(total / count, 3), "min": low, "max": high}
+            points.append(point)
+        return {"tier": table, "step": step, "points": points}
@@ -0,0 +1,144 @@
+import time
+import zlib
+
+UPSERT_OUTPUT_SQL = """
+    INSERT OR REPLACE INTO command_output (cmd_id, created_at, codec, size, stored_size, data)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+GET_OUTPUT_SQL = "SELECT codec, size, data FROM command_output WHERE cmd_id=?"
+
+
+def init_output_schema(conn):
+    # data is the last column so metadata reads never load overflow pages.
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS command_output (
+            cmd_id TEXT PRIMARY KEY,
+            created_at INTEGER NOT NULL,
+            codec TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            stored_size INTEGER NOT NULL,
+            data BLOB
+        )
+        """
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_command_output_created ON command_output (created_at, stored_size)"
+    )
+
+
+def output_row(cmd_id, text, level=6, now=None):
+    """Return an UPSERT_OUTPUT_SQL row; text is stored raw when zlib does not help."""
+    raw = (text or "").encode("utf-8")
+    packed = zlib.compress(raw, level)
+    codec, data = ("zlib", packed) if len(packed) < len(raw) else ("raw", raw)
+    return (cmd_id, int(time.time() if now is None else now), codec, len(raw), len(data), data)
+
+
+def decode_output(codec, data):
+    if codec == "zlib":
+        data = zlib.decompress(data)
+    return bytes(data).decode("utf-8", errors="replace")
+
+
+class OutputStore:
+    """Compressed command output, kept apart from the command metadata rows.
+
+    Retention runs from the heartbeat writer thread: rows older than
+    max_age_sec go first, then the oldest rows until the stored total fits
+    max_total_bytes. Every delete is a separate prune_batch-sized
+    transaction so the writer lock is only held briefly. Live progress
+    chunks older than max_age_sec are pruned the same way.
+    """
+
+    def __init__(
+        self,
+        db,
+        max_age_sec=90 * 86400,
+        max_total_bytes=1024 * 1024 * 1024,
+        prune_interval_sec=300,
+        prune_batch=2000,
+        level=6,
+    ):
+        self.db = db
+        self.max_age_sec = int(max_age_sec)
+        self.max_total_bytes = int(max_total_bytes)
+        self.prune_interval_sec = float(prune_interval_sec)
+        self.prune_batch = max(int(prune_batch), 1)
+        self.level = int(level)
+        self.last_prune = 0.0
+        self.stats = {"pruned_outputs": 0, "pruned_progress": 0, "stored_bytes": None}
+
+    def row(self, cmd_id, text):
+        return output_row(cmd_id, text, self.level)
+
+    def read(self, cmd_id):
+        """Return (text, size) or None when no output was stored."""
+        row = self.db.read_one(GET_OUTPUT_SQL, (cmd_id,))
+        if row is None:
+            return None
+        return decode_output(row[0], row[2]), row[1]
+
+    def maybe_prune(self, now=None):
+        now = time.time() if now is None else now
+        if now - self.last_prune < self.prune_interval_sec:
+            return 0
+        self.last_prune = now
+        return self.prune(now)
+
+    def prune(self, now=None):
+        now = time.time() if now is None else now
+        cutoff = int(now - self.max_age_sec)
+        pruned = 0
+        while True:
+            with self.db.transaction() as conn:
+                deleted = conn.execute(
+                    "DELETE FROM command_output WHERE rowid IN "
+                    "(SELECT rowid FROM command_output WHERE created_at < ? ORDER BY created_at LIMIT ?)",
+                    (cutoff, self.prune_batch),
+                ).rowcount
+            pruned += deleted
+            if deleted < self.prune_batch:
+                break
+
+        total = self.db.read_one("SELECT coalesce(sum(stored_size), 0) FROM command_output")[0]
+        while total > self.max_total_bytes:
+            # Walk the oldest rows until enough bytes are covered, capped at one batch.
+            rows = self.db.read(
+                "SELECT rowid, stored_size FROM command_output ORDER BY created_at LIMIT ?",
+                (self.prune_batch,),
+            )
+            if not rows:
+                break
+            excess, victims = total - self.max_total_bytes, []
+            for rowid, stored_size in rows:
+                victims.append(rowid)
+                excess -= stored_size
+                if excess <= 0:
+                    break
+            with self.db.transaction() as conn:
+                conn.execute(
+                    f"DELETE FROM command_output WHERE rowid IN ({', '.join('?' for _ in victims)})",
+                    victims,
+                )
+            pruned += len(victims)
+            total = self.db.read_one("SELECT coalesce(sum(stored_size), 0) FROM command_output")[0]
+
+        progress_cutoff = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(cutoff))
+        progress_pruned = 0
+        while True:
+            with self.db.transaction() as conn:
+                deleted = conn.execute(
+                    "DELETE FROM command_progress WHERE rowid IN "
+                    "(SELECT rowid FROM command_progress WHERE ts < ? LIMIT ?)",
+                    (progress_cutoff, self.prune_batch),
+                ).rowcount
+            progress_pruned += deleted
+            if deleted < self.prune_batch:
+                break
+
+        self.stats["pruned_outputs"] += pruned
+        self.stats["pruned_progress"] += progress_pruned
+        self.stats["stored_bytes"] = total
+        return pruned + progress_pruned
@@ -0,0 +1,121 @@
+import json
+import math
+import threading
+import time
+from datetime import datetime, timezone
+
+RATE_HINT_TOPIC = "kiosk/fleet/heartbeat_rate"
+
+
+def utc_now_iso():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class HeartbeatPacer:
+    """Throttles fleet heartbeats through a retained rate hint.
+
+    maybe_update() runs between ingest flushes and compares the observed
+    heartbeat rate, ingest queue backlog and drops with max_per_sec /
+    queue_high_water. When overloaded it publishes (retained) a
+    min_interval_sec that agents apply as a floor: at least
+    fleet size / max_per_sec, doubling while the overload lasts (at most
+    once per current floor, so agents get one interval to adopt it), capped
+    at max_interval_sec. After release_after_sec without overload the floor
+    is halved again, and the hint is cleared (empty retained message) once
+    it would drop below release_below_sec.
+    """
+
+    def __init__(
+        self,
+        publish,
+        stats,
+        fleet_size,
+        max_per_sec=200,
+        queue_high_water=0.5,
+        max_interval_sec=120,
+        release_after_sec=300,
+        release_below_sec=10,
+        eval_sec=10,
+    ):
+        self.publish = publish
+        self.stats = stats
+        self.fleet_size = fleet_size
+        self.max_per_sec = max(float(max_per_sec), 0.001)
+        self.queue_high_water = float(queue_high_water)
+        self.max_interval_sec = int(max_interval_sec)
+        self.release_after_sec = float(release_after_sec)
+        self.release_below_sec = float(release_below_sec)
+        self.eval_sec = float(eval_sec)
+        self.lock = threading.Lock()
+        self.min_interval_sec = None
+        self.reason = None
+        self.changed_at = None
+        self.calm_since = None
+        self.last = None
+        self.state = {"rate_per_sec": 0.0, "backlog": 0.0, "dropped": 0, "overloaded": False, "published": 0}
+
+    def maybe_update(self, now=None):
+        now = time.time() if now is None else now
+        if self.last is not None and now - self.last[0] < self.eval_sec:
+            return
+        self.update(self.stats(), self.fleet_size(), now)
+
+    def update(self, stats, fleet_size, now=None):
+        """Re-evaluate the hint from ingestor stats; returns the current floor."""
+        now = time.time() if now is None else now
+        previous, self.last = self.last, (now, stats["received"], stats["dropped"])
+        if previous is None:
+            return self.min_interval_sec
+        elapsed = max(now - previous[0], 0.001)
+        rate = (stats["received"] - previous[1]) / elapsed
+        dropped = stats["dropped"] - previous[2]
+        backlog = stats["queue_depth"] / max(stats["queue_size"], 1)
+        overloaded = dropped > 0 or backlog >= self.queue_high_water or rate > self.max_per_sec
+        # The floor that keeps the whole fleet under max_per_sec.
+        sustainable = math.ceil(fleet_size / self.max_per_sec)
+        floor = self.min_interval_sec
+        if overloaded:
+            self.calm_since = None
+            if floor is None or now - self.changed_at >= floor:
+                floor = min(max((floor or 0) * 2, sustainable, 1), self.max_interval_sec)
+        elif floor is not None:
+            if self.calm_since is None:
+                self.calm_since = now
+            elif now - self.calm_since >= self.release_after_sec:
+                self.calm_since = now
+                halved = floor / 2
+                floor = None if halved < self.release_below_sec else max(math.ceil(halved), sustainable)
+        with self.lock:
+            self.state.update(
+                rate_per_sec=round(rate, 2),
+                backlog=round(backlog, 3),
+                dropped=dropped,
+                overloaded=overloaded,
+            )
+        if floor != self.min_interval_sec:
+            self.min_interval_sec = floor
+            self.changed_at = now
+            self.reason = "ingest_overload" if overloaded else "recovering"
+            self.republish()
+        return floor
+
+    def republish(self):
+        """Publish the current hint, or clear a stale retained one (on connect)."""
+        if self.min_interval_sec is None:
+            payload = ""
+        else:
+            payload = json.dumps(
+                {"min_interval_sec": self.min_interval_sec, "reason": self.reason, "ts": utc_now_iso()}
+            )
+        ok = self.publish(RATE_HINT_TOPIC, payload)
+        with self.lock:
+            if ok:
+                self.state["published"] += 1
+        return ok
+
+    def snapshot(self):
+        with self.lock:
+            data = dict(self.state)
+        data["min_interval_sec"] = self.min_interval_sec
+        data["max_per_sec"] = self.max_per_sec
+        return data
@@ -0,0 +1,125 @@
+import time
+
+KIOSK_STATES = ("online", "stale", "offline")
+KIOSK_EXACT_FILTERS = ("location", "git_sha", "os_version")
+DEFAULT_ONLINE_SEC = 5 * 60
+DEFAULT_STALE_SEC = 30 * 60
+
+KIOSK_PAGE_SQL = """
+    SELECT kiosk_id, location, last_seen, ip, os_version, git_sha
+    FROM kiosks {where} ORDER BY kiosk_id LIMIT ?
+"""
+
+# Metadata only; output bodies live in command_output and are fetched per command.
+HISTORY_PAGE_SQL = """
+    SELECT c.rowid, c.cmd_id, c.action, c.when_mode, c.status, c.started_at, c.finished_at, o.size,
+           c.attempts, c.acked_at
+    FROM commands c LEFT JOIN command_output o ON o.cmd_id = c.cmd_id
+    {where} ORDER BY c.rowid DESC LIMIT ?
+"""
+
+
+def iso_at(ts):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(ts))
+
+
+def prefix_bounds(prefix):
+    """[low, high) range of strings starting with prefix under BINARY collation.
+
+    LIKE cannot use a BINARY index unless case_sensitive_like is on, while a
+    range always can. high is None when no string sorts after the prefix.
+    """
+    high = prefix
+    while high and high[-1] == chr(0x10FFFF):
+        high = high[:-1]
+    if not high:
+        return prefix, None
+    return prefix, high[:-1] + chr(ord(high[-1]) + 1)
+
+
+def prefix_clause(column, prefix):
+    low, high = prefix_bounds(prefix)
+    if high is None:
+        return f"{column} >= ?", [low]
+    return f"{column} >= ? AND {column} < ?", [low, high]
+
+
+def page_limit(args, default, maximum):
+    raw = args.get("limit")
+    try:
+        limit = int(raw) if raw not in (None, "") else default
+    except ValueError:
+        raise ValueError("invalid_limit") from None
+    if limit <= 0:
+        raise ValueError("invalid_limit")
+    return min(limit, maximum)
+
+
+def state_clause(state, now, online_sec=DEFAULT_ONLINE_SEC, stale_sec=DEFAULT_STALE_SEC):
+    """SQL for one online/stale/offline bucket; last_seen is ISO-8601 UTC text,
+    so lexical comparison matches time order."""
+    online_cutoff = iso_at(now - online_sec)
+    stale_cutoff = iso_at(now - stale_sec)
+    if state == "online":
+        return "last_seen >= ?", [online_cutoff]
+    if state == "stale":
+        return "last_seen >= ? AND last_seen < ?", [stale_cutoff, online_cutoff]
+    if state == "offline":
+        return "(last_seen IS NULL OR last_seen < ?)", [stale_cutoff]
+    raise ValueError("invalid_state")
+
+
+def kiosk_page_query(args, limit, now=None, online_sec=DEFAULT_ONLINE_SEC, stale_sec=DEFAULT_STALE_SEC):
+    """Build a keyset page over kiosks ordered by kiosk_id.
+
+    args may carry location, location_prefix, git_sha, os_version, state and
+    after (the last kiosk_id of the previous page). One extra row is fetched
+    so the caller can tell whether another page exists.
+    """
+    now = time.time() if now is None else now
+    clauses, params = [], []
+    for name in KIOSK_EXACT_FILTERS:
+        value = args.get(name)
+        if value:
+            clauses.append(f"{name} = ?")
+            params.append(value)
+    prefix = args.get("location_prefix")
+    if prefix:
+        clause, prefix_params = prefix_clause("location", prefix)
+        clauses.append(clause)
+        params += prefix_params
+    state = args.get("state")
+    if state:
+        clause, state_params = state_clause(state, now, online_sec, stale_sec)
+        clauses.append(clause)
+        params += state_params
+    after = args.get("after")
+    if after:
+        clauses.append("kiosk_id > ?")
+        params.append(after)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    return KIOSK_PAGE_SQL.format(where=where), params + [limit + 1]
+
+
+def history_page_query(kiosk_id, args, limit):
+    """Build a keyset page over one kiosk's commands, newest first.
+
+    args may carry status (comma-separated) and before (the cursor returned
+    with the previous page).
+    """
+    clauses, params = ["c.kiosk_id = ?"], [kiosk_id]
+    statuses = [s for s in (args.get("status") or "").split(",") if s]
+    if len(statuses) == 1:
+        clauses.append("c.status = ?")
+        params += statuses
+    elif statuses:
+        clauses.append(f"c.status IN ({', '.join('?' for _ in statuses)})")
+        params += statuses
+    before = args.get("before")
+    if before:
+        try:
+            params.append(int(before))
+        except ValueError:
+            raise ValueError("invalid_cursor") from None
+        clauses.append("c.rowid < ?")
+    return HISTORY_PAGE_SQL.format(where=f"WHERE {' AND '.join(clauses)}"), params + [limit + 1]
@@ -0,0 +1,96 @@
+import gzip
+import json
+import threading
+from collections import OrderedDict
+
+from flask import Response, request
+
+
+class EncodedResponses:
+    """Serialized JSON bodies keyed by URL, valid while their ETag matches.
+
+    ETags come from Database.etag(), so a conditional request is answered
+    with 304 and an unconditional repeat is served from the stored bytes;
+    neither touches sqlite. Bodies of at least gzip_min_bytes are gzipped
+    once for clients that accept it and the compressed copy is kept too.
+    """
+
+    def __init__(self, max_entries=256, max_bytes=32 * 1024 * 1024, gzip_min_bytes=1024, gzip_level=6):
+        self.max_entries = max(int(max_entries), 1)
+        self.max_bytes = max(int(max_bytes), 1)
+        self.total_bytes = 0
+        self.gzip_min_bytes = int(gzip_min_bytes)
+        self.gzip_level = int(gzip_level)
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.stats = {"not_modified": 0, "hits": 0, "misses": 0, "gzipped": 0}
+
+    def not_modified(self, etag):
+        """Return a 304 response if the request already holds etag, else None."""
+        if not request.if_none_match.contains_weak(etag):
+            return None
+        with self.lock:
+            self.stats["not_modified"] += 1
+        resp = Response(status=304)
+        resp.set_etag(etag, weak=True)
+        return resp
+
+    def get(self, key, etag):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry["etag"] != etag:
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry
+
+    def put(self, key, etag, data, headers=None):
+        entry = {
+            "key": key,
+            "etag": etag,
+            "body": json.dumps(data, separators=(",", ":")).encode("utf-8"),
+            "gzip": None,
+            "headers": dict(headers or {}),
+        }
+        with self.lock:
+            self._drop(key)
+            if len(entry["body"]) > self.max_bytes:
+                return entry
+            self.entries[key] = entry
+            self.total_bytes += len(entry["body"])
+            while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+                self._drop(next(iter(self.entries)))
+        return entry
+
+    def _drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= len(entry["body"]) + len(entry["gzip"] or b"")
+
+    def respond(self, entry):
+        body = entry["body"]
+        headers = dict(entry["headers"])
+        if len(body) >= self.gzip_min_bytes and "gzip" in request.accept_encodings:
+            compressed = entry["gzip"]
+            if compressed is None:
+                compressed = gzip.compress(body, self.gzip_level)
+                with self.lock:
+                    self.stats["gzipped"] += 1
+                    if entry["gzip"] is None:
+                        entry["gzip"] = compressed
+                        if self.entries.get(entry["key"]) is entry:
+                            self.total_bytes += len(compressed)
+            body = compressed
+            headers["Content-Encoding"] = "gzip"
+        resp = Response(body, content_type="application/json", headers=headers)
+        resp.set_etag(entry["etag"], weak=True)
+        resp.vary.add("Accept-Encoding")
+        return resp
+
+    def snapshot(self):
+        with self.lock:
+            data = dict(self.stats)
+            data["entries"] = len(self.entries)
+            data["bytes"] = self.total_bytes
+        return data
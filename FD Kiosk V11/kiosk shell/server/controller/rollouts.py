@@ -0,0 +1,410 @@
+import json
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+from outputs import UPSERT_OUTPUT_SQL, output_row
+from queries import prefix_clause
+
+COMMAND_STATUSES = ("pending", "queued", "received", "running", "success", "failed", "cancelled", "timeout")
+IN_FLIGHT_STATUSES = {"queued", "received", "running"}
+FINAL_STATUSES = {"success", "failed", "cancelled", "timeout"}
+
+INSERT_ROLLOUT_SQL = """
+    INSERT INTO rollouts (rollout_id, action, when_mode, args_json, selector_json,
+                          max_in_flight, wave_delay_sec, status, total, created_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+INSERT_ROLLOUT_COMMAND_SQL = """
+    INSERT INTO commands (cmd_id, kiosk_id, action, when_mode, args_json, status,
+                          started_at, finished_at, output, rollout_id, created_at)
+    VALUES (?, ?, ?, ?, ?, 'pending', NULL, NULL, NULL, ?, ?)
+"""
+
+NEXT_WAVE_SQL = """
+    SELECT cmd_id, kiosk_id FROM commands
+    WHERE rollout_id=? AND status='pending' ORDER BY rowid LIMIT ?
+"""
+
+MARK_PUBLISHED_SQL = "UPDATE commands SET status='queued' WHERE cmd_id=? AND status='pending'"
+
+MARK_PUBLISH_FAILED_SQL = """
+    UPDATE commands SET status='failed', started_at=?, finished_at=?
+    WHERE cmd_id=? AND status='pending'
+"""
+
+CANCEL_PENDING_SQL = """
+    UPDATE commands SET status='cancelled', finished_at=?
+    WHERE rollout_id=? AND status='pending'
+"""
+
+SET_ROLLOUT_STATUS_SQL = "UPDATE rollouts SET status=?, finished_at=? WHERE rollout_id=?"
+
+ROLLOUT_COUNTS_SQL = """
+    SELECT status, count(*) FROM commands WHERE rollout_id=? GROUP BY status
+"""
+
+ROLLOUT_CMD_IDS_SQL = """
+    SELECT cmd_id FROM commands
+    WHERE rollout_id=? AND status IN ('pending', 'queued', 'received', 'running')
+"""
+
+
+def utc_now_iso():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def init_rollouts_schema(conn):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS rollouts (
+            rollout_id TEXT PRIMARY KEY,
+            action TEXT,
+            when_mode TEXT,
+            args_json TEXT,
+            selector_json TEXT,
+            max_in_flight INTEGER,
+            wave_delay_sec REAL,
+            status TEXT,
+            total INTEGER,
+            created_at TEXT,
+            finished_at TEXT
+        )
+        """
+    )
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(commands)")}
+    if "rollout_id" not in columns:
+        conn.execute("ALTER TABLE commands ADD COLUMN rollout_id TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_commands_rollout ON commands (rollout_id, status)")
+
+
+def resolve_selector(db, selector):
+    """Return kiosk ids for a selector.
+
+    Accepts "all", {"kiosk_ids": [...]}, {"location_prefix": "..."} or
+    {"git_sha": "..."}. Raises ValueError for anything else.
+    """
+    if selector == "all" or selector == {"all": True}:
+        rows = db.read("SELECT kiosk_id FROM kiosks ORDER BY kiosk_id")
+        return [r[0] for r in rows]
+    if not isinstance(selector, dict) or len(selector) != 1:
+        raise ValueError("invalid_selector")
+    key, value = next(iter(selector.items()))
+    if key == "kiosk_ids":
+        if not isinstance(value, list) or not all(isinstance(v, str) and v for v in value):
+            raise ValueError("invalid_selector")
+        ids = list(dict.fromkeys(value))
+        if any(ch in kiosk_id for kiosk_id in ids for ch in ("/", "+", "#")):
+            raise ValueError("invalid_kiosk_id")
+        return ids
+    if not isinstance(value, str) or not value:
+        raise ValueError("invalid_selector")
+    if key == "location_prefix":
+        clause, params = prefix_clause("location", value)
+        rows = db.read(f"SELECT kiosk_id FROM kiosks WHERE {clause} ORDER BY kiosk_id", params)
+        return [r[0] for r in rows]
+    if key == "git_sha":
+        rows = db.read("SELECT kiosk_id FROM kiosks WHERE git_sha=? ORDER BY kiosk_id", (value,))
+        return [r[0] for r in rows]
+    raise ValueError("invalid_selector")
+
+
+class RolloutManager:
+    """Publishes fleet-wide commands in waves.
+
+    A rollout inserts one `pending` command row per kiosk in a single
+    transaction. The dispatcher thread publishes up to max_in_flight commands
+    at a time, waits wave_delay_sec between waves, and only refills the wave
+    as replies move commands out of queued/received/running. Nightly commands
+    have no result until the nightly run, so their waves are gated by the
+    delay only. publish is DeliveryTracker.send, which handles redelivery.
+
+    Progress counters are kept in memory and updated on every status
+    transition, so GET on a rollout never touches sqlite. Status changes the
+    dispatcher makes itself are published to the change feed, if given.
+    """
+
+    def __init__(self, db, publish, tick_sec=1.0, feed=None):
+        self.db = db
+        self.publish = publish
+        self.tick_sec = tick_sec
+        self.feed = feed
+        self.lock = threading.Lock()
+        self.rollouts = {}
+        self.cmd_rollout = {}
+        self.cmd_status = {}
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def load_active(self):
+        rows = self.db.read(
+            """
+            SELECT rollout_id, action, when_mode, args_json, selector_json, max_in_flight,
+                   wave_delay_sec, status, total, created_at, finished_at
+            FROM rollouts WHERE status='running'
+            """
+        )
+        for row in rows:
+            rollout = self._from_row(row)
+            for status, count in self.db.read(ROLLOUT_COUNTS_SQL, (rollout["rollout_id"],)):
+                rollout["counts"][status] = count
+            with self.lock:
+                self.rollouts[rollout["rollout_id"]] = rollout
+            for (cmd_id,) in self.db.read(ROLLOUT_CMD_IDS_SQL, (rollout["rollout_id"],)):
+                self.cmd_rollout[cmd_id] = rollout["rollout_id"]
+        for cmd_id, status in self.db.read(
+            """
+            SELECT cmd_id, status FROM commands
+            WHERE status IN ('pending', 'queued', 'received', 'running') AND rollout_id IS NOT NULL
+            """
+        ):
+            self.cmd_status[cmd_id] = status
+
+    def _from_row(self, row):
+        return {
+            "rollout_id": row[0],
+            "action": row[1],
+            "when": row[2],
+            "args": json.loads(row[3] or "{}"),
+            "selector": json.loads(row[4] or "null"),
+            "max_in_flight": row[5],
+            "wave_delay_sec": row[6],
+            "status": row[7],
+            "total": row[8],
+            "created_at": row[9],
+            "finished_at": row[10],
+            "counts": {status: 0 for status in COMMAND_STATUSES},
+            "waves": 0,
+            "next_wave_at": 0.0,
+        }
+
+    def start(self):
+        self.load_active()
+        self._thread = threading.Thread(target=self._run, name="rollouts", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def create(self, selector, action, when_mode, args, max_in_flight=50, wave_delay_sec=30):
+        kiosk_ids = resolve_selector(self.db, selector)
+        if not kiosk_ids:
+            raise ValueError("no_matching_kiosks")
+        rollout_id = str(uuid.uuid4())
+        created_at = utc_now_iso()
+        max_in_flight = max(int(max_in_flight), 1)
+        wave_delay_sec = max(float(wave_delay_sec), 0.0)
+        cmd_ids = [str(uuid.uuid4()) for _ in kiosk_ids]
+        args_json = json.dumps(args or {})
+        with self.db.transaction() as conn:
+            conn.execute(
+                INSERT_ROLLOUT_SQL,
+                (
+                    rollout_id,
+                    action,
+                    when_mode,
+                    args_json,
+                    json.dumps(selector),
+                    max_in_flight,
+                    wave_delay_sec,
+                    "running",
+                    len(kiosk_ids),
+                    created_at,
+                ),
+            )
+            conn.executemany(
+                INSERT_ROLLOUT_COMMAND_SQL,
+                [
+                    (cmd_id, kiosk_id, action, when_mode, args_json, rollout_id, created_at)
+                    for cmd_id, kiosk_id in zip(cmd_ids, kiosk_ids)
+                ],
+            )
+        self.db.bump("commands")
+        rollout = self._from_row(
+            (
+                rollout_id,
+                action,
+                when_mode,
+                args_json,
+                json.dumps(selector),
+                max_in_flight,
+                wave_delay_sec,
+                "running",
+                len(kiosk_ids),
+                created_at,
+                None,
+            )
+        )
+        rollout["counts"]["pending"] = len(kiosk_ids)
+        with self.lock:
+            self.rollouts[rollout_id] = rollout
+            for cmd_id in cmd_ids:
+                self.cmd_rollout[cmd_id] = rollout_id
+                self.cmd_status[cmd_id] = "pending"
+        self._notify(
+            [(cmd_id, kiosk_id, "pending") for cmd_id, kiosk_id in zip(cmd_ids, kiosk_ids)],
+            action=action,
+            when=when_mode,
+        )
+        self._wake.set()
+        return self.get(rollout_id)
+
+    def _notify(self, changes, **fields):
+        if self.feed is None or not changes:
+            return
+        self.feed.publish_many(
+            "command",
+            [
+                dict(fields, cmd_id=cmd_id, kiosk_id=kiosk_id, status=status)
+                for cmd_id, kiosk_id, status in changes
+            ],
+        )
+
+    def get(self, rollout_id):
+        with self.lock:
+            rollout = self.rollouts.get(rollout_id)
+            if rollout is not None:
+                return self._public(rollout)
+        rows = self.db.read(
+            """
+            SELECT rollout_id, action, when_mode, args_json, selector_json, max_in_flight,
+                   wave_delay_sec, status, total, created_at, finished_at
+            FROM rollouts WHERE rollout_id=?
+            """,
+            (rollout_id,),
+        )
+        if not rows:
+            return None
+        rollout = self._from_row(rows[0])
+        for status, count in self.db.read(ROLLOUT_COUNTS_SQL, (rollout_id,)):
+            rollout["counts"][status] = count
+        return self._public(rollout)
+
+    def list(self):
+        with self.lock:
+            return [self._public(r) for r in self.rollouts.values()]
+
+    def _public(self, rollout):
+        data = {k: v for k, v in rollout.items() if k != "next_wave_at"}
+        data["counts"] = dict(rollout["counts"])
+        data["in_flight"] = sum(rollout["counts"][s] for s in IN_FLIGHT_STATUSES)
+        data["done"] = sum(rollout["counts"][s] for s in FINAL_STATUSES)
+        return data
+
+    def cancel(self, rollout_id):
+        with self.lock:
+            rollout = self.rollouts.pop(rollout_id, None)
+        if rollout is None:
+            return False
+        now = utc_now_iso()
+        with self.db.transaction() as conn:
+            cancelled = conn.execute(
+                "SELECT cmd_id, kiosk_id FROM commands WHERE rollout_id=? AND status='pending'",
+                (rollout_id,),
+            ).fetchall()
+            conn.execute(CANCEL_PENDING_SQL, (now, rollout_id))
+            conn.execute(SET_ROLLOUT_STATUS_SQL, ("cancelled", now, rollout_id))
+        self.db.bump("commands")
+        with self.lock:
+            for cmd_id, owner in list(self.cmd_rollout.items()):
+                if owner == rollout_id and self.cmd_status.get(cmd_id) == "pending":
+                    self.cmd_status.pop(cmd_id, None)
+                    self.cmd_rollout.pop(cmd_id, None)
+        self._notify(
+            [(cmd_id, kiosk_id, "cancelled") for cmd_id, kiosk_id in cancelled], finished_at=now
+        )
+        return True
+
+    def on_command_status(self, cmd_id, status):
+        """Record a status transition reported by a kiosk (reply or progress)."""
+        with self.lock:
+            rollout_id = self.cmd_rollout.get(cmd_id)
+            if rollout_id is None:
+                return
+            self._transition(rollout_id, cmd_id, status)
+        self._wake.set()
+
+    def _transition(self, rollout_id, cmd_id, status):
+        rollout = self.rollouts.get(rollout_id)
+        previous = self.cmd_status.get(cmd_id)
+        if rollout is None or previous == status or previous in FINAL_STATUSES:
+            return
+        if previous is not None:
+            rollout["counts"][previous] -= 1
+        rollout["counts"][status] = rollout["counts"].get(status, 0) + 1
+        if status in FINAL_STATUSES:
+            self.cmd_status.pop(cmd_id, None)
+            self.cmd_rollout.pop(cmd_id, None)
+        else:
+            self.cmd_status[cmd_id] = status
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.tick_sec)
+            self._wake.clear()
+            with self.lock:
+                active = list(self.rollouts.keys())
+            for rollout_id in active:
+                try:
+                    self._advance(rollout_id)
+                except Exception as exc:
+                    print(f"Rollout {rollout_id} dispatch failed: {exc}")
+
+    def _advance(self, rollout_id):
+        with self.lock:
+            rollout = self.rollouts.get(rollout_id)
+            if rollout is None:
+                return
+            counts = rollout["counts"]
+            gated = rollout["when"] == "immediate"
+            in_flight = sum(counts[s] for s in IN_FLIGHT_STATUSES) if gated else 0
+            if counts["pending"] == 0 and in_flight == 0:
+                self._finish(rollout)
+                return
+            if counts["pending"] == 0 or time.monotonic() < rollout["next_wave_at"]:
+                return
+            room = rollout["max_in_flight"] - in_flight
+            if room <= 0:
+                return
+            payload = {"action": rollout["action"], "when": rollout["when"], "args": rollout["args"]}
+        wave = self.db.read(NEXT_WAVE_SQL, (rollout_id, room))
+        published, failed, changes = [], [], []
+        for cmd_id, kiosk_id in wave:
+            if self.publish(kiosk_id, dict(payload, cmd_id=cmd_id)):
+                published.append(cmd_id)
+                changes.append((cmd_id, kiosk_id, "queued"))
+            else:
+                failed.append(cmd_id)
+                changes.append((cmd_id, kiosk_id, "failed"))
+        now = utc_now_iso()
+        with self.db.transaction() as conn:
+            conn.executemany(MARK_PUBLISHED_SQL, [(cmd_id,) for cmd_id in published])
+            conn.executemany(MARK_PUBLISH_FAILED_SQL, [(now, now, cmd_id) for cmd_id in failed])
+            conn.executemany(
+                UPSERT_OUTPUT_SQL, [output_row(cmd_id, "publish_failed") for cmd_id in failed]
+            )
+        self.db.bump("commands")
+        with self.lock:
+            # A reply can beat us here; never move a command back to queued.
+            for cmd_id in published:
+                if self.cmd_status.get(cmd_id) == "pending":
+                    self._transition(rollout_id, cmd_id, "queued")
+            for cmd_id in failed:
+                if self.cmd_status.get(cmd_id) == "pending":
+                    self._transition(rollout_id, cmd_id, "failed")
+            rollout["waves"] += 1
+            rollout["next_wave_at"] = time.monotonic() + rollout["wave_delay_sec"]
+        self._notify(changes)
+
+    def _finish(self, rollout):
+        now = utc_now_iso()
+        self.db.write(SET_ROLLOUT_STATUS_SQL, ("completed", now, rollout["rollout_id"]))
+        rollout["status"] = "completed"
+        rollout["finished_at"] = now
+        self.rollouts.pop(rollout["rollout_id"], None)
@@ -1,12 +1,19 @@
 import json
 import os
-from urllib.parse import urljoin
+import statistics
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from urllib.parse import urlencode, urljoin
 
 import requests
-from flask import Flask, Response, jsonify, render_template, request
+from requests.adapters import HTTPAdapter
+from flask import Flask, Response, jsonify, render_template, request, stream_with_context
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 CONFIG_PATH = os.path.join(BASE_DIR, "config.json")
+PASS_HEADERS = ("Content-Type", "ETag", "X-Change-Version", "X-Next-Cursor", "Link")
 
 
 def load_config():
@@ -18,21 +25,300 @@ def make_controller_url(base_url, path):
     return urljoin(base_url.rstrip("/") + "/", path.lstrip("/"))
 
 
-def proxy_request(method, url, **kwargs):
+class ControllerClient:
+    """Keep-alive HTTP client for the controller with a small GET cache.
+
+    All calls share one pooled requests.Session. GET responses are cached
+    for ttl_sec in an LRU bounded by entry count and bytes; expired entries
+    that carry an ETag are revalidated with If-None-Match, so a 304 renews
+    them without resending the body. Concurrent misses for the same URL
+    share one upstream request (single flight).
+    """
+
+    def __init__(
+        self, timeout=10, pool_size=16, ttl_sec=2.0, max_entries=256, max_bytes=8 * 1024 * 1024
+    ):
+        self.timeout = timeout
+        self.ttl_sec = float(ttl_sec)
+        self.max_entries = max(int(max_entries), 1)
+        self.max_bytes = max(int(max_bytes), 1)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+        self.cache_bytes = 0
+        self.inflight = {}
+        self.latency_ms = deque(maxlen=1000)
+        self.stats = {
+            "requests": 0,
+            "hits": 0,
+            "coalesced": 0,
+            "misses": 0,
+            "revalidated": 0,
+            "evictions": 0,
+            "upstream_requests": 0,
+            "upstream_errors": 0,
+        }
+
+    def _send(self, method, url, **kwargs):
+        started = time.perf_counter()
+        try:
+            resp = self.session.request(method, url, timeout=self.timeout, **kwargs)
+        except requests.RequestException:
+            with self.lock:
+                self.stats["upstream_errors"] += 1
+            raise
+        with self.lock:
+            self.stats["upstream_requests"] += 1
+            self.latency_ms.append((time.perf_counter() - started) * 1000)
+        return resp
+
+    def request(self, method, url, **kwargs):
+        """Uncached call; returns a cache-entry shaped dict."""
+        resp = self._send(method, url, **kwargs)
+        return self._entry(resp)
+
+    def _entry(self, resp):
+        return {
+            "status": resp.status_code,
+            "content": resp.content,
+            "headers": {h: resp.headers[h] for h in PASS_HEADERS if h in resp.headers},
+            "etag": resp.headers.get("ETag"),
+            "expires": time.monotonic() + self.ttl_sec,
+        }
+
+    def get(self, url, params=None):
+        key = f"{url}?{urlencode(sorted(params.items()))}" if params else url
+        with self.lock:
+            self.stats["requests"] += 1
+            stale = self.cache.get(key)
+            if stale is not None and stale["expires"] > time.monotonic():
+                self.cache.move_to_end(key)
+                self.stats["hits"] += 1
+                return stale
+            flight = self.inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = {"done": threading.Event(), "entry": None, "error": None}
+                self.inflight[key] = flight
+            else:
+                self.stats["coalesced"] += 1
+        if not leader:
+            if not flight["done"].wait(self.timeout):
+                raise requests.Timeout(f"timed out waiting for in-flight request to {url}")
+            if flight["error"] is not None:
+                raise flight["error"]
+            return flight["entry"]
+        try:
+            flight["entry"] = self._fetch(key, url, params, stale)
+            return flight["entry"]
+        except Exception as exc:
+            # Followers re-raise whatever the leader hit, not just network errors.
+            flight["error"] = exc
+            raise
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+            flight["done"].set()
+
+    def _fetch(self, key, url, params, stale):
+        headers = {}
+        if stale is not None and stale["etag"]:
+            headers["If-None-Match"] = stale["etag"]
+        resp = self._send("GET", url, params=params, headers=headers)
+        with self.lock:
+            if resp.status_code == 304 and stale is not None:
+                self.stats["revalidated"] += 1
+                stale["expires"] = time.monotonic() + self.ttl_sec
+                if key in self.cache:
+                    self.cache.move_to_end(key)
+                return stale
+            self.stats["misses"] += 1
+            entry = self._entry(resp)
+            if resp.status_code == 200:
+                self._store(key, entry)
+            return entry
+
+    def _store(self, key, entry):
+        old = self.cache.pop(key, None)
+        if old is not None:
+            self.cache_bytes -= len(old["content"])
+        if len(entry["content"]) > self.max_bytes:
+            return
+        self.cache[key] = entry
+        self.cache_bytes += len(entry["content"])
+        while len(self.cache) > self.max_entries or self.cache_bytes > self.max_bytes:
+            _, evicted = self.cache.popitem(last=False)
+            self.cache_bytes -= len(evicted["content"])
+            self.stats["evictions"] += 1
+
+    def snapshot(self):
+        with self.lock:
+            data = dict(self.stats)
+            samples = sorted(self.latency_ms)
+            data["cache_entries"] = len(self.cache)
+            data["cache_bytes"] = self.cache_bytes
+        served = data["hits"] + data["coalesced"]
+        data["hit_ratio"] = round(served / data["requests"], 4) if data["requests"] else 0.0
+        data["upstream_latency_ms"] = {
+            "samples": len(samples),
+            "avg": round(statistics.fmean(samples), 3) if samples else None,
+            "p50": round(samples[len(samples) // 2], 3) if samples else None,
+            "p95": round(samples[int(len(samples) * 0.95)], 3) if samples else None,
+        }
+        return data
+
+
+def parse_event_id(value):
+    """Split an "epoch:version" event id; a bare version has epoch None."""
+    epoch, sep, version = str(value).rpartition(":")
+    return (epoch if sep else None), int(version)
+
+
+def proxy_response(entry):
+    """Turn a ControllerClient entry into a Flask response, honoring If-None-Match."""
+    headers = dict(entry["headers"])
+    if entry["etag"] and request.headers.get("If-None-Match") == entry["etag"]:
+        headers.pop("Content-Type", None)
+        return Response(status=304, headers=headers)
+    return Response(entry["content"], status=entry["status"], headers=headers)
+
+
+def proxy_request(client, method, url, cache=True, **kwargs):
+    """Forward a call to the controller; cache=False sends GETs straight upstream."""
     try:
-        resp = requests.request(method, url, timeout=10, **kwargs)
+        if method == "GET" and cache:
+            entry = client.get(url, params=kwargs.get("params"))
+        else:
+            entry = client.request(method, url, **kwargs)
     except requests.RequestException as exc:
         return jsonify({"error": "controller_unreachable", "detail": str(exc)}), 502
+    return proxy_response(entry)
 
-    if resp.headers.get("content-type", "").startswith("application/json"):
-        return Response(resp.content, status=resp.status_code, content_type="application/json")
 
-    return Response(resp.content, status=resp.status_code)
+class ChangeRelay:
+    """Fans one controller change stream out to every open dashboard page.
+
+    A single upstream SSE connection feeds a small ring buffer; browser
+    streams replay from it by version. When the controller reports a reset
+    (restart or buffer overrun) the relay picks a new epoch and every browser
+    is told to reload its snapshot. Browser event ids carry the relay epoch,
+    so a page reconnecting across a reset is reset too instead of replaying
+    versions from another controller process.
+    """
+
+    def __init__(self, url, max_events=2000, reconnect_sec=3, keepalive_sec=15):
+        self.url = url
+        self.reconnect_sec = reconnect_sec
+        self.keepalive_sec = keepalive_sec
+        self.events = deque(maxlen=max_events)
+        self.version = 0
+        self.epoch = uuid.uuid4().hex[:12]
+        self.upstream_epoch = None
+        self.connected = False
+        self.cond = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        with self.cond:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="change-relay", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self._consume()
+            except (requests.RequestException, ValueError) as exc:
+                print(f"Change stream from controller lost: {exc}")
+            self.connected = False
+            time.sleep(self.reconnect_sec)
+
+    def _consume(self):
+        headers = {"Accept": "text/event-stream"}
+        if self.upstream_epoch is not None:
+            headers["Last-Event-ID"] = f"{self.upstream_epoch}:{self.version}"
+        with requests.get(self.url, headers=headers, stream=True, timeout=(5, 60)) as resp:
+            resp.raise_for_status()
+            self.connected = True
+            fields = {}
+            for line in resp.iter_lines(decode_unicode=True):
+                if line:
+                    if not line.startswith(":"):
+                        name, _, value = line.partition(":")
+                        fields[name] = value[1:] if value.startswith(" ") else value
+                    continue
+                if "data" in fields:
+                    self._dispatch(fields.get("event", "message"), json.loads(fields["data"]))
+                fields = {}
+
+    def _dispatch(self, kind, data):
+        with self.cond:
+            # A first hello also resets: pages opened before the relay connected
+            # may hold snapshots older than anything it can replay. A hello from
+            # another controller process means its versions mean something else.
+            if kind == "reset" or (kind == "hello" and data.get("epoch") != self.upstream_epoch):
+                self.events.clear()
+                self.version = data["version"]
+                self.upstream_epoch = data.get("epoch")
+                self.epoch = uuid.uuid4().hex[:12]
+            elif kind == "hello":
+                return
+            else:
+                self.events.append(data)
+                self.version = data["version"]
+            self.cond.notify_all()
+
+    def stream(self, version, epoch=None):
+        """Yield server-sent event frames for one browser, starting after version.
+
+        epoch is the relay epoch from the browser's Last-Event-ID, if any.
+        """
+        with self.cond:
+            if epoch is None:
+                epoch = self.epoch
+        yield "retry: 3000\n\n"
+        while True:
+            with self.cond:
+                self.cond.wait_for(
+                    lambda: self.epoch != epoch or self.version > version, self.keepalive_sec
+                )
+                if self.epoch != epoch:
+                    epoch = self.epoch
+                    version = self.version
+                    yield f"id: {epoch}:{version}\nevent: reset\ndata: {json.dumps({'version': version})}\n\n"
+                    continue
+                oldest = self.events[0]["version"] if self.events else self.version + 1
+                if version < oldest - 1 and version < self.version:
+                    version = self.version
+                    yield f"id: {epoch}:{version}\nevent: reset\ndata: {json.dumps({'version': version})}\n\n"
+                    continue
+                events = [e for e in self.events if e["version"] > version]
+            if not events:
+                yield ": keepalive\n\n"
+                continue
+            for event in events:
+                yield f"id: {epoch}:{event['version']}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n"
+            version = events[-1]["version"]
 
 
 def create_app():
     cfg = load_config()
     controller_base = cfg["controller"]["base_url"]
+    proxy_cfg = cfg.get("proxy", {})
+    client = ControllerClient(
+        timeout=proxy_cfg.get("timeout_sec", 10),
+        pool_size=proxy_cfg.get("pool_size", 16),
+        ttl_sec=proxy_cfg.get("cache_ttl_sec", 2.0),
+        max_entries=proxy_cfg.get("cache_max_entries", 256),
+        max_bytes=proxy_cfg.get("cache_max_bytes", 8 * 1024 * 1024),
+    )
+
+    relay = ChangeRelay(make_controller_url(controller_base, "/api/changes/stream"))
+    relay.start()
 
     app = Flask(__name__)
 
@@ -47,18 +333,60 @@ def create_app():
     @app.get("/api/kiosks")
     def api_kiosks():
         url = make_controller_url(controller_base, "/api/kiosks")
-        return proxy_request("GET", url)
+        return proxy_request(client, "GET", url, params=request.args.to_dict())
+
+    @app.get("/api/fleet/summary")
+    def api_fleet_summary():
+        url = make_controller_url(controller_base, "/api/fleet/summary")
+        return proxy_request(client, "GET", url)
+
+    @app.get("/api/kiosks/<kiosk_id>")
+    def api_kiosk(kiosk_id):
+        url = make_controller_url(controller_base, f"/api/kiosks/{kiosk_id}")
+        return proxy_request(client, "GET", url)
 
     @app.get("/api/kiosks/<kiosk_id>/history")
     def api_kiosk_history(kiosk_id):
         url = make_controller_url(controller_base, f"/api/kiosks/{kiosk_id}/history")
-        return proxy_request("GET", url)
+        return proxy_request(client, "GET", url, params=request.args.to_dict())
+
+    @app.get("/api/commands/<cmd_id>/progress")
+    def api_command_progress(cmd_id):
+        url = make_controller_url(controller_base, f"/api/commands/{cmd_id}/progress")
+        # Progress is polled while output streams in; a cached page would lag.
+        return proxy_request(client, "GET", url, cache=False, params=request.args.to_dict())
+
+    @app.get("/api/commands/<cmd_id>/output")
+    def api_command_output(cmd_id):
+        url = make_controller_url(controller_base, f"/api/commands/{cmd_id}/output")
+        return proxy_request(client, "GET", url)
+
+    @app.get("/api/events")
+    def api_events():
+        try:
+            epoch, since = parse_event_id(
+                request.headers.get("Last-Event-ID") or request.args.get("since") or 0
+            )
+        except ValueError:
+            return jsonify({"error": "invalid_since"}), 400
+        relay.start()
+        return Response(
+            stream_with_context(relay.stream(since, epoch)),
+            content_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
 
     @app.post("/api/command")
     def api_command():
         url = make_controller_url(controller_base, "/api/command")
         payload = request.get_json(force=True, silent=True) or {}
-        return proxy_request("POST", url, json=payload)
+        return proxy_request(client, "POST", url, json=payload)
+
+    @app.get("/api/proxy/stats")
+    def api_proxy_stats():
+        data = client.snapshot()
+        data["change_relay"] = {"connected": relay.connected, "version": relay.version}
+        return jsonify(data)
 
     return app, cfg
 
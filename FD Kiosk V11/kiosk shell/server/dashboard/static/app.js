@@ -33,6 +33,20 @@ function formatRelative(lastSeen) {
 
 async function fetchJson(url, options) {
   const resp = await fetch(url, options);
+  return readJson(resp);
+}
+
+async function fetchSnapshot(url) {
+  const resp = await fetch(url);
+  const data = await readJson(resp);
+  return {
+    data,
+    version: Number(resp.headers.get("X-Change-Version") || 0),
+    next: resp.headers.get("X-Next-Cursor"),
+  };
+}
+
+async function readJson(resp) {
   const contentType = resp.headers.get("content-type") || "";
   let data = null;
   if (contentType.includes("application/json")) {
@@ -60,181 +74,506 @@ function setStatus(el, text, tone) {
   el.className = `status-line ${tone}`;
 }
 
+const AGE_REFRESH_MS = 30 * 1000;
+const KIOSK_PAGE_SIZE = 1000;
+const SUMMARY_REFRESH_MS = 15 * 1000;
+
+function subscribeChanges(since, handlers, onReset) {
+  const source = new EventSource(`/api/events?since=${since}`);
+  let lastVersion = since;
+  const dispatch = (type) => (event) => {
+    const change = JSON.parse(event.data);
+    if (change.version <= lastVersion) return;
+    lastVersion = change.version;
+    if (handlers[type]) handlers[type](change.data);
+  };
+  source.addEventListener("kiosk", dispatch("kiosk"));
+  source.addEventListener("command", dispatch("command"));
+  source.addEventListener("reset", () => {
+    source.close();
+    onReset();
+  });
+  return source;
+}
+
+function fillKioskRow(tr, kiosk) {
+  tr.innerHTML = "";
+
+  const statusTd = document.createElement("td");
+  statusTd.className = "status-cell";
+  const statusDot = document.createElement("span");
+  statusDot.className = `status-dot ${statusClass(kiosk.last_seen)}`;
+  statusTd.appendChild(statusDot);
+
+  const idTd = document.createElement("td");
+  const idLink = document.createElement("a");
+  idLink.className = "link";
+  idLink.href = `/kiosk/${encodeURIComponent(kiosk.kiosk_id || "")}`;
+  idLink.textContent = kiosk.kiosk_id || "—";
+  idTd.appendChild(idLink);
+
+  const locationTd = document.createElement("td");
+  locationTd.textContent = kiosk.location || "—";
+
+  const osTd = document.createElement("td");
+  osTd.textContent = kiosk.os_version || "—";
+
+  const gitTd = document.createElement("td");
+  gitTd.className = "mono";
+  gitTd.textContent = kiosk.git_sha || "—";
+
+  const ipTd = document.createElement("td");
+  ipTd.textContent = kiosk.ip || "—";
+
+  const lastSeenTd = document.createElement("td");
+  const lastSeenPrimary = document.createElement("div");
+  lastSeenPrimary.textContent = kiosk.last_seen || "—";
+  const lastSeenRelative = document.createElement("div");
+  lastSeenRelative.className = "small muted";
+  lastSeenRelative.textContent = formatRelative(kiosk.last_seen);
+  lastSeenTd.appendChild(lastSeenPrimary);
+  lastSeenTd.appendChild(lastSeenRelative);
+
+  tr.appendChild(statusTd);
+  tr.appendChild(idTd);
+  tr.appendChild(locationTd);
+  tr.appendChild(osTd);
+  tr.appendChild(gitTd);
+  tr.appendChild(ipTd);
+  tr.appendChild(lastSeenTd);
+}
+
+// Rows keyed by kiosk_id; change events are batched into one DOM pass per frame.
+const kioskList = { rows: new Map(), kiosks: new Map(), pending: new Map(), frame: null, source: null, timer: null };
+
+function queueKioskPatch(kiosk) {
+  kioskList.pending.set(kiosk.kiosk_id, kiosk);
+  if (kioskList.frame === null) {
+    kioskList.frame = requestAnimationFrame(applyKioskPatches);
+  }
+}
+
+function applyKioskPatches() {
+  const tableBody = document.querySelector("#kiosk-table-body");
+  const statusEl = document.querySelector("#kiosk-list-status");
+  kioskList.frame = null;
+  kioskList.pending.forEach((kiosk, kioskId) => {
+    let tr = kioskList.rows.get(kioskId);
+    if (!tr) {
+      tr = document.createElement("tr");
+      kioskList.rows.set(kioskId, tr);
+      tableBody.appendChild(tr);
+    }
+    kioskList.kiosks.set(kioskId, kiosk);
+    fillKioskRow(tr, kiosk);
+  });
+  kioskList.pending.clear();
+  if (statusEl) {
+    setStatus(statusEl, `Live: ${kioskList.rows.size} kiosks.`, "muted");
+  }
+}
+
+function refreshKioskAges() {
+  kioskList.rows.forEach((tr, kioskId) => {
+    const kiosk = kioskList.kiosks.get(kioskId);
+    tr.querySelector(".status-dot").className = `status-dot ${statusClass(kiosk.last_seen)}`;
+    tr.querySelector(".small.muted").textContent = formatRelative(kiosk.last_seen);
+  });
+}
+
 async function loadKioskList() {
   const tableBody = document.querySelector("#kiosk-table-body");
   const statusEl = document.querySelector("#kiosk-list-status");
   if (!tableBody || !statusEl) return;
 
+  if (kioskList.source) kioskList.source.close();
+  if (kioskList.frame !== null) cancelAnimationFrame(kioskList.frame);
+  kioskList.source = null;
+  kioskList.frame = null;
+  kioskList.rows.clear();
+  kioskList.kiosks.clear();
+  kioskList.pending.clear();
   setStatus(statusEl, "Loading kiosks…", "muted");
   tableBody.innerHTML = "";
 
   try {
-    const kiosks = await fetchJson("/api/kiosks");
+    // Replay changes from the first page's version; later pages are newer.
+    let page = await fetchSnapshot(`/api/kiosks?limit=${KIOSK_PAGE_SIZE}`);
+    const version = page.version;
+    const kiosks = [];
+    for (;;) {
+      page.data.forEach((kiosk) => {
+        const tr = document.createElement("tr");
+        fillKioskRow(tr, kiosk);
+        kioskList.rows.set(kiosk.kiosk_id, tr);
+        kioskList.kiosks.set(kiosk.kiosk_id, kiosk);
+        tableBody.appendChild(tr);
+        kiosks.push(kiosk);
+      });
+      if (!page.next) break;
+      setStatus(statusEl, `Loading kiosks… ${kiosks.length}`, "muted");
+      page = await fetchSnapshot(
+        `/api/kiosks?limit=${KIOSK_PAGE_SIZE}&after=${encodeURIComponent(page.next)}`
+      );
+    }
+    kioskList.source = subscribeChanges(version, { kiosk: queueKioskPatch }, loadKioskList);
+    if (kioskList.timer === null) {
+      kioskList.timer = setInterval(refreshKioskAges, AGE_REFRESH_MS);
+    }
+
     if (!kiosks.length) {
       setStatus(statusEl, "No kiosks reported yet.", "muted");
       return;
     }
-
-    kiosks.forEach((kiosk) => {
-      const tr = document.createElement("tr");
-
-      const statusTd = document.createElement("td");
-      statusTd.className = "status-cell";
-      const statusDot = document.createElement("span");
-      statusDot.className = `status-dot ${statusClass(kiosk.last_seen)}`;
-      statusTd.appendChild(statusDot);
-
-      const idTd = document.createElement("td");
-      const idLink = document.createElement("a");
-      idLink.className = "link";
-      idLink.href = `/kiosk/${encodeURIComponent(kiosk.kiosk_id || "")}`;
-      idLink.textContent = kiosk.kiosk_id || "—";
-      idTd.appendChild(idLink);
-
-      const locationTd = document.createElement("td");
-      locationTd.textContent = kiosk.location || "—";
-
-      const osTd = document.createElement("td");
-      osTd.textContent = kiosk.os_version || "—";
-
-      const gitTd = document.createElement("td");
-      gitTd.className = "mono";
-      gitTd.textContent = kiosk.git_sha || "—";
-
-      const ipTd = document.createElement("td");
-      ipTd.textContent = kiosk.ip || "—";
-
-      const lastSeenTd = document.createElement("td");
-      const lastSeenPrimary = document.createElement("div");
-      lastSeenPrimary.textContent = kiosk.last_seen || "—";
-      const lastSeenRelative = document.createElement("div");
-      lastSeenRelative.className = "small muted";
-      lastSeenRelative.textContent = formatRelative(kiosk.last_seen);
-      lastSeenTd.appendChild(lastSeenPrimary);
-      lastSeenTd.appendChild(lastSeenRelative);
-
-      tr.appendChild(statusTd);
-      tr.appendChild(idTd);
-      tr.appendChild(locationTd);
-      tr.appendChild(osTd);
-      tr.appendChild(gitTd);
-      tr.appendChild(ipTd);
-      tr.appendChild(lastSeenTd);
-      tableBody.appendChild(tr);
-    });
-
     setStatus(statusEl, `Loaded ${kiosks.length} kiosks.`, "muted");
   } catch (err) {
     setStatus(statusEl, `Failed to load kiosks: ${err.message}`, "error");
   }
 }
 
+function formatGroup(counts) {
+  const entries = Object.entries(counts || {});
+  if (!entries.length) return "—";
+  return entries.map(([name, n]) => `${name} (${n})`).join(", ");
+}
+
+function renderFleetSummary(statusEl, groupsEl, summary) {
+  statusEl.innerHTML = "";
+  const addCount = (className, count, labelText) => {
+    const item = document.createElement("div");
+    if (className) {
+      const dot = document.createElement("span");
+      dot.className = `status-dot ${className}`;
+      item.appendChild(dot);
+    }
+    const value = document.createElement("span");
+    value.className = "summary-count";
+    value.textContent = String(count);
+    const label = document.createElement("span");
+    label.className = "muted";
+    label.textContent = labelText;
+    item.appendChild(value);
+    item.appendChild(label);
+    statusEl.appendChild(item);
+  };
+  addCount(null, summary.total, "kiosks");
+  addCount("status-online", summary.status.online, "online");
+  addCount("status-stale", summary.status.stale, "stale");
+  addCount("status-offline", summary.status.offline, "offline");
+  addCount(null, summary.kiosks_with_failures, "with failed services");
+
+  groupsEl.innerHTML = "";
+  groupsEl.className = "grid small";
+  const addGroup = (labelText, counts) => {
+    const row = document.createElement("div");
+    const label = document.createElement("span");
+    label.className = "label";
+    label.textContent = labelText;
+    const value = document.createElement("span");
+    value.textContent = formatGroup(counts);
+    row.appendChild(label);
+    row.appendChild(value);
+    groupsEl.appendChild(row);
+  };
+  addGroup("Location", summary.by_location);
+  addGroup("Git SHA", summary.by_git_sha);
+  addGroup("OS", summary.by_os_version);
+  addGroup("Failed", summary.failed_services);
+}
+
+// Counts come precomputed from the controller; "no-cache" revalidates with
+// the ETag, so an unchanged fleet costs a 304 per poll.
+const fleetSummary = { timer: null };
+
+async function loadFleetSummary() {
+  const statusEl = document.querySelector("#fleet-status");
+  const groupsEl = document.querySelector("#fleet-groups");
+  if (!statusEl || !groupsEl) return;
+  try {
+    const summary = await fetchJson("/api/fleet/summary", { cache: "no-cache" });
+    // Keep row dots on the controller's thresholds.
+    STATUS_THRESHOLDS_MS.online = summary.thresholds.online_sec * 1000;
+    STATUS_THRESHOLDS_MS.stale = summary.thresholds.stale_sec * 1000;
+    renderFleetSummary(statusEl, groupsEl, summary);
+  } catch (err) {
+    setStatus(groupsEl, `Failed to load fleet summary: ${err.message}`, "error");
+  }
+  if (fleetSummary.timer === null) {
+    fleetSummary.timer = setInterval(loadFleetSummary, SUMMARY_REFRESH_MS);
+  }
+}
+
+function renderKioskDetail(detailEl, kiosk) {
+  detailEl.innerHTML = "";
+  const addRow = (labelText, valueNode) => {
+    const row = document.createElement("div");
+    const label = document.createElement("span");
+    label.className = "label";
+    label.textContent = labelText;
+    row.appendChild(label);
+    row.appendChild(document.createTextNode(" "));
+    row.appendChild(valueNode);
+    detailEl.appendChild(row);
+  };
+
+  const statusValue = document.createElement("span");
+  statusValue.className = `status-dot ${statusClass(kiosk.last_seen)}`;
+  addRow("Status", statusValue);
+
+  const locationValue = document.createElement("span");
+  locationValue.textContent = kiosk.location || "—";
+  addRow("Location", locationValue);
+
+  const osValue = document.createElement("span");
+  osValue.textContent = kiosk.os_version || "—";
+  addRow("OS", osValue);
+
+  const gitValue = document.createElement("span");
+  gitValue.className = "mono";
+  gitValue.textContent = kiosk.git_sha || "—";
+  addRow("Git SHA", gitValue);
+
+  const ipValue = document.createElement("span");
+  ipValue.textContent = kiosk.ip || "—";
+  addRow("IP", ipValue);
+
+  const lastSeenValue = document.createElement("span");
+  const lastSeenText = kiosk.last_seen || "—";
+  lastSeenValue.textContent = `${lastSeenText} (${formatRelative(kiosk.last_seen)})`;
+  addRow("Last Seen", lastSeenValue);
+}
+
+function fillHistoryRow(tr, entry) {
+  tr.innerHTML = "";
+
+  const cmdTd = document.createElement("td");
+  cmdTd.className = "mono";
+  cmdTd.textContent = entry.cmd_id || "—";
+
+  const actionTd = document.createElement("td");
+  actionTd.textContent = entry.action || "—";
+
+  const whenTd = document.createElement("td");
+  whenTd.textContent = entry.when || "—";
+
+  const statusTd = document.createElement("td");
+  const statusPill = document.createElement("span");
+  const statusValue = entry.status || "queued";
+  statusPill.className = `pill ${statusValue}`;
+  statusPill.textContent = statusValue;
+  if (entry.attempts > 1 || entry.acked_at) {
+    statusPill.title = `Delivered ${entry.attempts || 1}x${entry.acked_at ? `, acknowledged ${entry.acked_at}` : ""}`;
+  }
+  statusTd.appendChild(statusPill);
+
+  const startedTd = document.createElement("td");
+  startedTd.textContent = entry.started_at || "—";
+
+  const finishedTd = document.createElement("td");
+  finishedTd.textContent = entry.finished_at || "—";
+
+  const outputTd = document.createElement("td");
+  outputTd.className = "mono";
+  if (entry.output_bytes || FINAL_STATUSES.includes(statusValue)) {
+    const outputLink = document.createElement("a");
+    outputLink.className = "link";
+    outputLink.href = "#live-output";
+    outputLink.textContent = entry.output_bytes ? `View (${formatBytes(entry.output_bytes)})` : "View";
+    outputLink.addEventListener("click", () => showOutput(entry.cmd_id));
+    outputTd.appendChild(outputLink);
+  } else {
+    outputTd.textContent = "—";
+  }
+
+  tr.appendChild(cmdTd);
+  tr.appendChild(actionTd);
+  tr.appendChild(whenTd);
+  tr.appendChild(statusTd);
+  tr.appendChild(startedTd);
+  tr.appendChild(finishedTd);
+  tr.appendChild(outputTd);
+}
+
+const FINAL_STATUSES = ["success", "failed", "cancelled", "timeout"];
+
+function formatBytes(size) {
+  if (size < 1024) return `${size} B`;
+  if (size < 1024 * 1024) return `${(size / 1024).toFixed(1)} KB`;
+  return `${(size / (1024 * 1024)).toFixed(1)} MB`;
+}
+
+const HISTORY_RELOAD_MS = 1000;
+const kioskDetail = { kioskId: null, kiosk: null, entries: new Map(), source: null, timer: null, reload: null };
+
+function patchKioskDetail(kiosk) {
+  const detailEl = document.querySelector("#kiosk-detail");
+  if (!detailEl || kiosk.kiosk_id !== kioskDetail.kioskId) return;
+  kioskDetail.kiosk = kiosk;
+  renderKioskDetail(detailEl, kiosk);
+}
+
+function patchHistory(change) {
+  if (change.kiosk_id !== kioskDetail.kioskId) return;
+  const row = kioskDetail.entries.get(change.cmd_id);
+  if (!row) {
+    // New command: fetch its metadata once, coalescing bursts (e.g. a rollout wave).
+    if (kioskDetail.reload === null) {
+      kioskDetail.reload = setTimeout(() => {
+        kioskDetail.reload = null;
+        loadHistory(kioskDetail.kioskId).catch((err) => {
+          setStatus(document.querySelector("#history-status"), `Failed to load history: ${err.message}`, "error");
+        });
+      }, HISTORY_RELOAD_MS);
+    }
+    return;
+  }
+  Object.keys(change).forEach((key) => {
+    if (change[key] !== undefined && change[key] !== null) row.entry[key] = change[key];
+  });
+  fillHistoryRow(row.tr, row.entry);
+  if (change.status === "running") {
+    tailCommand(change.cmd_id);
+  }
+}
+
+async function loadHistory(kioskId) {
+  const historyBody = document.querySelector("#history-table-body");
+  const historyStatus = document.querySelector("#history-status");
+  const { data: history, version } = await fetchSnapshot(
+    `/api/kiosks/${encodeURIComponent(kioskId)}/history`
+  );
+  historyBody.innerHTML = "";
+  kioskDetail.entries.clear();
+  history.forEach((entry) => {
+    const tr = document.createElement("tr");
+    fillHistoryRow(tr, entry);
+    kioskDetail.entries.set(entry.cmd_id, { tr, entry });
+    historyBody.appendChild(tr);
+  });
+  if (!history.length) {
+    setStatus(historyStatus, "No command history yet.", "muted");
+  } else {
+    setStatus(historyStatus, `Loaded ${history.length} entries.`, "muted");
+  }
+  const active = history.find((entry) => entry.status === "running");
+  if (active) {
+    tailCommand(active.cmd_id);
+  }
+  return version;
+}
+
 async function loadKioskDetail(kioskId) {
   const detailEl = document.querySelector("#kiosk-detail");
   const historyBody = document.querySelector("#history-table-body");
   const historyStatus = document.querySelector("#history-status");
   if (!detailEl || !historyBody || !historyStatus) return;
 
+  if (kioskDetail.source) kioskDetail.source.close();
+  kioskDetail.source = null;
+  kioskDetail.kioskId = kioskId;
   setStatus(historyStatus, "Loading history…", "muted");
   historyBody.innerHTML = "";
 
+  // Replay changes from the older of the two snapshots; patches are idempotent.
+  let since = null;
   try {
-    const kiosks = await fetchJson("/api/kiosks");
-    const kiosk = kiosks.find((item) => item.kiosk_id === kioskId);
-    if (kiosk) {
-      detailEl.innerHTML = "";
-      const addRow = (labelText, valueNode) => {
-        const row = document.createElement("div");
-        const label = document.createElement("span");
-        label.className = "label";
-        label.textContent = labelText;
-        row.appendChild(label);
-        row.appendChild(document.createTextNode(" "));
-        row.appendChild(valueNode);
-        detailEl.appendChild(row);
-      };
-
-      const statusValue = document.createElement("span");
-      statusValue.className = `status-dot ${statusClass(kiosk.last_seen)}`;
-      addRow("Status", statusValue);
-
-      const locationValue = document.createElement("span");
-      locationValue.textContent = kiosk.location || "—";
-      addRow("Location", locationValue);
-
-      const osValue = document.createElement("span");
-      osValue.textContent = kiosk.os_version || "—";
-      addRow("OS", osValue);
-
-      const gitValue = document.createElement("span");
-      gitValue.className = "mono";
-      gitValue.textContent = kiosk.git_sha || "—";
-      addRow("Git SHA", gitValue);
-
-      const ipValue = document.createElement("span");
-      ipValue.textContent = kiosk.ip || "—";
-      addRow("IP", ipValue);
-
-      const lastSeenValue = document.createElement("span");
-      const lastSeenText = kiosk.last_seen || "—";
-      lastSeenValue.textContent = `${lastSeenText} (${formatRelative(kiosk.last_seen)})`;
-      addRow("Last Seen", lastSeenValue);
+    const { data: kiosk, version } = await fetchSnapshot(`/api/kiosks/${encodeURIComponent(kioskId)}`);
+    since = version;
+    kioskDetail.kiosk = kiosk;
+    renderKioskDetail(detailEl, kiosk);
+  } catch (err) {
+    if (err.message === "not_found") {
+      detailEl.innerHTML = "<div class=\"muted\">Kiosk has not reported yet.</div>";
     } else {
-      detailEl.innerHTML = "<div class=\"muted\">Kiosk not found in latest list.</div>";
+      detailEl.innerHTML = `<div class="error">Failed to load kiosk info: ${err.message}</div>`;
     }
-  } catch (err) {
-    detailEl.innerHTML = `<div class="error">Failed to load kiosk info: ${err.message}</div>`;
   }
 
   try {
-    const history = await fetchJson(`/api/kiosks/${encodeURIComponent(kioskId)}/history`);
-    if (!history.length) {
-      setStatus(historyStatus, "No command history yet.", "muted");
-      return;
-    }
-    history.forEach((entry) => {
-      const tr = document.createElement("tr");
-
-      const cmdTd = document.createElement("td");
-      cmdTd.className = "mono";
-      cmdTd.textContent = entry.cmd_id || "—";
-
-      const actionTd = document.createElement("td");
-      actionTd.textContent = entry.action || "—";
-
-      const whenTd = document.createElement("td");
-      whenTd.textContent = entry.when || "—";
-
-      const statusTd = document.createElement("td");
-      const statusPill = document.createElement("span");
-      const statusValue = entry.status || "queued";
-      statusPill.className = `pill ${statusValue}`;
-      statusPill.textContent = statusValue;
-      statusTd.appendChild(statusPill);
-
-      const startedTd = document.createElement("td");
-      startedTd.textContent = entry.started_at || "—";
-
-      const finishedTd = document.createElement("td");
-      finishedTd.textContent = entry.finished_at || "—";
-
-      const outputTd = document.createElement("td");
-      outputTd.className = "mono";
-      outputTd.textContent = entry.output || "—";
-
-      tr.appendChild(cmdTd);
-      tr.appendChild(actionTd);
-      tr.appendChild(whenTd);
-      tr.appendChild(statusTd);
-      tr.appendChild(startedTd);
-      tr.appendChild(finishedTd);
-      tr.appendChild(outputTd);
-      historyBody.appendChild(tr);
-    });
-    setStatus(historyStatus, `Loaded ${history.length} entries.`, "muted");
+    const version = await loadHistory(kioskId);
+    since = since === null ? version : Math.min(since, version);
   } catch (err) {
     setStatus(historyStatus, `Failed to load history: ${err.message}`, "error");
   }
+
+  if (since !== null) {
+    kioskDetail.source = subscribeChanges(
+      since,
+      { kiosk: patchKioskDetail, command: patchHistory },
+      () => loadKioskDetail(kioskId)
+    );
+  }
+  if (kioskDetail.timer === null) {
+    kioskDetail.timer = setInterval(() => {
+      if (kioskDetail.kiosk) renderKioskDetail(detailEl, kioskDetail.kiosk);
+    }, AGE_REFRESH_MS);
+  }
+}
+
+const LIVE_POLL_MS = 2000;
+let liveTail = null;
+
+async function showOutput(cmdId) {
+  const outputEl = document.querySelector("#live-output");
+  const statusEl = document.querySelector("#live-status");
+  if (!outputEl || !statusEl) return;
+  if (liveTail) clearTimeout(liveTail.timer);
+  liveTail = null;
+  outputEl.textContent = "";
+  setStatus(statusEl, `Loading output of ${cmdId}…`, "muted");
+  try {
+    const data = await fetchJson(`/api/commands/${encodeURIComponent(cmdId)}/output`);
+    outputEl.textContent = data.output;
+    setStatus(statusEl, `Output of ${cmdId} (${formatBytes(data.size)})`, "muted");
+  } catch (err) {
+    const message = err.message === "not_found" ? "no output stored" : err.message;
+    setStatus(statusEl, `Output of ${cmdId}: ${message}`, err.message === "not_found" ? "muted" : "error");
+  }
+}
+
+async function tailCommand(cmdId) {
+  const outputEl = document.querySelector("#live-output");
+  const statusEl = document.querySelector("#live-status");
+  if (!outputEl || !statusEl) return;
+  if (liveTail && liveTail.cmdId === cmdId) return;
+  if (liveTail) clearTimeout(liveTail.timer);
+
+  const tail = { cmdId, lastSeq: 0, dropped: 0, timer: null };
+  liveTail = tail;
+  outputEl.textContent = "";
+  setStatus(statusEl, `Waiting for output from ${cmdId}…`, "muted");
+
+  const poll = async () => {
+    if (liveTail !== tail) return;
+    try {
+      const data = await fetchJson(
+        `/api/commands/${encodeURIComponent(cmdId)}/progress?after=${tail.lastSeq}`
+      );
+      let done = false;
+      data.chunks.forEach((chunk) => {
+        if (chunk.dropped_bytes > tail.dropped) {
+          outputEl.textContent += "\n[…output skipped…]\n";
+          tail.dropped = chunk.dropped_bytes;
+        }
+        outputEl.textContent += chunk.data;
+        done = done || chunk.done;
+      });
+      tail.lastSeq = data.last_seq;
+      if (data.chunks.length) {
+        outputEl.scrollTop = outputEl.scrollHeight;
+      }
+      const finished = done || (data.status && !["queued", "received", "running"].includes(data.status));
+      if (finished) {
+        setStatus(statusEl, `${cmdId}: ${data.status || "finished"}`, data.status === "failed" ? "error" : "success");
+        return;
+      }
+      setStatus(statusEl, `${cmdId}: ${data.status || "running"}…`, "muted");
+    } catch (err) {
+      setStatus(statusEl, `Live output unavailable: ${err.message}`, "error");
+    }
+    tail.timer = setTimeout(poll, LIVE_POLL_MS);
+  };
+  poll();
 }
 
 async function issueCommand(kioskId, action) {
@@ -252,7 +591,7 @@ async function issueCommand(kioskId, action) {
     if (actionStatus) {
       setStatus(actionStatus, `Command queued: ${result.cmd_id}`, "success");
     }
-    await loadKioskDetail(kioskId);
+    tailCommand(result.cmd_id);
   } catch (err) {
     if (actionStatus) {
       setStatus(actionStatus, `Command failed: ${err.message}`, "error");
@@ -261,7 +600,10 @@ async function issueCommand(kioskId, action) {
 }
 
 window.dashboard = {
+  loadFleetSummary,
   loadKioskList,
   loadKioskDetail,
   issueCommand,
+  tailCommand,
+  showOutput,
 };
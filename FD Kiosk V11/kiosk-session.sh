@@ -8,6 +8,8 @@ TARGET_URL="${TARGET_URL:-$PRIMARY_URL}"
 DEBUG_PORT="${DEBUG_PORT:-9222}"
 BROWSER="${BROWSER:-chromium}"            # chromium|firefox
 PROFILE_DIR="${PROFILE_DIR:-$HOME/.local/share/kiosk-${BROWSER}}"
+DISK_CACHE_MB="${DISK_CACHE_MB:-512}"     # room for both sites' static assets
+CACHE_PROXY="${CACHE_PROXY:-}"            # optional local caching proxy, e.g. http://127.0.0.1:3128
 
 export DISPLAY="${DISPLAY:-:0}"
 export DBUS_SESSION_BUS_ADDRESS="${DBUS_SESSION_BUS_ADDRESS:-unix:path=/run/user/$(id -u)/bus}"
@@ -56,6 +58,10 @@ launch_chromium() {
   if [ -n "$touch_device" ]; then
     touch_flags+=(--touch-devices="$touch_device")
   fi
+  local cache_flags=(--disk-cache-size=$((DISK_CACHE_MB * 1024 * 1024)))
+  if [ -n "$CACHE_PROXY" ]; then
+    cache_flags+=(--proxy-server="$CACHE_PROXY")
+  fi
 
   exec "$bin" \
     --user-data-dir="$PROFILE_DIR" \
@@ -71,6 +77,7 @@ launch_chromium() {
     --enable-features=OverlayScrollbar,VirtualKeyboard,TouchVirtualKeyboard \
     --force-renderer-accessibility \
     "${touch_flags[@]}" \
+    "${cache_flags[@]}" \
     --test-type \
     --no-first-run \
     --no-default-browser-check \
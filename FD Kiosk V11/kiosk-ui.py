@@ -1,21 +1,41 @@
 #!/usr/bin/env python3
 """
 Version 10.0 GTK overlay UI:
-- Toggle button swaps PRIMARY_URL/SECONDARY_URL
+- Toggle button swaps PRIMARY_URL/SECONDARY_URL, reusing one warm tab per site
+- The other site is kept preloaded in a background tab; toggle-to-paint time is logged
+- Toggle label follows the active page over the DevTools websocket
 - Back sends Alt+Left
-- xvkbd on-screen keyboard with auto-show via AT-SPI focus events
+- xvkbd on-screen keyboard with auto-show via AT-SPI focus events (one resident
+  process, mapped / unmapped on focus)
 """
+import json
 import os
 import shutil
 import subprocess
 import threading
+import time
+from collections import OrderedDict, deque
+from urllib.parse import urlsplit
 
 import gi
 import requests
 
+try:
+    import websocket
+except ImportError:  # python3-websocket; without it the label follows STATE_FILE only
+    websocket = None
+
+try:
+    import Xlib.display
+    import Xlib.protocol.event
+    import Xlib.X
+    import Xlib.Xatom
+except ImportError:  # python3-xlib; without it the keyboard is mapped through xdotool
+    Xlib = None
+
 gi.require_version("Gtk", "3.0")
 gi.require_version("Atspi", "2.0")
-from gi.repository import Atspi, Gdk, Gtk, GLib
+from gi.repository import Atspi, Gdk, Gio, Gtk, GLib
 
 # Ensure xdotool can see the display when run under systemd
 os.environ.setdefault("DISPLAY", ":0")
@@ -25,6 +45,13 @@ SECONDARY_URL = os.environ.get("SECONDARY_URL", "https://alphaonlines.org/pages/
 BROWSER = os.environ.get("BROWSER", "chromium").lower()
 STATE_FILE = os.environ.get("KIOSK_STATE_FILE", "/tmp/kiosk-current-url.txt")
 DEBUG_PORT = int(os.environ.get("DEBUG_PORT", "9222"))
+TABS_FILE = os.environ.get("KIOSK_TABS_FILE", "/tmp/kiosk-browser-tabs.json")
+TAB_RSS_BUDGET_MB = int(os.environ.get("KIOSK_TAB_RSS_BUDGET_MB", "1200"))
+TAB_SAMPLE_SEC = int(os.environ.get("KIOSK_TAB_SAMPLE_SEC", "0"))
+PREWARM = os.environ.get("KIOSK_PREWARM", "1") == "1"
+PREWARM_REFRESH_SEC = int(os.environ.get("KIOSK_PREWARM_REFRESH_SEC", "1800"))
+FOCUS_DEBOUNCE_MS = int(os.environ.get("KIOSK_FOCUS_DEBOUNCE_MS", "80"))
+FOCUS_FLOOD_PER_SEC = int(os.environ.get("KIOSK_FOCUS_FLOOD_PER_SEC", "50"))
 
 
 def read_state(default=PRIMARY_URL):
@@ -38,6 +65,13 @@ def read_state(default=PRIMARY_URL):
     return default
 
 
+def write_json_atomic(path, data):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as fh:
+        json.dump(data, fh)
+    os.replace(tmp, path)
+
+
 def write_state(url: str) -> None:
     try:
         with open(STATE_FILE, "w", encoding="utf-8") as fh:
@@ -46,20 +80,534 @@ def write_state(url: str) -> None:
         pass
 
 
-def target_for_toggle():
-    url = read_state().lower()
+def site_for(url):
+    """PRIMARY_URL or SECONDARY_URL for a page on either site, else None."""
+    url = (url or "").lower()
     if url.startswith(SECONDARY_URL.lower()) or "alphaonline" in url or "aj-test" in url:
+        return SECONDARY_URL
+    host = urlsplit(url).hostname or ""
+    primary_host = urlsplit(PRIMARY_URL.lower()).hostname or ""
+    if host and (host == primary_host or host.endswith("." + primary_host)):
+        return PRIMARY_URL
+    return None
+
+
+def target_for_toggle(current=None):
+    if site_for(current or read_state()) == SECONDARY_URL:
         return PRIMARY_URL
     return SECONDARY_URL
 
 
-def toggle():
-    target = target_for_toggle()
+toggle_lock = threading.Lock()
+
+
+def toggle(current=None):
+    """Switch sites on a worker thread; DevTools calls never block the GTK loop."""
+    threading.Thread(target=_toggle, args=(current,), name="toggle", daemon=True).start()
+
+
+def _toggle(current):
+    # A tap while a switch is still in flight would act on a stale label.
+    if not toggle_lock.acquire(blocking=False):
+        return
     try:
-        requests.put(f"http://127.0.0.1:{DEBUG_PORT}/json/new?{target}", timeout=2)
-        write_state(target)
-    except Exception:
+        target = target_for_toggle(current)
+        started = time.time()
+        try:
+            target_id, warm = tab_manager.show(target)
+            write_state(target)
+        except Exception as exc:
+            print(f"toggle to {target} failed: {exc}", flush=True)
+            return
+        tab_manager.after_toggle(target_id, warm, started)
+    finally:
+        toggle_lock.release()
+
+
+def read_rss(pid):
+    try:
+        with open(f"/proc/{pid}/status", "r", encoding="utf-8") as fh:
+            for line in fh:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
         pass
+    return 0
+
+
+class CdpSession:
+    """Blocking request / response calls over a short-lived browser websocket."""
+
+    def __init__(self, ws_url):
+        self.ws = websocket.create_connection(ws_url, timeout=5, suppress_origin=True)
+        self.next_id = 0
+        self.events = []
+
+    def call(self, method, session_id=None, **params):
+        self.next_id += 1
+        msg = {"id": self.next_id, "method": method, "params": params}
+        if session_id:
+            msg["sessionId"] = session_id
+        self.ws.send(json.dumps(msg))
+        while True:
+            reply = json.loads(self.ws.recv())
+            if reply.get("id") == self.next_id:
+                if "error" in reply:
+                    raise RuntimeError(reply["error"].get("message", method))
+                return reply.get("result") or {}
+            if "method" in reply:
+                self.events.append((time.time(), reply))
+
+    def wait_for(self, method, match, timeout):
+        """Arrival time of the first `method` event whose params satisfy match, or None."""
+        deadline = time.time() + timeout
+        while True:
+            for index, (arrived, event) in enumerate(self.events):
+                if event.get("method") == method and match(event.get("params") or {}):
+                    del self.events[: index + 1]
+                    return arrived
+            self.events = []
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            self.ws.settimeout(remaining)
+            try:
+                self.events.append((time.time(), json.loads(self.ws.recv())))
+            except websocket.WebSocketTimeoutException:
+                return None
+
+    def close(self):
+        self.ws.close()
+
+
+class TabManager:
+    """Keeps at most one warm tab per site and the browser under an RSS budget.
+
+    show() activates the tab already holding the target site (/json/activate)
+    or opens one, then closes strays: extra tabs of either site and pages on
+    neither. After tab changes and toggles (request_sample()) the browser's
+    process RSS is summed (SystemInfo.getProcessInfo + /proc); above
+    rss_budget_mb background
+    tabs are closed and reopened on the next toggle, the prewarm tab only
+    once no stray is left to close. Each sample
+    (per-tab JS heap included) is written to report_path for the agent
+    heartbeat. An idle kiosk is sampled only when the prewarm tab is due for
+    a reload, or every sample_sec if set, so a page growing on screen with
+    nobody touching it is caught late in exchange for no wakeup per minute.
+
+    With prewarm, the site not on screen is kept loaded in a background
+    target (Target.createTarget background=true) while RSS stays under 80%
+    of the budget, and reloaded every refresh_sec when nobody has toggled
+    for a minute, so a toggle only activates an already painted tab.
+    after_toggle() times click to first frame over CDP and logs it.
+
+    self.lock only guards the counters and prewarm bookkeeping; HTTP and
+    CDP calls run outside it, and only one prewarm runs at a time.
+
+    /json/activate raises a tab without any target event, so show() tells
+    the BrowserWatcher in watcher, if set, which tab is now on screen. The
+    prewarm tab is opened blank and hidden from the watcher before it
+    navigates, so loading it never counts as the page on screen.
+    """
+
+    def __init__(
+        self,
+        port=DEBUG_PORT,
+        rss_budget_mb=TAB_RSS_BUDGET_MB,
+        sample_sec=TAB_SAMPLE_SEC,
+        report_path=TABS_FILE,
+        prewarm=PREWARM,
+        refresh_sec=PREWARM_REFRESH_SEC,
+    ):
+        self.base = f"http://127.0.0.1:{port}"
+        self.rss_budget = rss_budget_mb * 1024 * 1024
+        self.sample_sec = sample_sec
+        self.report_path = report_path
+        self.prewarm_enabled = prewarm and websocket is not None
+        self.refresh_sec = refresh_sec
+        self.watcher = None
+        self.lock = threading.Lock()
+        self.discarded = 0
+        self.closed = 0
+        self.rss = 0
+        self.last_toggle = 0.0
+        self.loaded_at = {}
+        self.paint_ms = []
+        self.prewarming = False
+        self.wake = threading.Event()
+
+    def pages(self):
+        # Most recently active first.
+        listing = requests.get(f"{self.base}/json/list", timeout=2).json()
+        return [t for t in listing if t.get("type") == "page"]
+
+    def _close(self, target_id):
+        requests.get(f"{self.base}/json/close/{target_id}", timeout=2)
+
+    def show(self, url):
+        with self.lock:
+            self.last_toggle = time.time()
+        pages = self.pages()
+        warm = {}
+        for page in pages:
+            warm.setdefault(site_for(page["url"]), page)
+        warm.pop(None, None)
+        target = warm.get(site_for(url))
+        reused = target is not None
+        if reused:
+            requests.get(f"{self.base}/json/activate/{target['id']}", timeout=2)
+        else:
+            target = requests.put(f"{self.base}/json/new?{url}", timeout=2).json()
+        if self.watcher is not None:
+            self.watcher.activate(target["id"])
+        # Close only after switching so the window never loses its last tab.
+        closed = 0
+        for page in pages:
+            if page["id"] != target["id"] and warm.get(site_for(page["url"])) is not page:
+                self._close(page["id"])
+                closed += 1
+        with self.lock:
+            self.closed += closed
+        return target["id"], reused
+
+    def after_toggle(self, target_id, warm, started):
+        if websocket is None:
+            return
+        threading.Thread(
+            target=self._after_toggle,
+            args=(target_id, warm, started),
+            name="toggle-paint",
+            daemon=True,
+        ).start()
+
+    def _after_toggle(self, target_id, warm, started):
+        try:
+            painted = self.first_paint(target_id, warm)
+        except Exception:
+            painted = None
+        kind = "warm" if warm else "cold"
+        if painted is not None:
+            elapsed_ms = round((painted - started) * 1000)
+            with self.lock:
+                self.paint_ms = (self.paint_ms + [elapsed_ms])[-20:]
+            print(f"toggle to first paint: {elapsed_ms} ms ({kind} tab)", flush=True)
+        else:
+            print(f"toggle to first paint: not observed ({kind} tab)", flush=True)
+        # Load the other site only once this one is on screen.
+        try:
+            self.prewarm()
+        except Exception as exc:
+            print(f"prewarm failed: {exc}", flush=True)
+        self.request_sample()
+
+    def first_paint(self, target_id, warm, timeout=20):
+        """Wall time of the first frame painted by target_id after a toggle, or None."""
+        version = requests.get(f"{self.base}/json/version", timeout=2).json()
+        cdp = CdpSession(version["webSocketDebuggerUrl"])
+        try:
+            attached = cdp.call("Target.attachToTarget", targetId=target_id, flatten=True)
+            session = attached["sessionId"]
+            if warm:
+                # Background tabs get no animation frames; the second one after
+                # activation has been presented.
+                cdp.ws.settimeout(timeout)
+                cdp.call(
+                    "Runtime.evaluate",
+                    session_id=session,
+                    expression=(
+                        "new Promise(r => requestAnimationFrame(() => requestAnimationFrame(r)))"
+                    ),
+                    awaitPromise=True,
+                )
+                return time.time()
+            cdp.call("Page.enable", session_id=session)
+            cdp.call("Page.setLifecycleEventsEnabled", session_id=session, enabled=True)
+            painted = cdp.wait_for(
+                "Page.lifecycleEvent",
+                lambda p: p.get("name") == "firstContentfulPaint" and p.get("frameId") == target_id,
+                timeout,
+            )
+            if painted is None:
+                # Painted before we attached: read it back from the page.
+                result = cdp.call(
+                    "Runtime.evaluate",
+                    session_id=session,
+                    expression=(
+                        "(performance.getEntriesByName('first-contentful-paint')[0] || {})"
+                        ".startTime + performance.timeOrigin"
+                    ),
+                    returnByValue=True,
+                )
+                value = result.get("result", {}).get("value")
+                painted = value / 1000 if isinstance(value, (int, float)) else None
+            return painted
+        finally:
+            cdp.close()
+
+    def prewarm(self):
+        """Open (in the background) or periodically reload the site that is not on screen."""
+        with self.lock:
+            if not self.prewarm_enabled or self.prewarming or self.rss > self.rss_budget * 0.8:
+                return
+            self.prewarming = True
+        try:
+            self._prewarm()
+        finally:
+            with self.lock:
+                self.prewarming = False
+
+    def _prewarm(self):
+        pages = self.pages()
+        if not pages:
+            return
+        active = site_for(pages[0]["url"])
+        other = SECONDARY_URL if active == PRIMARY_URL else PRIMARY_URL
+        background = next((p for p in pages[1:] if site_for(p["url"]) == other), None)
+        now = time.time()
+        if background is not None:
+            with self.lock:
+                loaded = self.loaded_at.setdefault(background["id"], now)
+                last_toggle = self.last_toggle
+            if now - loaded < self.refresh_sec or now - last_toggle < 60:
+                return
+        version = requests.get(f"{self.base}/json/version", timeout=2).json()
+        cdp = CdpSession(version["webSocketDebuggerUrl"])
+        try:
+            if background is None:
+                created = cdp.call("Target.createTarget", url="about:blank", background=True)
+                if self.watcher is not None:
+                    self.watcher.hide(created["targetId"])
+                attached = cdp.call(
+                    "Target.attachToTarget", targetId=created["targetId"], flatten=True
+                )
+                cdp.call("Page.navigate", session_id=attached["sessionId"], url=other)
+                loaded_id = created["targetId"]
+            else:
+                attached = cdp.call(
+                    "Target.attachToTarget", targetId=background["id"], flatten=True
+                )
+                cdp.call("Page.reload", session_id=attached["sessionId"])
+                loaded_id = background["id"]
+        finally:
+            cdp.close()
+        with self.lock:
+            self.loaded_at = {loaded_id: now}
+
+    def start(self):
+        if websocket is None or BROWSER.startswith("firefox"):
+            return False
+        threading.Thread(target=self._run, name="tab-budget", daemon=True).start()
+        return True
+
+    def request_sample(self):
+        """Sample soon; called for BrowserWatcher target events and after toggles."""
+        self.wake.set()
+
+    def _idle_timeout(self):
+        timeouts = [self.sample_sec] if self.sample_sec > 0 else []
+        with self.lock:
+            if self.prewarm_enabled and self.loaded_at:
+                due = max(max(self.loaded_at.values()) + self.refresh_sec, self.last_toggle + 60)
+                timeouts.append(max(due - time.time(), 1))
+        return min(timeouts) if timeouts else None
+
+    def _run(self):
+        # First pass soon after start so the other site is warm before the first toggle.
+        timeout = 10
+        while True:
+            self.wake.wait(timeout)
+            # A navigation sends a burst of target events; sample once it settles.
+            time.sleep(2)
+            self.wake.clear()
+            try:
+                report = self.sample()
+                self.prewarm()
+                write_json_atomic(self.report_path, report)
+            except Exception:
+                pass
+            timeout = self._idle_timeout()
+
+    def sample(self):
+        pages = self.pages()
+        version = requests.get(f"{self.base}/json/version", timeout=2).json()
+        cdp = CdpSession(version["webSocketDebuggerUrl"])
+        try:
+            processes = cdp.call("SystemInfo.getProcessInfo").get("processInfo", [])
+            rss_by_type = {}
+            for proc in processes:
+                rss_by_type[proc["type"]] = rss_by_type.get(proc["type"], 0) + read_rss(proc["id"])
+            total = sum(rss_by_type.values())
+            tabs = []
+            for index, page in enumerate(pages):
+                tab = {
+                    "site": site_for(page["url"]),
+                    "url": urlsplit(page["url"])._replace(query="", fragment="").geturl(),
+                    "active": index == 0,
+                }
+                try:
+                    attached = cdp.call("Target.attachToTarget", targetId=page["id"], flatten=True)
+                    session = attached["sessionId"]
+                    heap = cdp.call("Runtime.getHeapUsage", session_id=session)
+                    cdp.call("Target.detachFromTarget", sessionId=session)
+                    tab["js_heap_used_bytes"] = int(heap.get("usedSize", 0))
+                    tab["js_heap_total_bytes"] = int(heap.get("totalSize", 0))
+                except Exception:
+                    pass
+                tabs.append(tab)
+        finally:
+            cdp.close()
+        discarded = 0
+        if total > self.rss_budget:
+            with self.lock:
+                warm_ids = set(self.loaded_at)
+            strays = [i for i in range(1, len(pages)) if pages[i]["id"] not in warm_ids]
+            # Stray tabs go first; the next sample drops the prewarm tab if still over.
+            for index in strays or range(1, len(pages)):
+                self._close(pages[index]["id"])
+                tabs[index]["discarded"] = True
+                discarded += 1
+        with self.lock:
+            self.discarded += discarded
+            self.rss = total
+            counters = (self.closed, self.discarded, list(self.paint_ms))
+        return {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "rss_bytes": total,
+            "rss_budget_bytes": self.rss_budget,
+            "rss_by_type": rss_by_type,
+            "tabs": tabs,
+            "tabs_closed": counters[0],
+            "tabs_discarded": counters[1],
+            "toggle_paint_ms": counters[2],
+            "focus": focus_tracker.snapshot(),
+        }
+
+
+tab_manager = TabManager()
+
+
+class BrowserWatcher:
+    """Follows the browser's active page over one DevTools websocket.
+
+    Target discovery events report every page opened, navigated or closed;
+    the page most recently opened or navigated counts as active and its URL
+    is passed to on_url (None while the browser is unreachable). Switching
+    to an existing tab sends no event, so whoever switches calls
+    activate(), which also hides every other page: hidden pages (background
+    tabs, including a prewarm tab passed to hide()) are tracked but never
+    reported until activated, so a reload or redirect behind the page on
+    screen does not move the label. The thread blocks in recv(), so an idle kiosk causes no
+    wakeups, and reconnects with backoff when the browser restarts.
+    on_change, if set, is called after any page is opened, navigated or closed.
+    """
+
+    def __init__(self, on_url, port=DEBUG_PORT):
+        self.on_url = on_url
+        self.port = port
+        self.lock = threading.Lock()
+        self.pages = {}
+        self.hidden = set()
+        self.url = None
+        self.on_change = None
+
+    def start(self):
+        if websocket is None or BROWSER.startswith("firefox"):
+            return False
+        threading.Thread(target=self._run, name="cdp-watch", daemon=True).start()
+        return True
+
+    def _run(self):
+        delay = 1
+        while True:
+            try:
+                self._session()
+            except Exception:
+                pass
+            if self.pages:
+                delay = 1
+            with self.lock:
+                self.pages = {}
+            self._publish()
+            time.sleep(delay)
+            delay = min(delay * 2, 30)
+
+    def _session(self):
+        base = f"http://127.0.0.1:{self.port}"
+        version = requests.get(f"{base}/json/version", timeout=2).json()
+        listing = requests.get(f"{base}/json/list", timeout=2).json()
+        # Chromium rejects DevTools websockets that send an Origin header.
+        ws = websocket.create_connection(version["webSocketDebuggerUrl"], timeout=5, suppress_origin=True)
+        try:
+            ws.send(json.dumps({"id": 1, "method": "Target.setDiscoverTargets", "params": {"discover": True}}))
+            # /json/list puts the most recently active page first.
+            with self.lock:
+                self.pages = {t["id"]: t["url"] for t in reversed(listing) if t.get("type") == "page"}
+                self.hidden &= set(self.pages)
+            self._publish()
+            ws.settimeout(None)
+            while True:
+                msg = json.loads(ws.recv())
+                self._handle(msg.get("method"), msg.get("params") or {})
+        finally:
+            ws.close()
+
+    def _handle(self, method, params):
+        with self.lock:
+            if method in ("Target.targetCreated", "Target.targetInfoChanged"):
+                info = params.get("targetInfo") or {}
+                target_id = info.get("targetId")
+                # Title changes and already listed pages keep their position.
+                if info.get("type") != "page" or self.pages.get(target_id) == info.get("url"):
+                    return
+                if target_id not in self.hidden:
+                    self.pages.pop(target_id, None)
+                self.pages[target_id] = info.get("url") or ""
+            elif method == "Target.targetDestroyed":
+                self.hidden.discard(params.get("targetId"))
+                if self.pages.pop(params.get("targetId"), None) is None:
+                    return
+            else:
+                return
+        self._publish()
+        if self.on_change is not None:
+            self.on_change()
+
+    def activate(self, target_id):
+        """Mark target_id as the page on screen after a switch that sent no event."""
+        with self.lock:
+            if target_id not in self.pages:
+                return
+            self.hidden = set(self.pages) - {target_id}
+            self.pages[target_id] = self.pages.pop(target_id)
+        self._publish()
+
+    def hide(self, target_id):
+        """Keep a background page from counting as active until it is activated."""
+        with self.lock:
+            self.hidden.add(target_id)
+        self._publish()
+
+    def _publish(self):
+        with self.lock:
+            url = next(
+                (
+                    u
+                    for target_id, u in reversed(list(self.pages.items()))
+                    if target_id not in self.hidden and u.startswith(("http://", "https://"))
+                ),
+                None,
+            )
+            # Called under the lock so racing publishers report in order.
+            if url != self.url:
+                self.url = url
+                self.on_url(url)
+
+
+def watch_state_file(on_change):
+    """inotify watch (Gio.FileMonitor) on STATE_FILE; keep the returned monitor referenced."""
+    monitor = Gio.File.new_for_path(STATE_FILE).monitor_file(Gio.FileMonitorFlags.NONE, None)
+    monitor.connect("changed", lambda *_: on_change())
+    return monitor
 
 
 def go_back():
@@ -67,76 +615,188 @@ def go_back():
 
 
 # Keyboard management (xvkbd)
-keyboard_process = None
+KEYBOARD_CMD = [
+    "xvkbd",
+    "-geometry",
+    "1200x600+360+560",
+    "-xrm",
+    "xvkbd*Font: 9x15bold",
+    "-xrm",
+    "xvkbd.name: KioskKeyboard",
+]
 autoshow_suppressed = False
 last_focus_editable = False
 
 
-def toggle_keyboard():
-    global autoshow_suppressed
-    if keyboard_process and keyboard_process.poll() is None:
-        stop_keyboard()
-        if last_focus_editable:
-            autoshow_suppressed = True
-    else:
-        autoshow_suppressed = False
-        start_keyboard()
+def find_window_by_class(display, window, name, pid=None, depth=2):
+    """Depth-limited search under window for a toplevel whose WM_CLASS contains name.
 
+    Override-redirect and transient windows (xvkbd's popups share its
+    WM_CLASS) are skipped, as is any window whose _NET_WM_PID is not pid.
+    """
+    pid_atom = display.intern_atom("_NET_WM_PID")
+    for child in window.query_tree().children:
+        wm_class = child.get_wm_class()
+        if wm_class and any(name in part.lower() for part in wm_class):
+            owner = child.get_full_property(pid_atom, Xlib.Xatom.CARDINAL)
+            if (
+                not child.get_attributes().override_redirect
+                and child.get_wm_transient_for() is None
+                and (pid is None or owner is None or owner.value[0] == pid)
+            ):
+                return child
+        elif depth > 1:
+            found = find_window_by_class(display, child, name, pid, depth - 1)
+            if found is not None:
+                return found
+    return None
 
-def start_keyboard():
-    global keyboard_process
-    if keyboard_process and keyboard_process.poll() is None:
-        return
-    try:
-        keyboard_process = subprocess.Popen(
-            [
-                "xvkbd",
-                "-geometry",
-                "1200x600+360+560",
-                "-xrm",
-                "xvkbd*Font: 9x15bold",
-                "-xrm",
-                "xvkbd.name: KioskKeyboard",
-            ],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-        )
-        threading.Timer(1.0, set_keyboard_always_on_top).start()
-    except FileNotFoundError:
-        pass
 
+class ResidentKeyboard:
+    """One long-lived xvkbd, shown and hidden by mapping its window.
 
-def stop_keyboard():
-    global keyboard_process
-    if keyboard_process and keyboard_process.poll() is None:
-        keyboard_process.terminate()
+    The process starts with the overlay and its toplevel is looked up once
+    per process (WM_CLASS via python-xlib, else one `xdotool search`),
+    skipping popups and windows of other processes.
+    show() sets _NET_WM_STATE_ABOVE and maps the window; hide() withdraws
+    it (unmap plus the ICCCM synthetic UnmapNotify). Both are single X
+    requests on the main loop, so nothing forks on focus changes. A dead
+    xvkbd is respawned on the next show().
+    """
+
+    def __init__(self):
+        self.process = None
+        self.window = None
+        self.visible = False
+        self.xdisplay = None
+        self.lookup_deadline = 0.0
+
+    def start(self):
+        if self.process is None or self.process.poll() is not None:
+            self._spawn()
+
+    def _spawn(self):
+        self.window = None
         try:
-            keyboard_process.wait(timeout=2)
-        except subprocess.TimeoutExpired:
-            keyboard_process.kill()
-    keyboard_process = None
+            self.process = subprocess.Popen(
+                KEYBOARD_CMD, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+        except FileNotFoundError:
+            self.process = None
+            return
+        self.lookup_deadline = time.monotonic() + 10
+        GLib.timeout_add(50 if Xlib else 250, self._lookup)
 
+    def _lookup(self):
+        if self.process is None or self.process.poll() is not None:
+            return False
+        try:
+            self.window = self._find_window()
+        except Exception:
+            self.window = None
+        if self.window is None:
+            return time.monotonic() < self.lookup_deadline
+        # xvkbd maps itself at start: withdraw it, then show it if focus asked meanwhile.
+        self._unmap()
+        if self.visible:
+            self._map()
+        return False
 
-def set_keyboard_always_on_top():
-    """Set xvkbd window to always stay on top."""
-    try:
-        result = subprocess.run(
-            ["wmctrl", "-l", "-x"],
-            capture_output=True,
-            text=True,
-            timeout=5,
+    def _find_window(self):
+        if Xlib is None:
+            # _NET_WM_PID is optional for Xt clients: fall back to the class alone.
+            for criteria in (["--all", "--pid", str(self.process.pid)], []):
+                out = subprocess.run(
+                    ["xdotool", "search", *criteria, "--classname", "xvkbd"],
+                    capture_output=True,
+                    text=True,
+                    timeout=2,
+                ).stdout.split()
+                if out:
+                    return int(out[0])
+            return None
+        if self.xdisplay is None:
+            self.xdisplay = Xlib.display.Display()
+        return find_window_by_class(
+            self.xdisplay, self.xdisplay.screen().root, "xvkbd", self.process.pid
         )
-        for line in result.stdout.split("\n"):
-            if "xvkbd" in line.lower() or "KioskKeyboard" in line:
-                window_id = line.split()[0]
-                subprocess.run(
-                    ["wmctrl", "-ir", window_id, "-b", "add,above"],
-                    check=False,
-                    timeout=5,
-                )
-                break
-    except Exception:
-        pass
+
+    def _map(self):
+        if Xlib is None:
+            xid = str(self.window)
+            subprocess.run(["xdotool", "windowmap", xid, "windowraise", xid], check=False)
+            return
+        d = self.xdisplay
+        # A withdrawn window may set its initial EWMH state itself.
+        above = d.intern_atom("_NET_WM_STATE_ABOVE")
+        self.window.change_property(d.intern_atom("_NET_WM_STATE"), Xlib.Xatom.ATOM, 32, [above])
+        self.window.map()
+        self.window.configure(stack_mode=Xlib.X.Above)
+        d.flush()
+
+    def _unmap(self):
+        if Xlib is None:
+            subprocess.run(["xdotool", "windowunmap", str(self.window)], check=False)
+            return
+        root = self.xdisplay.screen().root
+        self.window.unmap()
+        root.send_event(
+            Xlib.protocol.event.UnmapNotify(window=self.window, event=root, from_configure=False),
+            event_mask=Xlib.X.SubstructureRedirectMask | Xlib.X.SubstructureNotifyMask,
+        )
+        self.xdisplay.flush()
+
+    def is_shown(self):
+        return self.visible and self.process is not None and self.process.poll() is None
+
+    def show(self):
+        if self.visible and self.window is not None and self.process.poll() is None:
+            return
+        self.visible = True
+        if self.process is None or self.process.poll() is not None:
+            self._spawn()
+        elif self.window is not None:
+            self._run(self._map)
+
+    def hide(self):
+        if not self.visible:
+            return
+        self.visible = False
+        if self.window is not None and self.process is not None and self.process.poll() is None:
+            self._run(self._unmap)
+
+    def _run(self, request):
+        try:
+            request()
+        except Exception:
+            # Window gone (xvkbd restarted its toplevel): look it up again.
+            self.window = None
+            self.lookup_deadline = time.monotonic() + 10
+            GLib.timeout_add(50, self._lookup)
+
+    def close(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=2)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.process = None
+        self.window = None
+
+
+keyboard = ResidentKeyboard()
+
+
+def toggle_keyboard():
+    global autoshow_suppressed
+    if keyboard.is_shown():
+        keyboard.hide()
+        if last_focus_editable:
+            autoshow_suppressed = True
+    else:
+        autoshow_suppressed = False
+        keyboard.show()
 
 
 def is_editable(obj):
@@ -161,23 +821,132 @@ def is_editable(obj):
     return False
 
 
-def on_focus_event(event):
+def apply_focus(editable):
     global autoshow_suppressed, last_focus_editable
-    try:
-        focused = bool(event.detail1)
-    except Exception:
-        focused = False
-    if not focused:
-        return
-    obj = event.source
-    editable = is_editable(obj)
     last_focus_editable = editable
     if editable:
         if not autoshow_suppressed:
-            start_keyboard()
+            keyboard.show()
     else:
         autoshow_suppressed = False
-        stop_keyboard()
+        keyboard.hide()
+
+
+class FocusTracker:
+    """Coalesces AT-SPI focus bursts and applies only the last focus.
+
+    on_event() just remembers the newest focused accessible; the first
+    event of a burst arms a debounce_ms one-shot timer, and when it fires
+    only that last object is checked and applied. Editability is cached
+    per accessible (LRU of cache_size), dropped again on
+    object:state-changed:editable. Event counts, the busiest second and
+    handler latency go into the tab report; a second with flood_per_sec
+    events or more is logged (at most once a minute).
+    """
+
+    def __init__(
+        self, debounce_ms=FOCUS_DEBOUNCE_MS, flood_per_sec=FOCUS_FLOOD_PER_SEC, cache_size=256
+    ):
+        self.debounce_ms = debounce_ms
+        self.flood_per_sec = flood_per_sec
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.pending = None
+        self.armed = False
+        self.listener = None
+        self.lock = threading.Lock()
+        self.stats = {
+            "events": 0,
+            "focus_events": 0,
+            "applied": 0,
+            "cache_hits": 0,
+            "peak_per_sec": 0,
+        }
+        self.handler_ms = deque(maxlen=200)
+        self.second = 0
+        self.in_second = 0
+        self.flood_logged_at = 0.0
+
+    def start(self):
+        self.listener = Atspi.EventListener.new(self.on_event)
+        self.listener.register("object:state-changed:focused")
+        self.listener.register("object:state-changed:editable")
+
+    def on_event(self, event):
+        self._count(time.monotonic())
+        try:
+            if event.type.startswith("object:state-changed:editable"):
+                self.cache.pop(event.source, None)
+                return
+            focused = bool(event.detail1)
+        except Exception:
+            return
+        if not focused:
+            return
+        with self.lock:
+            self.stats["focus_events"] += 1
+        self.pending = event.source
+        if not self.armed:
+            self.armed = True
+            GLib.timeout_add(self.debounce_ms, self._apply)
+
+    def _count(self, now):
+        second = int(now)
+        if second != self.second:
+            self.second = second
+            self.in_second = 0
+        self.in_second += 1
+        with self.lock:
+            self.stats["events"] += 1
+            self.stats["peak_per_sec"] = max(self.stats["peak_per_sec"], self.in_second)
+        if self.in_second == self.flood_per_sec and now - self.flood_logged_at >= 60:
+            self.flood_logged_at = now
+            print(f"AT-SPI flood: {self.flood_per_sec}+ events in one second", flush=True)
+
+    def _apply(self):
+        self.armed = False
+        obj, self.pending = self.pending, None
+        if obj is None:
+            return False
+        started = time.monotonic()
+        apply_focus(self.editable(obj))
+        elapsed_ms = (time.monotonic() - started) * 1000
+        with self.lock:
+            self.stats["applied"] += 1
+            self.handler_ms.append(elapsed_ms)
+        return False
+
+    def editable(self, obj):
+        try:
+            editable = self.cache.pop(obj)
+        except (KeyError, TypeError):
+            editable = is_editable(obj)
+        else:
+            with self.lock:
+                self.stats["cache_hits"] += 1
+        try:
+            self.cache[obj] = editable
+        except TypeError:
+            return editable
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return editable
+
+    def snapshot(self):
+        with self.lock:
+            data = dict(self.stats)
+            samples = sorted(self.handler_ms)
+        data["coalesced"] = data["focus_events"] - data["applied"]
+        if samples:
+            data["handler_ms"] = {
+                "p50": round(samples[len(samples) // 2], 2),
+                "p95": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 2),
+                "max": round(samples[-1], 2),
+            }
+        return data
+
+
+focus_tracker = FocusTracker()
 
 
 def start_focus_monitor():
@@ -185,8 +954,7 @@ def start_focus_monitor():
     ensure_atspi_bus()
     try:
         Atspi.init()
-        listener = Atspi.EventListener.new(on_focus_event)
-        listener.register("object:state-changed:focused")
+        focus_tracker.start()
     except Exception:
         pass
 
@@ -271,11 +1039,21 @@ class OverlayApp:
         self.screen_height = screen.get_height()
 
         start_focus_monitor()
+        keyboard.start()
 
         self.toggle_button, self.toggle_window = self._make_toggle_window()
         self._make_back_window()
 
-        GLib.timeout_add(800, self.update_toggle_text)
+        # The label changes only when the active URL does: DevTools events
+        # while the browser is reachable, the state file otherwise.
+        self.active_url = None
+        self.state_monitor = watch_state_file(self.on_state_file_changed)
+        self.browser = BrowserWatcher(lambda url: GLib.idle_add(self.on_active_url, url))
+        self.browser.on_change = tab_manager.request_sample
+        if self.browser.start():
+            tab_manager.watcher = self.browser
+        tab_manager.start()
+        self.update_toggle_text()
 
     def _make_window(self, label, on_click, width, height, x, y, style_class):
         win = Gtk.Window()
@@ -302,26 +1080,38 @@ class OverlayApp:
     def _make_toggle_window(self):
         width, height = 220, 50
         x, y = 10, self.screen_height - 60
-        return self._make_window("Toggle", toggle, width, height, x, y, "kiosk-toggle")
+        return self._make_window(
+            "Toggle", lambda: toggle(self.active_url), width, height, x, y, "kiosk-toggle"
+        )
 
     def _make_back_window(self):
         width, height = 120, 45
         x, y = 10, 10
         self._make_window("← Back", go_back, width, height, x, y, "kiosk-back")
 
+    def on_active_url(self, url):
+        self.active_url = url
+        if url:
+            write_state(url)
+        self.update_toggle_text()
+        return False
+
+    def on_state_file_changed(self):
+        if self.active_url is None:
+            self.update_toggle_text()
 
     def update_toggle_text(self):
-        target = target_for_toggle().lower()
+        target = target_for_toggle(self.active_url).lower()
         label = "Furniture Distributors" if target.startswith(PRIMARY_URL.lower()) else "AlphaPulse"
-        self.toggle_button.set_label(label)
-        return True
+        if label != self.toggle_button.get_label():
+            self.toggle_button.set_label(label)
 
     def run(self):
         try:
             self.toggle_window.connect("destroy", Gtk.main_quit)
             Gtk.main()
         finally:
-            stop_keyboard()
+            keyboard.close()
 
 
 if __name__ == "__main__":